@@ -17,6 +17,14 @@ exception InvalidMessageException {
     1: string fault
 }
 
+exception ReplicationGapException {
+    1: string fault
+}
+
+exception InvalidSubscriptionException {
+    1: string fault
+}
+
 /* Message types */
 
 enum MessageType {
@@ -85,6 +93,25 @@ struct Message {
     3: optional ChatStatusMessage chatStatusMessage
 }
 
+/* Send message status */
+enum SendMessageStatus {
+    SENT,
+    INVALID_CHAT,
+    INVALID_MESSAGE,
+    UNAVAILABLE
+}
+
+/* Send message result
+ *
+ * message is the updated message if the message was sent,
+ * otherwise error describes why the message was not sent.
+ */
+struct SendMessageResult {
+    1: SendMessageStatus status,
+    2: optional Message message,
+    3: optional string error
+}
+
 
 /* Hashring */
 
@@ -106,7 +133,12 @@ struct UserState {
     3: double updateTimestamp
 }
 
-/* Chat State */
+/* Chat State
+ *
+ * Note that delta snapshots only include the state
+ * fields which have changed, and unchanged fields
+ * will be unset.
+ */
 struct ChatState {
     1: string token,
     2: ChatStatus status,
@@ -120,9 +152,66 @@ struct ChatState {
     10: map<string, string> session
 }
 
+/* Chat Cursor
+ *
+ * Position of a client within a chat, for which
+ * messages with timestamps greater than asOf
+ * should be returned.
+ */
+struct ChatCursor {
+    1: string chatToken,
+    2: double asOf
+}
+
+/* Chat Messages
+ *
+ * New messages for a single chat. invalidChat is set
+ * if the chat token is invalid or the chat has expired.
+ */
+struct ChatMessages {
+    1: string chatToken,
+    2: list<Message> messages,
+    3: optional bool invalidChat
+}
+
+/* Chat Snapshot
+ *
+ * epoch identifies the sequence numbers of the replicating
+ * chat instance. Delta snapshots (baseSequence set) contain
+ * the changes since baseSequence, and can only be applied
+ * by replicas which have already applied a snapshot with
+ * a sequence of at least baseSequence for the same epoch.
+ */
 struct ChatSnapshot {
     1: bool fullSnapshot,
-    2: ChatState state
+    2: ChatState state,
+    3: optional string epoch,
+    4: optional i64 sequence,
+    5: optional i64 baseSequence
+}
+
+/* Chat Digest Bucket
+ *
+ * Digest of the ids of the messages whose timestamps fall
+ * within [start, start + bucketDuration). The digest is
+ * independent of message order.
+ */
+struct ChatDigestBucket {
+    1: double start,
+    2: i32 count,
+    3: string digest
+}
+
+/* Chat Digest
+ *
+ * Used by anti-entropy to compare replicas of a chat,
+ * so that only the messages in mismatched buckets
+ * need to be transferred.
+ */
+struct ChatDigest {
+    1: string token,
+    2: double bucketDuration,
+    3: list<ChatDigestBucket> buckets
 }
 
 
@@ -145,6 +234,41 @@ service TChatService extends core.TRService
                 1:UnavailableException unavailableException,
                 2:InvalidChatException invalidChatException)
 
+    list<ChatMessages> getMessagesMulti(
+            1: core.RequestContext requestContext,
+            2: list<ChatCursor> cursors,
+            3: bool block,
+            4: i32 timeout) throws (
+                1:UnavailableException unavailableException)
+
+    /* Push subscriptions
+     *
+     * Messages are pushed to subscriptions as they arrive and
+     * returned by pollSubscription(). If a subscription is lost
+     * (InvalidSubscriptionException), clients should resume from
+     * their cursor with subscribe() or getMessages().
+     */
+    string subscribe(
+            1: core.RequestContext requestContext,
+            2: string chatToken,
+            3: double asOf) throws (
+                1:UnavailableException unavailableException,
+                2:InvalidChatException invalidChatException)
+
+    list<Message> pollSubscription(
+            1: core.RequestContext requestContext,
+            2: string chatToken,
+            3: string subscriptionId,
+            4: i32 timeout) throws (
+                1:UnavailableException unavailableException,
+                2:InvalidChatException invalidChatException,
+                3:InvalidSubscriptionException invalidSubscriptionException)
+
+    void unsubscribe(
+            1: core.RequestContext requestContext,
+            2: string chatToken,
+            3: string subscriptionId),
+
     Message sendMessage(
             1: core.RequestContext requestContext,
             2: Message message,
@@ -154,6 +278,13 @@ service TChatService extends core.TRService
                 2:InvalidChatException invalidChatException, 
                 3:InvalidMessageException invalidMessageException), 
 
+    list<SendMessageResult> sendMessages(
+            1: core.RequestContext requestContext,
+            2: list<Message> messages,
+            3: i32 N,
+            4: i32 W) throws (
+                1:UnavailableException unavailableException),
+
     string twilioRequest(
             1: core.RequestContext requestContext,
             2: string path
@@ -163,7 +294,19 @@ service TChatService extends core.TRService
 
     void replicate(
             1: core.RequestContext requestContext,
-            2: ChatSnapshot chatSnapshot),
+            2: ChatSnapshot chatSnapshot) throws (
+                1:ReplicationGapException replicationGapException),
+
+    ChatDigest getChatDigest(
+            1: core.RequestContext requestContext,
+            2: string chatToken,
+            3: double bucketDuration),
+
+    list<Message> getChatBucketMessages(
+            1: core.RequestContext requestContext,
+            2: string chatToken,
+            3: double bucketDuration,
+            4: list<double> bucketStarts),
 
     bool expireZookeeperSession(
             1: core.RequestContext requestContext,
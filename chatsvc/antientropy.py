@@ -0,0 +1,179 @@
+import logging
+
+import gevent
+
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+class AntiEntropy(object):
+    """Anti-entropy synchronizer.
+
+    Periodically compares the chats for which this service
+    is the primary with their replicas, and exchanges the
+    messages missing from either copy. Replicas are compared
+    using chat digests (getChatDigest) which contain a hash of
+    the message ids in each time bucket, so that only the
+    messages in mismatched buckets (getChatBucketMessages) are
+    exchanged, and replicas which already agree cost a single
+    digest request.
+
+    Messages which only the replica holds, i.e. messages sent
+    to a previous primary prior to a failover, are stored
+    locally, and messages which the replica is missing are
+    sent to the replica.
+
+    Replicas which have been verified at the chat's current
+    sequence are not compared again until the chat changes.
+    """
+
+    def __init__(
+            self,
+            replicator,
+            chat_manager,
+            interval=60,
+            bucket_duration=60):
+        """AntiEntropy constructor.
+
+        Args:
+            replicator: Replicator object whose preference
+                lists and replication connections will be used.
+            chat_manager: ChatManager object
+            interval: number of seconds between anti-entropy passes
+            bucket_duration: digest bucket duration in seconds
+        """
+        self.replicator = replicator
+        self.chat_manager = chat_manager
+        self.interval = interval
+        self.bucket_duration = bucket_duration
+
+        #dict of {(chat_token, service_key): sequence} of the
+        #chat sequence at which the replica was last verified.
+        self.verified = {}
+
+        self.running = False
+        self.greenlet = None
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+    def start(self):
+        """Start anti-entropy."""
+        if not self.running:
+            self.running = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        """Run anti-entropy."""
+        while self.running:
+            try:
+                gevent.sleep(self.interval)
+                self.synchronize()
+            except gevent.GreenletExit:
+                break
+            except Exception as error:
+                self.log.exception(error)
+
+        self.running = False
+
+    def stop(self):
+        """Stop anti-entropy."""
+        if self.running:
+            self.running = False
+            self.greenlet.kill()
+
+    def join(self, timeout=None):
+        """Join anti-entropy.
+
+        Args:
+            timeout: optional maximum number of seconds to wait
+                for anti-entropy to complete.
+        """
+        if self.greenlet:
+            self.greenlet.join(timeout)
+
+    def synchronize(self):
+        """Synchronize all chats for which we are the primary.
+
+        Returns:
+            number of messages exchanged with replicas.
+        """
+        exchanged = 0
+        chats = self.chat_manager.all()
+        for chat_token, chat in chats.items():
+            preference_list = self.replicator.preference_list(chat_token)[:self.replicator.N]
+            if not preference_list or self.replicator.is_remote_node(preference_list[0]):
+                continue
+
+            for node in preference_list[1:]:
+                if self.replicator.is_remote_node(node):
+                    try:
+                        exchanged += self.synchronize_node(chat, node)
+                    except Exception as error:
+                        self.log.warning("anti-entropy for %s at %s failed: %s" % (
+                            chat_token, node, error))
+
+            #Yield between chats since digests are cpu bound.
+            gevent.sleep(0)
+
+        for chat_token, service_key in self.verified.keys():
+            if chat_token not in chats:
+                del self.verified[(chat_token, service_key)]
+
+        if exchanged:
+            self.log.info("anti-entropy exchanged %s missing message(s)" % exchanged)
+        return exchanged
+
+    def synchronize_node(self, chat, node):
+        """Synchronize chat with the replica on the given node.
+
+        Args:
+            chat: Chat object
+            node: ServiceHashringNode of the replica
+        Returns:
+            number of messages exchanged with the replica.
+        """
+        verified_key = (chat.token, node.service_info.key)
+        if self.verified.get(verified_key) == chat.sequence:
+            return 0
+
+        digest = chat.digest(self.bucket_duration)
+        service_proxy_pool = self.replicator.service_proxy_pool(node)
+        with service_proxy_pool.get() as proxy:
+            context = self.replicator.build_request_context()
+            replica_digest = proxy.getChatDigest(context, chat.token, self.bucket_duration)
+
+            buckets = dict((start, (count, value)) for start, count, value in digest)
+            replica_buckets = dict((b.start, (b.count, b.digest))
+                    for b in replica_digest.buckets or [])
+            mismatched = sorted(start for start in set(buckets) | set(replica_buckets)
+                    if buckets.get(start) != replica_buckets.get(start))
+
+            pulled = []
+            pushed = []
+            if mismatched:
+                records = chat.bucket_messages(self.bucket_duration, mismatched)
+                replica_messages = proxy.getChatBucketMessages(
+                        context, chat.token, self.bucket_duration, mismatched)
+
+                message_ids = set(record.id for record in records)
+                replica_message_ids = set(message.header.id for message in replica_messages)
+
+                pulled = [message for message in replica_messages
+                        if message.header.id not in message_ids]
+                if pulled:
+                    chat.store_replicated_messages(pulled)
+
+                pushed = [record.message for record in records
+                        if record.id not in replica_message_ids]
+                if pushed:
+                    #Send an unsequenced, messages only snapshot,
+                    #which the replica will merge into its messages.
+                    snapshot = ChatSnapshot(
+                            fullSnapshot=False,
+                            state=ChatState(token=chat.token, messages=pushed))
+                    proxy.replicate(context, snapshot)
+
+                self.log.info("anti-entropy pulled %s and pushed %s message(s) in %s bucket(s) of %s with %s" % (
+                    len(pulled), len(pushed), len(mismatched), chat.token, node))
+
+        #Pulled messages change the chat's sequence, so that
+        #they are exchanged with the chat's other replicas.
+        self.verified[verified_key] = chat.sequence
+        return len(pulled) + len(pushed)
@@ -1,12 +1,323 @@
 import bisect
+import hashlib
 import logging
+import struct
+import time
+import uuid
+from array import array
 
-from gevent.event import Event
+import gevent
+from gevent.event import AsyncResult, Event
 from sqlalchemy.orm.exc import NoResultFound
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
 
 from trpycore.timezone import tz
 from trsvcscore.db.models import Chat as ChatModel
-from trchatsvc.gen.ttypes import MessageRouteType, ChatState, ChatStatus
+from trchatsvc.gen.ttypes import Message, MessageRouteType, ChatState, ChatStatus
+
+class ChatLoadException(Exception):
+    """Raised when a chat could not be loaded due to
+    an error, rather than because it does not exist."""
+    pass
+
+
+class MessageRecord(object):
+    """Compact stored message.
+
+    Chats store each message as a record containing the
+    binary encoding of the message, along with the header
+    fields needed to order and route it, instead of the
+    Message object and its nested header, route and payload
+    objects. Message objects are only materialized when
+    messages are returned to clients or replicated.
+
+    Records may be written in place of Message objects, in
+    which case the encoded message is written to binary
+    protocols as is, so that messages read by many clients
+    are only encoded once.
+    """
+
+    __slots__ = ["id", "timestamp", "route_type", "recipients", "data"]
+
+    def __init__(self, message):
+        """MessageRecord constructor.
+
+        Args:
+            message: Message object
+        """
+        header = message.header
+        self.id = header.id
+        self.timestamp = header.timestamp
+        self.route_type = header.route.type
+        self.recipients = tuple(header.route.recipients or ())
+
+        transport = TTransport.TMemoryBuffer()
+        message.write(TBinaryProtocol.TBinaryProtocolAccelerated(transport))
+        self.data = transport.getvalue()
+
+    @property
+    def message(self):
+        """Materialize Message object.
+
+        Returns:
+            new Message object decoded from the record.
+        """
+        message = Message()
+        transport = TTransport.TMemoryBuffer(self.data)
+        message.read(TBinaryProtocol.TBinaryProtocolAccelerated(transport))
+        return message
+
+    def write(self, oprot):
+        """Write message to the given protocol.
+
+        Args:
+            oprot: Thrift protocol object
+        """
+        if isinstance(oprot, TBinaryProtocol.TBinaryProtocol):
+            oprot.trans.write(self.data)
+        else:
+            self.message.write(oprot)
+
+
+def materialize(records):
+    """Materialize Message objects from records.
+
+    Args:
+        records: list of MessageRecord objects
+    Returns:
+        list of Message objects
+    """
+    return [record.message for record in records]
+
+
+class MessageWaiter(object):
+    """Message waiter.
+
+    Represents a single blocking get_messages() request
+    which is waiting for new messages to arrive.
+    """
+
+    def __init__(self, user_id=None, asOf=None, event=None):
+        """MessageWaiter constructor.
+
+        Args:
+            user_id: optional user_id of the waiting user.
+                If None, the waiter is interested in all
+                messages and will be woken for every message.
+            asOf: optional timestamp cursor of the waiter.
+                The waiter is only interested in messages
+                with timestamps greater than asOf.
+            event: optional Event to set when the waiter is
+                woken, which allows a single event to be
+                shared by waiters in multiple chats.
+        """
+        self.user_id = user_id
+        self.asOf = asOf
+        self.event = event or Event()
+
+    def is_satisfied(self, timestamp):
+        """Check if a message timestamp satisfies the waiter's cursor.
+
+        Args:
+            timestamp: message timestamp
+        Returns:
+            True if a message with the given timestamp
+            would be returned to the waiter.
+        """
+        return self.asOf is None or timestamp > self.asOf
+
+    def wait(self, timeout=None):
+        """Wait to be woken.
+
+        Args:
+            timeout: optional timeout in seconds.
+        Returns:
+            True if the waiter was woken, False otherwise.
+        """
+        return self.event.wait(timeout)
+
+    def wake(self):
+        """Wake the waiter."""
+        self.event.set()
+
+class MessageSubscription(object):
+    """Message subscription.
+
+    Represents a client subscribed to the messages routed to
+    a user. New messages are pushed to the subscription as they
+    are stored in the chat, and queued until the client polls,
+    so that polls do not need to read messages from the chat.
+
+    The subscription's cursor is the latest message timestamp
+    delivered to the client, which allows the client to resume
+    with get_messages() or a new subscription if the
+    subscription is lost.
+    """
+
+    def __init__(self, user_id, asOf, max_queue_size=1000):
+        """MessageSubscription constructor.
+
+        Args:
+            user_id: user_id of the subscribed user, or None
+                to subscribe to all messages, including those
+                with NO_ROUTE.
+            asOf: timestamp cursor after which messages
+                should be delivered.
+            max_queue_size: maximum number of undelivered
+                messages before the subscription overflows.
+        """
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.cursor = asOf or 0
+        self.max_queue_size = max_queue_size
+        self.messages = []
+        self.overflowed = False
+        self.last_poll = time.time()
+        self.event = Event()
+
+        #time at which a poll was last handled
+        #by message handlers (user presence).
+        self.last_handle_poll = 0
+
+    def push(self, messages):
+        """Push messages to the subscription.
+
+        Once the subscription overflows its queued messages
+        are dropped, and no further messages are queued.
+
+        Args:
+            messages: list of MessageRecord objects routed
+                to the subscribed user.
+        """
+        if self.overflowed:
+            return
+
+        messages = [m for m in messages if m.timestamp > self.cursor]
+        if messages:
+            self.messages.extend(messages)
+            if len(self.messages) > self.max_queue_size:
+                self.overflowed = True
+                self.messages = []
+            self.event.set()
+
+    def poll(self, timeout=None):
+        """Poll for pushed messages.
+
+        Args:
+            timeout: optional timeout in seconds to wait
+                for messages if none are queued.
+        Returns:
+            list of Message objects ordered by timestamp.
+        """
+        self.last_poll = time.time()
+        if not self.messages:
+            self.event.wait(timeout)
+
+        messages = self.messages
+        self.messages = []
+        self.event.clear()
+
+        if messages:
+            messages.sort(key=lambda m: m.timestamp)
+            self.cursor = max(self.cursor, messages[-1].timestamp)
+        return materialize(messages)
+
+    def is_expired(self, ttl):
+        """Check if the subscription has not been polled within ttl seconds.
+
+        Args:
+            ttl: subscription time to live in seconds
+        Returns:
+            True if the subscription is expired.
+        """
+        return time.time() - self.last_poll > ttl
+
+
+class MessageLog(object):
+    """Ordered message log.
+
+    Sorted list of MessageRecord objects, ordered by timestamp,
+    which allows messages to be retrieved by timestamp with
+    a binary search and slice.
+
+    Messages are almost always added in timestamp order, so
+    appends are O(1). Out of order messages, which are typically
+    the result of replication, are merged into the tail of the
+    log in a single pass.
+    """
+
+    def __init__(self, messages=None):
+        """MessageLog constructor.
+
+        Args:
+            messages: optional list to store messages in.
+                The list must be empty, and will be updated
+                in place as messages are added to the log.
+        """
+        #compact array of message timestamps. Note that
+        #the indexes in self.timestamps correlate exactly
+        #with the indexes of self.messages.
+        self.timestamps = array("d")
+        self.messages = messages if messages is not None else []
+
+    def __len__(self):
+        return len(self.messages)
+
+    def merge(self, messages):
+        """Merge messages into the log.
+
+        Args:
+            messages: list of MessageRecord objects sorted
+                by timestamp.
+        """
+        if not messages:
+            return
+
+        timestamps = [m.timestamp for m in messages]
+        if not self.timestamps or timestamps[0] >= self.timestamps[-1]:
+            self.timestamps.extend(timestamps)
+            self.messages.extend(messages)
+            return
+        
+        #Only the tail of the log following the first
+        #new message needs to be merged.
+        index = bisect.bisect(self.timestamps, timestamps[0])
+        tail_timestamps = self.timestamps[index:]
+        tail_messages = self.messages[index:]
+        del self.timestamps[index:]
+        del self.messages[index:]
+
+        i = j = 0
+        while i < len(tail_messages) and j < len(messages):
+            if tail_timestamps[i] <= timestamps[j]:
+                self.timestamps.append(tail_timestamps[i])
+                self.messages.append(tail_messages[i])
+                i += 1
+            else:
+                self.timestamps.append(timestamps[j])
+                self.messages.append(messages[j])
+                j += 1
+
+        self.timestamps.extend(tail_timestamps[i:])
+        self.messages.extend(tail_messages[i:])
+        self.timestamps.extend(timestamps[j:])
+        self.messages.extend(messages[j:])
+
+    def since(self, asOf=None):
+        """Get messages with timestamps greater than asOf.
+
+        Args:
+            asOf: optional timestamp boundary. If None,
+                all messages will be returned.
+        Returns:
+            list of MessageRecord objects.
+        """
+        if asOf is None:
+            return list(self.messages)
+        index = bisect.bisect(self.timestamps, asOf)
+        return self.messages[index:]
+
 
 class Chat(object):
     """Chat object.
@@ -16,6 +327,25 @@ class Chat(object):
     data which is useful for bookkeeping and  replication.
     """
 
+    #ChatState fields which are replicated
+    STATE_FIELDS = [
+        "status",
+        "maxDuration",
+        "maxParticipants",
+        "startTimestamp",
+        "endTimestamp",
+        "users",
+        "persisted",
+        "session"
+    ]
+
+    #Approximate in memory sizes, in bytes, of a chat,
+    #a message record excluding its encoded message,
+    #and a user, used to estimate chat size.
+    BASE_SIZE = 4096
+    MESSAGE_SIZE = 256
+    USER_SIZE = 256
+
     def __init__(self, service_handler, chat_token):
         """Chat constructor.
 
@@ -41,60 +371,272 @@ class Chat(object):
         #database model id
         self.id = None
 
+        #time at which the chat was last accessed
+        #through the ChatManager.
+        self.last_accessed = time.time()
+
         #loaded event which will be triggered
         #when the chat session is successfully
         #loaded from the database.
         self.loaded_event = Event()
 
-        #message event which will be triggered
-        #when a new message is added to the 
-        #chat session.
-        self.message_event = Event()
+        #dict of {user_id: set of MessageWaiter objects}
+        #for blocking get_messages() requests. Waiters
+        #which are not filtering messages by user_id are
+        #stored under the None key, and will be woken
+        #for every new message added to the chat.
+        self.message_waiters = {}
+
+        #dict of {subscription_id: MessageSubscription}
+        #to which new messages are pushed.
+        self.subscriptions = {}
         
-        #sorted list of Message object timestamps
-        #to allow for binary search by message
-        #timestamp. Note that the message indexes in
-        #self.message_timestamps correlate exactly
-        #with the indexes of self.messages.
-        self.message_timestamps = []
+        #ordered log of all chat messages to allow
+        #for binary search by message timestamp.
+        #Note that the log stores MessageRecord
+        #objects in self.state.messages.
+        self.message_log = MessageLog(self.state.messages)
         
-        #dict of {message_id: message} to prevent
+        #dict of {message_id: MessageRecord} to prevent
         #the addition of duplicate messages.
         self.message_history = {}
+
+        #total size of the encoded messages
+        self.message_bytes = 0
+
+        #dict of {user_id: MessageLog} containing the
+        #messages routed to each user which has requested
+        #messages. Indexes are created on first request
+        #and maintained by _store_messages() so that
+        #filtered reads do not require a scan of all messages.
+        self.message_indexes = {}
+
+        #Unique identifier for this chat instance's sequence
+        #numbers. Sequence numbers are only comparable to
+        #other sequence numbers with the same epoch.
+        self.epoch = uuid.uuid4().hex
+
+        #Monotonically increasing sequence number which is
+        #incremented upon each change to the chat's
+        #replicated state or messages.
+        self.sequence = 0
+
+        #dict of {state field: sequence} of the last change
+        #to each replicated ChatState field.
+        self.state_sequences = {}
+
+        #array of message sequence numbers, and list of 
+        #correlating MessageRecord objects, in the order in which
+        #the messages were stored. This allows for the
+        #lookup of messages stored after a given sequence.
+        self.message_sequences = array("l")
+        self.sequenced_messages = []
+
+        #dict of {service_key: sequence} of the last sequence
+        #acknowledged by each replica of this chat.
+        self.replica_sequences = {}
+
+        #epoch and sequence of the last replicated snapshot
+        #stored in this chat.
+        self.replicated_epoch = None
+        self.replicated_sequence = 0
+
+        #time at which this chat, as a replica, was last
+        #known to be in sync with the chat's primary.
+        self.replicated_timestamp = None
+
+        #(bucket_duration, sequence, digest) of the last
+        #digest computed, since digests are requested
+        #repeatedly for unchanged chats by anti-entropy.
+        self.digest_cache = None
         
         #Additional number of seconds beyond max_duration
         #which a chat is allowed to proceed before it's
         #considered expired and inaccessible.
         self.expiration_threshold = 360
     
-    def _store_message(self, message):
-        """Helper method to store message in session.
+    def _store_messages(self, messages):
+        """Helper method to store messages in session.
+
+        Duplicate messages will be ignored.
 
         Args:
-            message: Message object.
+            messages: list of Message objects.
+        Returns:
+            list of newly stored MessageRecord objects
+            ordered by timestamp.
         """
-        if message.header.id not in self.message_history:
-            index = bisect.bisect(self.message_timestamps, message.header.timestamp)
-            self.message_history[message.header.id] = message
-            self.message_timestamps.insert(index, message.header.timestamp)
-            self.state.messages.insert(index, message)
+        stored_messages = []
+        for message in messages:
+            if message.header.id not in self.message_history:
+                record = MessageRecord(message)
+                self.message_history[record.id] = record
+                self.message_bytes += len(record.data)
+                stored_messages.append(record)
+
+        if stored_messages:
+            self.sequence += 1
+            self.message_sequences.extend([self.sequence] * len(stored_messages))
+            self.sequenced_messages.extend(stored_messages)
+
+            stored_messages.sort(key=lambda m: m.timestamp)
+            self.message_log.merge(stored_messages)
+            for user_id, message_index in self.message_indexes.iteritems():
+                message_index.merge(self._filter_messages(stored_messages, user_id))
+
+        return stored_messages
     
+    def _is_routed(self, message, user_id=None):
+        """Helper method to check if a message is routed to a user.
+
+        Args:
+            message: MessageRecord object
+            user_id: optional user_id to check the message route for.
+        Returns:
+            True if the message should be delivered to the user,
+            False otherwise.
+        """
+        if message.route_type == MessageRouteType.NO_ROUTE:
+            return False
+        elif message.route_type == MessageRouteType.TARGETED_ROUTE:
+            if user_id and user_id not in message.recipients:
+                return False
+        return True
+
     def _filter_messages(self, messages, user_id=None):
         """Helper method to filter messages.
 
         Args:
-            messages: list of Message objects to filter
+            messages: list of MessageRecord objects to filter
             user_id: optional user_id to filter messages for.
         """
-        result = []
-        for message in messages or []:
-            if message.header.route.type == MessageRouteType.NO_ROUTE:
-                continue
-            elif message.header.route.type == MessageRouteType.TARGETED_ROUTE:
-                if user_id and user_id not in message.header.route.recpiients:
-                    continue
-            result.append(message)
-        return result
+        return [m for m in messages or [] if self._is_routed(m, user_id)]
+
+    def _message_index(self, user_id):
+        """Helper method to get the message index for a user.
+
+        The index will be built from the existing messages
+        on first request, and maintained by _store_messages()
+        from then on.
+
+        Args:
+            user_id: user_id to get the index for.
+        Returns:
+            MessageLog object.
+        """
+        message_index = self.message_indexes.get(user_id)
+        if message_index is None:
+            message_index = MessageLog()
+            message_index.merge(self._filter_messages(self.state.messages, user_id))
+            self.message_indexes[user_id] = message_index
+        return message_index
+
+    def _read_messages(self, asOf=None, user_id=None):
+        """Helper method to read messages.
+
+        Args:
+            asOf: optional timestamp boundary for which messages
+                should be returned.
+            user_id: optional user_id to filter messages for.
+        Returns:
+            list of MessageRecord objects.
+        """
+        if user_id is not None:
+            return self._message_index(user_id).since(asOf)
+        elif asOf is not None:
+            return self.message_log.since(asOf)
+        else:
+            return self.state.messages
+
+    def add_waiter(self, waiter):
+        """Register a message waiter.
+
+        Waiters registered with a shared event may be used
+        to wait for messages in multiple chats at once.
+
+        Args:
+            waiter: MessageWaiter object
+        """
+        if waiter.user_id not in self.message_waiters:
+            self.message_waiters[waiter.user_id] = set()
+        self.message_waiters[waiter.user_id].add(waiter)
+
+    def remove_waiter(self, waiter):
+        """Unregister a message waiter.
+
+        Args:
+            waiter: MessageWaiter object
+        """
+        waiters = self.message_waiters.get(waiter.user_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del self.message_waiters[waiter.user_id]
+
+    def _trigger_waiters(self, user_id, timestamp=None):
+        """Helper method to wake the waiters for the given user_id.
+
+        Args:
+            user_id: user_id for which to wake waiters, or
+                None to wake waiters which are not filtering
+                messages by user_id.
+            timestamp: optional timestamp of the latest message
+                routed to the user. If provided, only waiters
+                whose asOf cursor is satisfied by the timestamp
+                will be woken.
+        """
+        for waiter in list(self.message_waiters.get(user_id, [])):
+            if timestamp is None or waiter.is_satisfied(timestamp):
+                waiter.wake()
+
+    def _trigger_recipients(self, messages):
+        """Helper method to wake the recipients of messages.
+
+        Only waiters for which at least one of the messages
+        is routed, and whose asOf cursor is satisfied by the
+        timestamp of that message, will be woken. This matters
+        for replicated messages, which may be older than the
+        cursors of the waiters.
+
+        Args:
+            messages: list of MessageRecord objects ordered by timestamp.
+        """
+        if not messages:
+            return
+
+        #Subscriptions which are not filtering by user_id receive
+        #all messages, including NO_ROUTE, as in get_messages().
+        for subscription in self.subscriptions.values():
+            if subscription.user_id is None:
+                subscription.push(messages)
+            else:
+                subscription.push(self._filter_messages(messages, subscription.user_id))
+
+        #latest timestamp of broadcast messages, and
+        #dict of {user_id: latest timestamp} of targeted messages
+        broadcast_timestamp = None
+        targeted_timestamps = {}
+        for message in messages:
+            timestamp = message.timestamp
+            if message.route_type == MessageRouteType.BROADCAST_ROUTE:
+                broadcast_timestamp = timestamp
+            elif message.route_type == MessageRouteType.TARGETED_ROUTE:
+                for user_id in message.recipients:
+                    targeted_timestamps[user_id] = timestamp
+
+        #Waiters which are not filtering by user_id receive all messages.
+        self._trigger_waiters(None, messages[-1].timestamp)
+
+        if broadcast_timestamp is not None:
+            for user_id in self.message_waiters.keys():
+                if user_id is not None:
+                    timestamp = max(broadcast_timestamp,
+                            targeted_timestamps.get(user_id, broadcast_timestamp))
+                    self._trigger_waiters(user_id, timestamp)
+        else:
+            for user_id, timestamp in targeted_timestamps.iteritems():
+                if user_id is not None:
+                    self._trigger_waiters(user_id, timestamp)
     
     @property
     def loaded(self):
@@ -148,66 +690,178 @@ class Chat(object):
         """Load chat model from database.
 
         Raises:
+            KeyError if the chat does not exist.
             Exception (sqlalchemy)
         """
         if not self.loaded_event.is_set():
+            session = self.service_handler.get_database_session()
             try:
-                session = self.service_handler.get_database_session()
                 model = session.query(ChatModel)\
                         .filter_by(token=self.token)\
                         .one()
-                self.id = model.id
                 session.commit()
-                
-                self.state.maxDuration = model.max_duration
-                self.state.maxParticipants = model.max_participants
-
-                if model.end:
-                    self.state.status = ChatStatus.ENDED
-                    self.state.startTimestamp = tz.utc_to_timestamp(model.start)
-                    self.state.endTimesamp = tz.utc_to_timestamp(model.end)
-                elif model.start:
-                    self.state.status = ChatStatus.STARTED
-                    self.state.startTimestamp = tz.utc_to_timestamp(model.start)
-            
             except NoResultFound:
-                self.loaded_event.set()
-                self.loaded_event.clear()
+                session.rollback()
+                raise KeyError(self.token)
             except Exception as error:
                 logging.exception(error)
-                self.loaded_event.set()
-                self.loaded_event.clear()
+                session.rollback()
                 raise
-
             finally:
                 session.close()
-                   
-            self.loaded_event.set()
 
-    def save(self):
-        """Save chat to the database.
+            self.load_model(model)
 
-        Updates chat start / end times.
+    def load_model(self, model):
+        """Load chat from a chat model.
 
-        Raises:
-            Exception (sqlalchemy)
+        Args:
+            model: ChatModel object loaded from the database.
         """
-        try:
-            session = self.service_handler.get_database_session()
-            session.query(ChatModel) \
-                    .filter(ChatModel.id == self.id)\
-                    .update({
-                        "start": self.start,
-                        "end": self.end
-                    })
-            session.commit()
-        except Exception as error:
-            logging.exception(error)
-            session.rollback()
-            raise
-        finally:
-            session.close()
-    
+        self.id = model.id
+        self.state.maxDuration = model.max_duration
+        self.state.maxParticipants = model.max_participants
+
+        if model.end:
+            self.state.status = ChatStatus.ENDED
+            self.state.startTimestamp = tz.utc_to_timestamp(model.start)
+            self.state.endTimestamp = tz.utc_to_timestamp(model.end)
+        elif model.start:
+            self.state.status = ChatStatus.STARTED
+            self.state.startTimestamp = tz.utc_to_timestamp(model.start)
+
+        self.state_changed(
+                "status",
+                "maxDuration",
+                "maxParticipants",
+                "startTimestamp",
+                "endTimestamp")
+        self.loaded_event.set()
+
+    def state_changed(self, *fields):
+        """Record a change to replicated chat state.
+
+        This method must be invoked following changes to
+        replicated ChatState fields (Chat.STATE_FIELDS), so
+        that the changes will be included in delta replications.
+
+        Args:
+            fields: names of the changed ChatState fields
+        """
+        self.sequence += 1
+        for field in fields:
+            self.state_sequences[field] = self.sequence
+
+    def changes_since(self, sequence):
+        """Get the changes to the chat following sequence.
+
+        Args:
+            sequence: chat sequence number
+        Returns:
+            (fields, messages) tuple, where fields is a list of
+            the ChatState fields changed since sequence, and
+            messages is a list of the Message objects stored
+            since sequence.
+        """
+        fields = [field for field, field_sequence in self.state_sequences.iteritems()
+                if field_sequence > sequence]
+        index = bisect.bisect(self.message_sequences, sequence)
+        return fields, materialize(self.sequenced_messages[index:])
+
+    def acknowledge(self, service_key, sequence):
+        """Record the replication of the chat to a replica.
+
+        Args:
+            service_key: service key of the replica
+            sequence: sequence number of the chat snapshot
+                which the replica has stored.
+        """
+        if sequence > self.replica_sequences.get(service_key, -1):
+            self.replica_sequences[service_key] = sequence
+
+    def digest(self, bucket_duration):
+        """Get a digest of the chat's message ids.
+
+        Messages are grouped into buckets by timestamp, and
+        the digest of each bucket is the XOR of the hashes
+        of its message ids, so that it does not depend on the
+        order in which the messages were stored.
+
+        Args:
+            bucket_duration: bucket duration in seconds
+        Returns:
+            list of (bucket start, message count, digest)
+            tuples ordered by bucket start. Empty buckets
+            are not included.
+        """
+        if self.digest_cache is not None:
+            cached_duration, cached_sequence, digest = self.digest_cache
+            if cached_duration == bucket_duration and \
+               cached_sequence == self.sequence:
+                return digest
+
+        buckets = {}
+        for message in self.state.messages:
+            bucket = int(message.timestamp // bucket_duration)
+            message_hash = struct.unpack("<Q", hashlib.md5(message.id).digest()[:8])[0]
+            count, value = buckets.get(bucket, (0, 0))
+            buckets[bucket] = (count + 1, value ^ message_hash)
+
+        digest = [(bucket * bucket_duration, count, "%016x" % value)
+                for bucket, (count, value) in sorted(buckets.iteritems())]
+        self.digest_cache = (bucket_duration, self.sequence, digest)
+        return digest
+
+    def bucket_messages(self, bucket_duration, bucket_starts):
+        """Get the chat's messages in the given digest buckets.
+
+        Args:
+            bucket_duration: bucket duration in seconds
+            bucket_starts: list of bucket start timestamps,
+                as returned in digest().
+        Returns:
+            list of MessageRecord objects.
+        """
+        buckets = set(int(round(start / bucket_duration)) for start in bucket_starts)
+        return [message for message in self.state.messages
+                if int(message.timestamp // bucket_duration) in buckets]
+
+    def store_snapshot(self, snapshot):
+        """Store a replicated chat snapshot.
+
+        Snapshot messages are always stored. Snapshot state
+        will not be stored if the snapshot is older than the
+        last snapshot stored from the same epoch, or if the
+        snapshot is a delta which does not follow from the
+        last snapshot stored (replication gap).
+
+        Args:
+            snapshot: ChatSnapshot object
+        Returns:
+            False if the snapshot is a delta which could not
+            be applied due to a replication gap, True otherwise.
+        """
+        state = snapshot.state
+        self.store_replicated_messages(state.messages or [])
+        self.replicated_timestamp = time.time()
+
+        if snapshot.sequence is not None:
+            same_epoch = snapshot.epoch == self.replicated_epoch
+            if snapshot.baseSequence is not None:
+                if not same_epoch or \
+                   snapshot.baseSequence > self.replicated_sequence:
+                    return False
+            if same_epoch and snapshot.sequence <= self.replicated_sequence:
+                return True
+            self.replicated_epoch = snapshot.epoch
+            self.replicated_sequence = snapshot.sequence
+
+        for field in self.STATE_FIELDS:
+            value = getattr(state, field)
+            if value is not None:
+                setattr(self.state, field, value)
+        return True
+
     def wait_load(self, timeout=None):
         """Wait for chat model load to complete.
 
@@ -219,15 +873,75 @@ class Chat(object):
         self.loaded_event.wait(timeout)
         return self.loaded_event.is_set()
 
+    def estimated_size(self):
+        """Estimate the chat's memory usage.
+
+        Returns:
+            approximate size in bytes.
+        """
+        size = self.BASE_SIZE + \
+                len(self.state.messages) * self.MESSAGE_SIZE + \
+                self.message_bytes + \
+                len(self.state.users) * self.USER_SIZE
+        for key, value in self.state.session.iteritems():
+            size += len(key) + len(value)
+        return size
+
     def trigger_messages(self):
-        """Trigger messages event.
+        """Wake all message waiters.
 
         This is useful in the event that a service is shutting down,
         and following the removal of its nodes from the hashring,
         wants to respond to all active long polling requests.
         """
-        self.message_event.set()
-        self.message_event.clear()
+        for waiters in self.message_waiters.values():
+            for waiter in list(waiters):
+                waiter.wake()
+        for subscription in self.subscriptions.values():
+            subscription.event.set()
+
+    def subscribe(self, asOf=None, user_id=None, max_queue_size=1000):
+        """Subscribe to the chat's messages.
+
+        Messages since asOf are pushed to the subscription
+        immediately, so that no messages are missed
+        between the cursor and the subscription.
+
+        Args:
+            asOf: optional timestamp cursor after which messages
+                should be delivered.
+            user_id: optional user_id for which to filter messages.
+            max_queue_size: maximum number of undelivered
+                messages before the subscription overflows.
+        Returns:
+            MessageSubscription object
+        """
+        subscription = MessageSubscription(user_id, asOf, max_queue_size)
+        subscription.push(self._read_messages(asOf, user_id))
+        self.subscriptions[subscription.id] = subscription
+        return subscription
+
+    def unsubscribe(self, subscription_id):
+        """Remove a subscription.
+
+        Waiting polls will be woken.
+
+        Args:
+            subscription_id: subscription id
+        """
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is not None:
+            subscription.event.set()
+
+    def expire_subscriptions(self, ttl):
+        """Remove subscriptions which have overflowed or expired.
+
+        Args:
+            ttl: subscription time to live in seconds
+        """
+        for subscription in self.subscriptions.values():
+            if subscription.overflowed or subscription.is_expired(ttl):
+                self.unsubscribe(subscription.id)
 
     def get_messages(self, asOf=None, block=False, timeout=None, user_id=None):
         """Get messages from chat_session.
@@ -246,40 +960,51 @@ class Chat(object):
         Returns:
             list of Message objects
         """
-        #TODO improve performance
-        #The below is not optimal since a single messages event is used for all waiters.
-        #This means that if a message arrivals for a single user, all users in this
-        #session will be awoken, and messages will be returned. For users not
-        #receiving the messages an empty list will be returned. At some point, the
-        #single event should be replaced with a seperate event for each user_id
-        #and one event for waiters will no user_id.
-        #This change will also require changing to trigger_messages().
-
-        messages = []
-        if asOf is not None:
-            index = bisect.bisect(self.message_timestamps, asOf)
-            messages = self.state.messages[index:]
-            if user_id is not None:
-                messages = self._filter_messages(messages, user_id)
-            if not messages and block:
-                self.message_event.wait(timeout)
-                index = bisect.bisect(self.message_timestamps, asOf)
-                messages = self.state.messages[index:]
-                if user_id is not None:
-                    messages = self._filter_messages(messages, user_id)
-        else:
-            messages = self.self.state.messages
-            if user_id is not None:
-                messages = self._filter_messages(messages, user_id)
+        return materialize(self.get_message_records(asOf, block, timeout, user_id))
+
+    def get_message_records(self, asOf=None, block=False, timeout=None, user_id=None):
+        """Get message records from chat_session.
+
+        This is equivalent to get_messages() except that
+        stored MessageRecord objects are returned, which
+        can be written to a binary protocol without
+        re-encoding the messages.
+        
+        Args:
+            asOf: timestamp boundary for which messages should
+                be returned. If a message's timestamp is greater
+                than asOf it will be included in the result.
+            block: optional flag indicating that the method
+                should block and wait for new messages if
+                no messages are currently available.
+            timeout: optional timeout in seconds for blocking requests.
+            user_id: optional user_id for which to filter messages.
+                If this is None, messages will not be filtered
+                and include ALL messages.
+        Returns:
+            list of MessageRecord objects
+        """
+        messages = self._read_messages(asOf, user_id)
+        if asOf is not None and not messages and block:
+            #Waiters are registered by user_id so that
+            #send_messages() only wakes the users that
+            #new messages are routed to.
+            waiter = MessageWaiter(user_id, asOf)
+            self.add_waiter(waiter)
+            try:
+                waiter.wait(timeout)
+            finally:
+                self.remove_waiter(waiter)
+            messages = self._read_messages(asOf, user_id)
         
         return messages
 
     def send_messages(self, messages):
         """Send new messages to the chat.
         
-        Adds new messages to the chat and
-        triggers the messages event to notify
-        waiters in get_messages().
+        Adds new messages to the chat and wakes
+        the waiters in get_messages() for which
+        the new messages are routed.
         Args:
             messages: list of Message objects.
         """
@@ -292,40 +1017,107 @@ class Chat(object):
                 #message were processed we could get out of
                 #order messages.
                 message.header.timestamp = tz.timestamp()
-                self._store_message(message)
-        self.trigger_messages()
+        stored_messages = self._store_messages(messages)
+        self._trigger_recipients(stored_messages)
 
     def store_replicated_messages(self, messages):
         """Store replicate message in chat.
         
         This is equivalent to send_message() except
-        the messages event will not be triggered.
+        message timestamps will not be set. Replicated
+        messages are sorted and merged into the chat
+        in a single pass, and the waiters for which
+        the new messages are routed will be woken,
+        which allows replicas to serve long polls.
 
         Args:
             messages: list of Message object.
         """
-        for message in messages:
-            if message.header.id not in self.message_history:
-                self._store_message(message)
+        stored_messages = self._store_messages(messages)
+        self._trigger_recipients(stored_messages)
+
+    def is_stale(self, max_staleness):
+        """Check if this replica may be out of sync with the primary.
+
+        Args:
+            max_staleness: maximum number of seconds since the
+                replica was last known to be in sync.
+        Returns:
+            True if the replica has not been in sync with
+            the primary within max_staleness seconds.
+        """
+        return self.replicated_timestamp is None or \
+                time.time() - self.replicated_timestamp > max_staleness
 
 
 class ChatManager(object):
     """Chat anager.
 
     Convenience manager for accessing, loading, and removing chats.
+
+    Chats are loaded from the database on first access. Loads
+    are single-flight, so concurrent requests for a chat which
+    is loading share its AsyncResult, and are batched, so that
+    chats requested together are loaded with a single query.
+    Unknown chat tokens are cached for unknown_ttl seconds.
+
+    If max_bytes is provided, evict() removes chats, least
+    recently used first, until their estimated size is within
+    the budget. Persisted chats, and completed chats for which
+    this service is not the primary, are evicted first, followed
+    by other chats for which this service is not the primary.
+    Unpersisted chats for which this service is the primary
+    are never evicted.
     """
 
-    def __init__(self, service_handler):
+    def __init__(
+            self,
+            service_handler,
+            unknown_ttl=30,
+            load_batch_size=100,
+            max_bytes=None,
+            is_primary=None):
         """ChatManager constructor.
         
         Args:
             service_handler: ChatServiceHandler object.
+            unknown_ttl: number of seconds to cache the
+                absence of unknown chat tokens.
+            load_batch_size: maximum number of chats
+                to load in a single query.
+            max_bytes: optional memory budget, in bytes,
+                for the estimated size of all chats.
+            is_primary: optional method to be invoked with a
+                chat token, returning True if this service is
+                the chat's primary. If not provided, all chats
+                are treated as primary.
         """
         self.service_handler = service_handler
+        self.unknown_ttl = unknown_ttl
+        self.load_batch_size = load_batch_size
+        self.max_bytes = max_bytes
+        self.is_primary = is_primary
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
 
         #dict of {chat_token: Chat object}
         self._chats = {}
 
+        #dict of {chat_token: AsyncResult} for chats being loaded
+        self._loading = {}
+
+        #list of chat tokens waiting to be loaded
+        self._load_queue = []
+
+        #loader greenlet, if a load is in progress
+        self._loader = None
+
+        #dict of {chat_token: expiration timestamp} of
+        #chat tokens which do not exist.
+        self._unknown = {}
+        self._unknown_purged = time.time()
+
+        self.observers = []
+
     def all(self):
         """Get dict of all chats.
 
@@ -333,6 +1125,40 @@ class ChatManager(object):
             dict of {chat_token: Chat object}
         """
         return self._chats
+
+    def add_observer(self, observer):
+        """Add chat manager observer.
+
+        Add a method which will be invoked with the ChatManager
+        and Chat object, each time a chat is loaded.
+
+        Args:
+            observer: method to be invoked with ChatManager
+                and Chat objects.
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Remove chat manager observer.
+
+        Args:
+            observer: method to be invoked with ChatManager
+                and Chat objects.
+        """
+        self.observers.remove(observer)
+
+    def _notify_observers(self, chat):
+        """Notify observers of loaded chat.
+
+        Args:
+            chat: Chat object
+        """
+        for observer in self.observers:
+            try:
+                observer(self, chat)
+            except Exception as error:
+                self.log.error("chat manager observer exception.")
+                self.log.exception(error)
     
     def get(self, chat_token):
         """Get chat for the given chat token.
@@ -342,21 +1168,183 @@ class ChatManager(object):
 
         Returns:
             loaded Chat object.
+        Raises:
+            KeyError if the chat does not exist.
+            ChatLoadException if the chat could not be loaded.
         """
-        if chat_token not in self._chats:
-            chat = Chat(self.service_handler, chat_token)
-            self._chats[chat_token] = chat
-            try:
-                chat.load()
-            except:
-                self.remove(chat_token)
+        chat = self._chats.get(chat_token)
+        if chat is not None:
+            chat.last_accessed = time.time()
+            return chat
+
+        expiration = self._unknown.get(chat_token)
+        if expiration is not None:
+            if expiration > time.time():
                 raise KeyError(chat_token)
+            del self._unknown[chat_token]
+
+        result = self._loading.get(chat_token)
+        if result is None:
+            result = AsyncResult()
+            self._loading[chat_token] = result
+            self._load_queue.append(chat_token)
+            if self._loader is None:
+                self._loader = gevent.spawn(self._run_loader)
 
-        chat = self._chats[chat_token]
-        if not chat.loaded:
-            chat.wait_load()
+        return result.get()
 
-        return chat
+    def _run_loader(self):
+        """Load queued chats in batches.
+
+        The loader yields before its first query, so that
+        all of the chats requested in the current iteration
+        of the event loop are loaded together.
+        """
+        try:
+            gevent.sleep(0)
+            while self._load_queue:
+                chat_tokens = self._load_queue[:self.load_batch_size]
+                del self._load_queue[:self.load_batch_size]
+                self._load_batch(chat_tokens)
+        finally:
+            self._loader = None
+
+    def _load_batch(self, chat_tokens):
+        """Load chats with a single query.
+
+        The result of every chat token is always resolved,
+        so that callers are never left waiting. Database
+        errors are reported with ChatLoadException, rather
+        than KeyError, and are not cached as unknown chats.
+
+        Args:
+            chat_tokens: list of chat tokens to load.
+        """
+        models = {}
+        error = None
+        try:
+            session = self.service_handler.get_database_session()
+            try:
+                for model in session.query(ChatModel)\
+                        .filter(ChatModel.token.in_(chat_tokens)):
+                    models[model.token] = model
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+        except Exception as e:
+            self.log.exception(e)
+            error = e
+
+        now = time.time()
+        for chat_token in chat_tokens:
+            result = self._loading.pop(chat_token, None)
+            if result is None:
+                continue
+
+            try:
+                model = models.get(chat_token)
+                if error is not None:
+                    result.set_exception(ChatLoadException(
+                        "unable to load chat %s: %s" % (chat_token, error)))
+                elif model is None:
+                    self._unknown[chat_token] = now + self.unknown_ttl
+                    result.set_exception(KeyError(chat_token))
+                else:
+                    chat = self._chats.get(chat_token)
+                    if chat is None:
+                        chat = Chat(self.service_handler, chat_token)
+                        chat.load_model(model)
+                        self._chats[chat_token] = chat
+                        self._notify_observers(chat)
+                    result.set(chat)
+            except Exception as e:
+                self.log.exception(e)
+                result.set_exception(ChatLoadException(
+                    "unable to load chat %s: %s" % (chat_token, e)))
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Loaded %s of %s chat(s)" % (len(models), len(chat_tokens)))
+
+        self._purge_unknown(now)
+
+    def preload(self, models):
+        """Add chats loaded in bulk by the caller.
+
+        Chats which are already present are left as is.
+
+        Args:
+            models: list of ChatModel objects
+        Returns:
+            number of chats added.
+        """
+        added = 0
+        for model in models:
+            if model.token not in self._chats:
+                chat = Chat(self.service_handler, model.token)
+                chat.load_model(model)
+                self._chats[model.token] = chat
+                self._unknown.pop(model.token, None)
+                self._notify_observers(chat)
+                added += 1
+        return added
+
+    def evict(self):
+        """Evict chats until within the memory budget.
+
+        Returns:
+            number of chats evicted.
+        """
+        if not self.max_bytes:
+            return 0
+
+        sizes = dict((chat_token, chat.estimated_size())
+                for chat_token, chat in self._chats.iteritems())
+        total = sum(sizes.itervalues())
+        if total <= self.max_bytes:
+            return 0
+
+        candidates = []
+        for chat_token, chat in self._chats.iteritems():
+            primary = self.is_primary is None or self.is_primary(chat_token)
+            if chat.state.persisted or (chat.completed and not primary):
+                rank = 0
+            elif not primary:
+                rank = 1
+            else:
+                continue
+            candidates.append((rank, chat.last_accessed, chat_token))
+        candidates.sort()
+
+        evicted = 0
+        for rank, last_accessed, chat_token in candidates:
+            if total <= self.max_bytes:
+                break
+            chat = self._chats.pop(chat_token)
+            chat.trigger_messages()
+            total -= sizes[chat_token]
+            evicted += 1
+
+        self.log.info("Evicted %s chat(s) (estimated_size=%s, max_bytes=%s)" % (
+            evicted, total, self.max_bytes))
+        if total > self.max_bytes:
+            self.log.warning("Chats exceed memory budget (estimated_size=%s, max_bytes=%s)" % (
+                total, self.max_bytes))
+        return evicted
+
+    def _purge_unknown(self, now):
+        """Remove expired unknown chat tokens.
+
+        Args:
+            now: current timestamp
+        """
+        if now - self._unknown_purged > self.unknown_ttl:
+            self._unknown_purged = now
+            for chat_token, expiration in self._unknown.items():
+                if expiration <= now:
+                    del self._unknown[chat_token]
 
     def remove(self, chat_token):
         """Remove chat for the given chat token."""
@@ -364,12 +1352,12 @@ class ChatManager(object):
             del self._chats[chat_token]
     
     def trigger_messages(self, chat_token=None):
-        """Trigger chat messages event.
+        """Wake chat message waiters.
 
         Args:
             chat_token: optional chat token
-                for which to trigger the messages event.
-                If None, messages event will be triggered
+                for which to wake all message waiters.
+                If None, message waiters will be woken
                 for all chats.
         """
         if chat_token:
@@ -18,9 +18,9 @@ from trpycore.process.pid import pidfile, PidFileException
 from trsvcscore.service_gevent.default import GDefaultService
 from trsvcscore.service_gevent.server.default import GThriftServer
 from trsvcscore.service_gevent.server.mongrel2 import GMongrel2Server
-from trchatsvc.gen import TChatService
 
 from handler import ChatServiceHandler, ChatMongrel2Handler
+from processor import ChatServiceProcessor
 
 
 class ChatService(GDefaultService):
@@ -33,7 +33,11 @@ class ChatService(GDefaultService):
                 interface=settings.THRIFT_SERVER_INTERFACE,
                 port=settings.THRIFT_SERVER_PORT,
                 handler=handler,
-                processor=TChatService.Processor(handler),
+                processor=ChatServiceProcessor(
+                    handler,
+                    protocol=settings.THRIFT_SERVER_PROTOCOL,
+                    allow_compact=settings.THRIFT_SERVER_ALLOW_COMPACT,
+                    allow_framed=settings.THRIFT_SERVER_ALLOW_FRAMED),
                 address=settings.THRIFT_SERVER_ADDRESS)
 
         mongrel2_handler = ChatMongrel2Handler(handler)
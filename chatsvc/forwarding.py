@@ -0,0 +1,236 @@
+import logging
+import socket
+import time
+from contextlib import contextmanager
+
+import gevent
+from thrift.transport.TTransport import TTransportException
+
+from trsvcscore.hashring.base import ServiceHashringEvent
+from trchatsvc.gen import TChatService
+from trchatsvc.gen.ttypes import UnavailableException
+
+from protocol import PoolExhaustedException, ServiceProxyPool
+
+class ForwardingProxyPools(object):
+    """Forwarding service proxy pools.
+
+    Manages a pool of reusable service proxies for each remote
+    hashring node, so that forwarding a request to the node
+    responsible for a chat does not require a new connection.
+
+    Pools are evicted when their node is removed from the
+    hashring, when a forwarded request fails due to a
+    connection error (failed health check), and when a pool
+    has been idle for longer than idle_timeout.
+
+    Blocking requests, i.e. long polls, which may hold a
+    connection for their entire timeout, use a separate pool
+    for each node, so that they cannot exhaust the connections
+    needed to forward other requests. Requests fail with an
+    UnavailableException, rather than waiting, if their
+    pool has no connections available.
+    """
+
+    def __init__(
+            self,
+            hashring,
+            max_connections_per_service,
+            max_blocking_connections_per_service=100,
+            acquire_timeout=5,
+            idle_timeout=None,
+            reap_interval=60,
+            transport=None,
+            protocol=None):
+        """ForwardingProxyPools constructor.
+
+        Args:
+            hashring: ServiceHashring object
+            max_connections_per_service: maximum number of forwarding
+                connections for each service. This limits the number
+                of concurrent forwarded non-blocking requests, per service.
+            max_blocking_connections_per_service: maximum number of
+                forwarding connections for blocking requests, i.e.
+                long polls, for each service.
+            acquire_timeout: number of seconds to wait for a pooled
+                connection before failing the request. This should
+                be less than the long poll wait, so that a forwarded
+                long poll which could not be started still returns
+                within the client's wait.
+            idle_timeout: optional number of seconds a pool may be
+                unused before it is evicted. If None, idle pools
+                will not be evicted.
+            reap_interval: number of seconds between checks
+                for idle pools.
+            transport: optional transport name, 'buffered' or
+                'framed', to use for forwarded requests.
+            protocol: optional protocol name, 'binary',
+                'accelerated', or 'compact', to use for
+                forwarded requests.
+        """
+        self.hashring = hashring
+        self.max_connections_per_service = max_connections_per_service
+        self.max_blocking_connections_per_service = max_blocking_connections_per_service
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.transport = transport
+        self.protocol = protocol
+
+        #dict of {service_key: ServiceProxyPool}
+        self.pools = {}
+
+        #dict of {service_key: ServiceProxyPool} for blocking requests
+        self.blocking_pools = {}
+
+        #dict of {service_key: timestamp} of last pool use
+        self.last_used = {}
+
+        self.running = False
+        self.greenlet = None
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        #add hashring observer
+        self.hashring.add_observer(self._hashring_observer)
+
+    def _hashring_observer(self, hashring, event):
+        """Observer method which will be invoked upon hashring changes.
+
+        Evicts the pools for services which are no longer
+        in the hashring.
+
+        Args:
+            hashring: ServiceHashring object
+            event: ServiceHashringEvent object
+        """
+        if event.event_type == ServiceHashringEvent.CHANGED_EVENT:
+            service_keys = set(n.service_info.key for n in event.current_hashring)
+            for service_key in self.last_used.keys():
+                if service_key not in service_keys:
+                    self.evict(service_key)
+
+    def _pool(self, node, blocking=False):
+        """Get service proxy pool for the given hashring node.
+
+        Args:
+            node: ServiceHashringNode object
+            blocking: boolean indicating if the pool for
+                blocking requests should be returned.
+        Returns:
+            ServiceProxyPool object to be used to connect
+                to the specified node.
+        """
+        service_key = node.service_info.key
+        if blocking:
+            pools = self.blocking_pools
+            max_connections = self.max_blocking_connections_per_service
+        else:
+            pools = self.pools
+            max_connections = self.max_connections_per_service
+
+        if service_key not in pools:
+            endpoint = node.service_info.default_endpoint()
+            pools[service_key] = ServiceProxyPool(
+                    endpoint.address,
+                    endpoint.port,
+                    max_connections,
+                    TChatService,
+                    transport=self.transport or "buffered",
+                    protocol=self.protocol or "binary")
+        self.last_used[service_key] = time.time()
+        return pools[service_key]
+
+    @contextmanager
+    def get(self, node, blocking=False):
+        """Get a service proxy to the given node.
+
+        This method should be used as a context manager, which
+        will return the proxy to its pool upon exit. If the
+        forwarded request fails due to a connection error,
+        the node's pools will be evicted so that subsequent
+        requests establish new connections.
+
+        Args:
+            node: ServiceHashringNode object
+            blocking: boolean indicating if the request may
+                block, i.e. a long poll.
+        Returns:
+            service proxy context manager.
+        Raises:
+            UnavailableException if no connection to the
+            node is available.
+        """
+        pool = self._pool(node, blocking)
+        try:
+            with pool.get(self.acquire_timeout) as proxy:
+                yield proxy
+        except PoolExhaustedException as error:
+            self.log.warning("forwarding to %s failed: %s" % (node, error))
+            raise UnavailableException(str(error))
+        except (TTransportException, socket.error) as error:
+            self.log.warning("forwarding to %s failed: %s" % (node, error))
+            self.evict(node.service_info.key)
+            raise
+
+    def evict(self, service_key):
+        """Evict the pools for the given service.
+
+        The pools' idle connections are closed. Connections
+        in use are closed once their request completes.
+
+        Args:
+            service_key: service key
+        """
+        pools = [
+            self.pools.pop(service_key, None),
+            self.blocking_pools.pop(service_key, None)
+        ]
+        self.last_used.pop(service_key, None)
+
+        for pool in pools:
+            if pool is not None:
+                self.log.info("evicting forwarding pool for %s" % service_key)
+                pool.close()
+
+    def reap(self):
+        """Evict pools which have been idle longer than idle_timeout."""
+        if self.idle_timeout is not None:
+            now = time.time()
+            for service_key, last_used in self.last_used.items():
+                if now - last_used > self.idle_timeout:
+                    self.evict(service_key)
+
+    def start(self):
+        """Start idle pool reaper."""
+        if not self.running:
+            self.running = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        """Run idle pool reaper."""
+        while self.running:
+            try:
+                gevent.sleep(self.reap_interval)
+                self.reap()
+            except gevent.GreenletExit:
+                break
+            except Exception as error:
+                self.log.exception(error)
+
+        self.running = False
+
+    def stop(self):
+        """Stop idle pool reaper."""
+        if self.running:
+            self.running = False
+            self.greenlet.kill()
+
+    def join(self, timeout=None):
+        """Join idle pool reaper.
+
+        Args:
+            timeout: optional maximum number of seconds to wait
+                for the reaper to complete.
+        """
+        if self.greenlet:
+            self.greenlet.join(timeout)
@@ -1,6 +1,10 @@
+import heapq
 import logging
 
 import gevent
+import gevent.event
+
+from trpycore.timezone import tz
 
 class GarbageCollectionEvent(object):
     ZOMBIE_CHAT_EVENT = "ZOMBIE_CHAT_EVENT"
@@ -17,17 +21,126 @@ class GarbageCollector(object):
             hashring,
             chat_manager,
             interval,
-            throttle):
+            throttle,
+            eviction_interval=10,
+            completed_grace_period=60,
+            subscription_ttl=None):
         self.service = service
         self.hashring = hashring
         self.chat_manager = chat_manager
         self.interval = interval
         self.throttle = throttle
+        self.eviction_interval = eviction_interval
+        self.completed_grace_period = completed_grace_period
+        self.subscription_ttl = subscription_ttl
+        self.next_eviction = 0
         self.observers = []
         self.running = False
         self.greenlet = None
         self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        #min-heap of (due timestamp, chat_token). Entries whose
+        #due timestamp no longer matches self.scheduled are stale
+        #and skipped when popped.
+        self.heap = []
+
+        #dict of {chat_token: due timestamp}
+        self.scheduled = {}
+
+        #event which is set when a chat is scheduled
+        #ahead of the current head of the heap.
+        self.wakeup_event = gevent.event.Event()
+
+        #schedule chats as they're loaded
+        self.chat_manager.add_observer(self._chat_manager_observer)
+
+    def _chat_manager_observer(self, chat_manager, chat):
+        self.schedule(chat)
+
+    def _due(self, chat):
+        """Get the timestamp at which chat should be collected.
+
+        Completed chats are due completed_grace_period seconds
+        after completion, so that clients polling at completion
+        receive the chat's final messages. Started chats with
+        a max duration are due at expiration.
+
+        Returns:
+            due timestamp, or None if chat will not be due
+            until its state changes.
+        """
+        if chat.completed:
+            return chat.state.endTimestamp + self.completed_grace_period
+        elif chat.started and chat.state.maxDuration:
+            return chat.state.startTimestamp + \
+                    chat.state.maxDuration + \
+                    chat.expiration_threshold
+        return None
+
+    def schedule(self, chat, delay=None):
+        """Schedule chat for garbage collection.
+
+        This should be invoked whenever a chat starts, ends,
+        or is persisted. Rescheduling a chat replaces its
+        previous due timestamp.
+
+        Args:
+            chat: Chat object
+            delay: optional minimum number of seconds
+                from now before the chat is due.
+        """
+        due = self._due(chat)
+        if due is None:
+            return
+        if delay is not None:
+            due = max(due, tz.timestamp() + delay)
+
+        if self.scheduled.get(chat.token) != due:
+            self.scheduled[chat.token] = due
+            heapq.heappush(self.heap, (due, chat.token))
+            if self.heap[0][1] == chat.token:
+                self.wakeup_event.set()
+
+    def _collect_due(self):
+        """Collect all chats which are due.
+
+        Chats which could not be collected, i.e. zombie chats
+        waiting to be persisted, are rescheduled in interval
+        seconds.
+        """
+        chats = self.chat_manager.all()
+        now = tz.timestamp()
+        while self.heap and self.heap[0][0] <= now:
+            due, chat_token = heapq.heappop(self.heap)
+            if self.scheduled.get(chat_token) != due:
+                continue
+            del self.scheduled[chat_token]
+
+            chat = chats.get(chat_token)
+            if chat is None:
+                continue
+
+            if chat.completed or chat.expired:
+                self._gc_chat(chat)
+            if chat_token in chats:
+                self.schedule(chat, self.interval)
+
+            if self.throttle:
+                gevent.sleep(self.throttle)
   
+    def _expire_subscriptions(self):
+        """Remove overflowed and expired subscriptions.
+
+        Subscriptions are otherwise only expired when a new
+        subscription is added to their chat.
+        """
+        if self.subscription_ttl is None:
+            return
+
+        for chat in self.chat_manager.all().values():
+            if chat.subscriptions:
+                chat.expire_subscriptions(self.subscription_ttl)
+
     def _notify_observers(self, event):
         for observer in self.observers:
             try:
@@ -66,18 +179,25 @@ class GarbageCollector(object):
     def run(self):
         while self.running:
             try:
-                #note that itervalues should not be used in place of values,
-                #since we will be modifying the underlying dict
-                for chat in self.chat_manager.all().values():
-                    if chat.completed or chat.expired:
-                        self._gc_chat(chat)
-                    if self.throttle:
-                        gevent.sleep(self.throttle)
+                self.wakeup_event.clear()
+                self._collect_due()
+
+                now = tz.timestamp()
+                if now >= self.next_eviction:
+                    self._expire_subscriptions()
+                    self.chat_manager.evict()
+                    self.next_eviction = now + self.eviction_interval
+
+                #wait until the next chat is due, the next eviction
+                #or a chat is scheduled ahead of the next due chat.
+                timeout = min(self.interval, max(0, self.next_eviction - now))
+                if self.heap:
+                    timeout = min(timeout, max(0, self.heap[0][0] - tz.timestamp()))
+                self.wakeup_event.wait(timeout)
             except gevent.GreenletExit:
                 break
             except Exception as error:                
                 self.log.exception(error)
-            finally:
                 gevent.sleep(self.interval)
         
         self.running = False
@@ -1,27 +1,37 @@
 import logging
+import time
 
+import gevent
+import gevent.event
 import gevent.queue
 
 from tridlcore.gen.ttypes import RequestContext
 from trpycore.greenlet.util import join
 from trpycore.zookeeper_gevent.util import expire_zookeeper_client_session
-from trsvcscore.proxy.basic import BasicServiceProxy
 from trsvcscore.service_gevent.handler.service import GServiceHandler
 from trsvcscore.service_gevent.handler.mongrel2 import GMongrel2Handler
 from trsvcscore.hashring.zoo import ZookeeperServiceHashring
 from trchatsvc.gen import TChatService
 from trchatsvc.gen.ttypes import HashringNode, UnavailableException, \
-        InvalidChatException, InvalidMessageException
+        InvalidChatException, InvalidMessageException, ReplicationGapException, \
+        InvalidSubscriptionException, \
+        ChatDigest, ChatDigestBucket, ChatMessages, SendMessageResult, \
+        SendMessageStatus
 
 import settings
-from chat import ChatManager
+from antientropy import AntiEntropy
+from chat import ChatManager, MessageWaiter, materialize
+from forwarding import ForwardingProxyPools
+from preference import PreferenceListCache
 from message_handlers.base import MessageHandlerException
 from message_handlers.manager import MessageHandlerManager
 from persistence import GreenletPoolPersister, PersistEvent
 from twilio_handlers.base import TwilioHandlerException
 from twilio_handlers.manager import TwilioHandlerManager
 from replication import ReplicationException, GreenletPoolReplicator
+from scheduler import ReplicationPriority
 from garbage import GarbageCollector, GarbageCollectionEvent
+from warmup import ChatWarmer
 
 class ChatServiceHandler(TChatService.Iface, GServiceHandler):
     """Chat service handler."""
@@ -40,7 +50,12 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
                 database_connection=settings.DATABASE_CONNECTION)
         
 
-        self.chat_manager =  ChatManager(self)
+        self.chat_manager =  ChatManager(
+                service_handler=self,
+                unknown_ttl=settings.CHAT_UNKNOWN_TTL,
+                load_batch_size=settings.CHAT_LOAD_BATCH_SIZE,
+                max_bytes=settings.CHAT_MEMORY_BUDGET,
+                is_primary=self._is_primary_chat)
         self.message_handler_manager = MessageHandlerManager(self)
         self.twilio_handler_manager = TwilioHandlerManager(self)
         self.deferred_init = False
@@ -51,9 +66,12 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
         self.service_info = None
         self.server_endpoint = None
         self.hashring = None
+        self.preference_lists = None
+        self.forwarding_pools = None
         self.replicator = None
         self.persister = None
         self.garbage_collector = None
+        self.chat_warmer = None
         
     def _deferred_init(self):
         """Deferred initialization.
@@ -72,6 +90,20 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
                     positions=[None, None, None],
                     position_data=None)
 
+            #shared preference list cache which must be created
+            #prior to other hashring observers, so that it is
+            #invalidated before they are notified of changes.
+            self.preference_lists = PreferenceListCache(self.hashring)
+
+            self.forwarding_pools = ForwardingProxyPools(
+                    hashring=self.hashring,
+                    max_connections_per_service=settings.FORWARDING_MAX_CONNECTIONS_PER_SERVICE,
+                    max_blocking_connections_per_service=settings.FORWARDING_MAX_BLOCKING_CONNECTIONS_PER_SERVICE,
+                    acquire_timeout=settings.FORWARDING_ACQUIRE_TIMEOUT,
+                    idle_timeout=settings.FORWARDING_IDLE_TIMEOUT,
+                    transport=settings.FORWARDING_TRANSPORT,
+                    protocol=settings.FORWARDING_PROTOCOL)
+
             self.replicator = GreenletPoolReplicator(
                     service=self.service,
                     hashring=self.hashring,
@@ -80,14 +112,45 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
                     N=settings.REPLICATION_N,
                     W=settings.REPLICATION_W,
                     max_connections_per_service=settings.REPLICATION_MAX_CONNECTIONS_PER_SERVICE,
-                    allow_same_host_replications=settings.REPLICATION_ALLOW_SAME_HOST)
+                    allow_same_host_replications=settings.REPLICATION_ALLOW_SAME_HOST,
+                    priority_weights={
+                        ReplicationPriority.INTERACTIVE: settings.REPLICATION_INTERACTIVE_WEIGHT,
+                        ReplicationPriority.REBALANCE: settings.REPLICATION_REBALANCE_WEIGHT,
+                        ReplicationPriority.BACKGROUND: settings.REPLICATION_BACKGROUND_WEIGHT
+                    },
+                    preference_lists=self.preference_lists,
+                    coalesce=settings.REPLICATION_COALESCE,
+                    coalesce_window=settings.REPLICATION_COALESCE_WINDOW,
+                    rebalance_size=settings.REBALANCE_POOL_SIZE,
+                    rebalance_chats_per_second=settings.REBALANCE_CHATS_PER_SECOND,
+                    rebalance_bytes_per_second=settings.REBALANCE_BYTES_PER_SECOND,
+                    rebalance_chunk_size=settings.REBALANCE_CHUNK_SIZE,
+                    handoff_max_hints=settings.HANDOFF_MAX_HINTS,
+                    handoff_spill_path=settings.HANDOFF_SPILL_PATH,
+                    handoff_probe_interval=settings.HANDOFF_PROBE_INTERVAL,
+                    handoff_batch_size=settings.HANDOFF_BATCH_SIZE,
+                    transport=settings.REPLICATION_TRANSPORT,
+                    protocol=settings.REPLICATION_PROTOCOL,
+                    send_timeout=settings.REPLICATION_SEND_TIMEOUT,
+                    drain_timeout=settings.REPLICATION_DRAIN_TIMEOUT)
+
+            self.anti_entropy = AntiEntropy(
+                    replicator=self.replicator,
+                    chat_manager=self.chat_manager,
+                    interval=settings.ANTI_ENTROPY_INTERVAL,
+                    bucket_duration=settings.ANTI_ENTROPY_BUCKET_DURATION)
 
             self.persister = GreenletPoolPersister(
                     service=self.service,
                     hashring=self.hashring,
                     chat_manager=self.chat_manager,
                     database_session_factory=self.get_database_session,
-                    size=4)
+                    size=settings.PERSISTER_POOL_SIZE,
+                    preference_lists=self.preference_lists,
+                    save_delay=settings.PERSISTER_SAVE_DELAY,
+                    save_batch_size=settings.PERSISTER_SAVE_BATCH_SIZE,
+                    save_retries=settings.PERSISTER_SAVE_RETRIES,
+                    save_retry_delay=settings.PERSISTER_SAVE_RETRY_DELAY)
             self.persister.add_observer(self._persist_observer)
             
             self.garbage_collector = GarbageCollector(
@@ -95,9 +158,22 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
                     hashring=self.hashring,
                     chat_manager=self.chat_manager,
                     interval=60,
-                    throttle=0.1)
+                    throttle=0.1,
+                    eviction_interval=settings.CHAT_EVICTION_INTERVAL,
+                    completed_grace_period=settings.CHAT_COMPLETED_GRACE_PERIOD,
+                    subscription_ttl=settings.CHAT_SUBSCRIPTION_TTL)
             self.garbage_collector.add_observer(self._gc_observer)
 
+            if settings.CHAT_WARMUP:
+                self.chat_warmer = ChatWarmer(
+                        service=self.service,
+                        hashring=self.hashring,
+                        chat_manager=self.chat_manager,
+                        database_session_factory=self.get_database_session,
+                        preference_lists=self.preference_lists,
+                        max_age=settings.CHAT_WARMUP_MAX_AGE,
+                        debounce=settings.CHAT_WARMUP_DEBOUNCE)
+
             self.deferred_init = True
 
 
@@ -119,25 +195,91 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             or None if no nodes are available.
         """
         result = None
-        preference_list = self.hashring.preference_list(chat_token)
+        preference_list = self.preference_lists.preference_list(chat_token)
         if preference_list:
             result = preference_list[0]
         return result
 
-    def _service_proxy(self, node):
-        """Get a service proxy to the given node.
+    def _is_primary_chat(self, chat_token):
+        """Check if this node is the primary for the chat_token.
+
+        Returns:
+            True if this node is the primary for the chat, or
+            the hashring is not yet available.
+        """
+        if not self.deferred_init:
+            return True
+        primary_node = self._primary_node(chat_token)
+        return primary_node is None or not self._is_remote_node(primary_node)
+
+    def _replica_chat(self, chat_token):
+        """Get the local replica of a chat to serve reads from.
+
+        Replica reads must be enabled, this node must be a
+        secondary in the chat's first N preference list nodes,
+        and the local replica must have been in sync with the
+        primary within CHAT_REPLICA_READS_MAX_STALENESS seconds.
+
+        Args:
+            chat_token: chat token
+        Returns:
+            Chat object, or None if reads should not be
+            served by this node's replica.
+        """
+        if not settings.CHAT_REPLICA_READS:
+            return None
+
+        preference_list = self.replicator.preference_list(chat_token)[:settings.REPLICATION_N]
+        if not any(not self._is_remote_node(n) for n in preference_list[1:]):
+            return None
+
+        chat = self.chat_manager.all().get(chat_token)
+        if chat is None or chat.is_stale(settings.CHAT_REPLICA_READS_MAX_STALENESS):
+            return None
+        return chat
+
+    def _poll_primary(self, requestContext, chat, asOf, primary_node):
+        """Forward poll side effects to the chat's primary.
+
+        Performs a non-blocking getMessages request on the
+        primary, so that the primary handles the poll
+        (user presence), and stores the returned messages
+        in the replica, which marks the replica as being
+        in sync with the primary.
+
+        Args:
+            requestContext: RequestContext object
+            chat: Chat object of the local replica
+            asOf: unix timestamp after which messages should
+                be returned.
+            primary_node: ServiceHashringNode of the primary
+        """
+        try:
+            with self._service_proxy(primary_node) as proxy:
+                messages = proxy.getMessages(requestContext, chat.token, asOf, False, 0)
+            chat.store_replicated_messages(messages)
+            chat.replicated_timestamp = time.time()
+        except Exception as error:
+            self.log.warning("replica poll of %s at %s failed: %s" % (
+                chat.token, primary_node, error))
+
+    def _service_proxy(self, node, blocking=False):
+        """Get a pooled service proxy to the given node.
+
+        This method should be used as a context manager,
+        which will return the proxy to its pool upon exit.
 
+        Args:
+            node: ServiceHashringNode object
+            blocking: boolean indicating if the forwarded
+                request may block, i.e. a long poll.
         Returns:
-            BasicServiceProxy object to the given node.
+            service proxy context manager for the given node.
+        Raises:
+            UnavailableException if no connection to the
+            node is available.
         """
-        endpoint = node.service_info.default_endpoint()
-        proxy = BasicServiceProxy(
-                service_name=node.service_info.name,
-                service_hostname=endpoint.address,
-                service_port=endpoint.port,
-                service_class=TChatService,
-                is_gevent=True)
-        return proxy
+        return self.forwarding_pools.get(node, blocking)
 
     def _convert_hashring_nodes(self, nodes):
         """Convert ServiceHashringNode's to HashringNode's.
@@ -170,7 +312,13 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
         if event.event_type == PersistEvent.CHAT_PERSISTED_EVENT:
             self.log.info("chat session (id=%s) successfully persisted" \
                     % event.chat.id)
-            self.replicator.replicate(event.chat, [])
+            self.replicator.replicate(event.chat, [],
+                    priority=ReplicationPriority.BACKGROUND)
+
+            #Persisted chats may now be garbage collected, once
+            #clients have had a chance to poll the final messages.
+            self.garbage_collector.schedule(event.chat,
+                    self.garbage_collector.completed_grace_period)
 
     def _gc_observer(self, event):
         """GarbageCollector observer method.
@@ -190,8 +338,17 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
         super(ChatServiceHandler, self).start()
         self.persister.start()
         self.replicator.start()
+        self.forwarding_pools.start()
         self.hashring.start()
+
+        #Preload the active chats we own once our hashring
+        #positions are known, so that first requests for
+        #them do not wait on a database load.
+        if self.chat_warmer:
+            self.chat_warmer.warm()
+
         self.garbage_collector.start()
+        self.anti_entropy.start()
     
     def stop(self):
         """Stop handler."""
@@ -199,9 +356,13 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
         #Wait for the hashring to be stopped before stopping our parent,
         #since this will stop the zookeeper client which is required
         #to stop the hashring.
+        self.anti_entropy.stop()
         self.garbage_collector.stop()
+        if self.chat_warmer:
+            self.chat_warmer.stop()
         self.hashring.stop()
         self.hashring.join()
+        self.forwarding_pools.stop()
         self.replicator.stop()
         self.persister.stop()
 
@@ -223,12 +384,62 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
                 to determine if the handler is still running.
         """
         greenlets = [
+                self.anti_entropy,
                 self.garbage_collector,
                 self.hashring,
+                self.forwarding_pools,
                 self.replicator,
                 super(ChatServiceHandler, self)
                 ]
         join(greenlets, timeout)
+
+    def _replication_counters(self):
+        """Get replication queue and rebalance counters.
+
+        Returns:
+            dict of {counter name: integer value}. Wait
+            times are in milliseconds.
+        """
+        counters = {}
+        stats = self.replicator.stats()
+        for priority, queue_stats in stats["queue"].iteritems():
+            for name, value in queue_stats.iteritems():
+                if name.endswith("_wait"):
+                    name, value = name + "_ms", value * 1000
+                counters["replication_%s_%s" % (priority, name)] = int(value)
+        for name, value in stats["rebalance"].iteritems():
+            counters["rebalance_%s" % name] = int(value)
+        return counters
+
+    def getCounter(self, requestContext, key):
+        """Return the value of the given service counter.
+
+        Args:
+            requestContext: RequestContext object
+            key: counter name
+        Returns:
+            counter value
+        """
+        counters = self._replication_counters()
+        if key in counters:
+            return counters[key]
+        return GServiceHandler.getCounter(self, requestContext, key)
+
+    def getCounters(self, requestContext):
+        """Return all service counters.
+
+        Includes the replication queue depth and wait
+        time of each priority class, and the progress
+        of the current rebalance.
+
+        Args:
+            requestContext: RequestContext object
+        Returns:
+            dict of {counter name: value}
+        """
+        counters = GServiceHandler.getCounters(self, requestContext)
+        counters.update(self._replication_counters())
+        return counters
     
     def getHashring(self, requestContext):
         """Return hashring as ordered list of HashringNode's.
@@ -266,7 +477,7 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             Ordered list of HashringNode's.
         """
         merge_nodes = not settings.REPLICATION_ALLOW_SAME_HOST
-        preference_list = self.hashring.preference_list(
+        preference_list = self.preference_lists.preference_list(
                 chatToken,
                 merge_nodes=merge_nodes)
         return self._convert_hashring_nodes(preference_list)
@@ -274,6 +485,11 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
     def getMessages(self, requestContext, chatToken, asOf, block, timeout):
         """Long poll for new chat messages.
 
+        If CHAT_REPLICA_READS is enabled, secondary nodes in
+        the chat's preference list will serve reads from their
+        replica of the chat, provided it is not stale, and
+        forward the poll to the primary in the background.
+
         Args:
             requestContext: RequestContext object.
             chatToken: chat token
@@ -283,7 +499,7 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             timeout: if block is True, how long to wait for
                 new messages before timing out.
         Returns:
-            list of Message objects.
+            list of Message or MessageRecord objects.
         Raises:
             UnavailableException if no nodes are available.
         """
@@ -292,8 +508,15 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             raise UnavailableException("no nodes available")
 
         if self._is_remote_node(primary_node):
-            proxy = self._service_proxy(primary_node)
-            return proxy.getMessages(requestContext, chatToken, asOf, block, timeout)
+            replica_chat = self._replica_chat(chatToken)
+            if replica_chat is None:
+                with self._service_proxy(primary_node, block) as proxy:
+                    return proxy.getMessages(requestContext, chatToken, asOf, block, timeout)
+
+            if replica_chat.expired:
+                raise InvalidChatException("invalid chat token: %s" % chatToken)
+            gevent.spawn(self._poll_primary, requestContext, replica_chat, asOf, primary_node)
+            return replica_chat.get_message_records(asOf, block, timeout, requestContext.userId)
         
         try:
             chat = self.chat_manager.get(chatToken)
@@ -310,8 +533,10 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
                 self.sendMessage(requestContext, message,
                         settings.REPLICATION_N, settings.REPLICATION_W)
             
-            #read messages
-            messages = chat.get_messages(asOf, block, timeout, requestContext.userId)
+            #read messages. Stored message records are returned,
+            #so that their encoded messages are written to the
+            #response as is (see processor.GetMessagesResult).
+            messages = chat.get_message_records(asOf, block, timeout, requestContext.userId)
             return messages
         except (KeyError, InvalidChatException):
             raise InvalidChatException("invalid chat token: %s" % chatToken)
@@ -319,6 +544,279 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             self.log.exception(error)
             raise UnavailableException(str(error))
 
+    def _forward_messages_multi(self, requestContext, node, cursors, block, timeout, results, errors, event):
+        """Forward a group of getMessagesMulti cursors to their primary.
+
+        Args:
+            requestContext: RequestContext object
+            node: ServiceHashringNode of the cursors' primary
+            cursors: list of ChatCursor objects
+            block: boolean indicating if the request should block
+            timeout: if block is True, how long to wait for
+                new messages before timing out.
+            results: list of ChatMessages objects to extend
+                with the forwarded request's results.
+            errors: list of (node, error) tuples to extend
+                if the forwarded request failed.
+            event: Event to set if the forwarded request
+                returned any results or failed.
+        """
+        try:
+            with self._service_proxy(node, block) as proxy:
+                chat_messages = proxy.getMessagesMulti(requestContext, cursors, block, timeout)
+            if chat_messages:
+                results.extend(chat_messages)
+                event.set()
+        except Exception as error:
+            self.log.warning("getMessagesMulti forwarding to %s failed: %s" % (node, error))
+            errors.append((node, error))
+            event.set()
+
+    def _poll_chats(self, requestContext, cursors, results):
+        """Handle polls for the local chats of getMessagesMulti.
+
+        Args:
+            requestContext: RequestContext object
+            cursors: list of ChatCursor objects for local chats
+            results: list of ChatMessages objects to extend
+                with invalid chat results.
+        Returns:
+            list of (Chat, ChatCursor) tuples for the valid chats.
+        """
+        result = []
+        for cursor in cursors:
+            try:
+                chat = self.chat_manager.get(cursor.chatToken)
+                if chat.expired:
+                    raise InvalidChatException()
+
+                additional_messages = self.message_handler_manager.handle_poll(
+                        requestContext, chat)
+                for message in additional_messages:
+                    self.sendMessage(requestContext, message,
+                            settings.REPLICATION_N, settings.REPLICATION_W)
+                result.append((chat, cursor))
+            except (KeyError, InvalidChatException):
+                results.append(ChatMessages(
+                    chatToken=cursor.chatToken,
+                    messages=[],
+                    invalidChat=True))
+        return result
+
+    def _read_chats(self, requestContext, chats):
+        """Read messages from the local chats of getMessagesMulti.
+
+        Args:
+            requestContext: RequestContext object
+            chats: list of (Chat, ChatCursor) tuples
+        Returns:
+            list of ChatMessages objects for chats with messages.
+        """
+        result = []
+        for chat, cursor in chats:
+            messages = chat.get_messages(cursor.asOf, user_id=requestContext.userId)
+            if messages:
+                result.append(ChatMessages(chatToken=cursor.chatToken, messages=messages))
+        return result
+
+    def getMessagesMulti(self, requestContext, cursors, block, timeout):
+        """Long poll for new messages in multiple chats.
+
+        Cursors are grouped by the primary node of their chat,
+        and each remote group is forwarded as a single request.
+        Local chats share a single waiter event, so that the
+        request returns as soon as any chat has new messages
+        or the timeout expires.
+
+        Forwarded requests which have not completed when this
+        request returns are killed, and their results discarded.
+        Since the cursors of those chats will not have advanced,
+        their messages will be returned by the next request.
+        If a forwarded request fails, this request returns
+        immediately. The results of the remaining chats are
+        returned if there are any, otherwise an
+        UnavailableException is raised.
+
+        Args:
+            requestContext: RequestContext object.
+            cursors: list of ChatCursor objects
+            block: boolean indicating if this method should block.
+            timeout: if block is True, how long to wait for
+                new messages before timing out.
+        Returns:
+            list of ChatMessages objects for the chats with
+            new messages or which are invalid.
+        Raises:
+            UnavailableException if no nodes are available, or a
+            node could not be reached and there are no results.
+        """
+        #dict of {service_key: (node, list of ChatCursor)}
+        groups = {}
+        for cursor in cursors:
+            node = self._primary_node(cursor.chatToken)
+            if node is None:
+                raise UnavailableException("no nodes available")
+            groups.setdefault(node.service_info.key, (node, []))[1].append(cursor)
+
+        event = gevent.event.Event()
+        results = []
+        errors = []
+        workers = []
+        local_cursors = []
+        for node, group_cursors in groups.values():
+            if self._is_remote_node(node):
+                workers.append(gevent.spawn(self._forward_messages_multi,
+                        requestContext, node, group_cursors, block, timeout, results, errors, event))
+            else:
+                local_cursors = group_cursors
+
+        try:
+            chats = self._poll_chats(requestContext, local_cursors, results)
+            local_results = self._read_chats(requestContext, chats)
+            if not block:
+                gevent.joinall(workers)
+            elif not local_results and not results and not errors:
+                waiters = []
+                for chat, cursor in chats:
+                    waiter = MessageWaiter(requestContext.userId, cursor.asOf, event)
+                    chat.add_waiter(waiter)
+                    waiters.append((chat, waiter))
+                try:
+                    event.wait(timeout)
+                finally:
+                    for chat, waiter in waiters:
+                        chat.remove_waiter(waiter)
+                local_results = self._read_chats(requestContext, chats)
+
+            chat_messages = list(results) + local_results
+            if not chat_messages and errors:
+                raise UnavailableException("unable to reach %s" % \
+                        ", ".join(str(node) for node, error in errors))
+            return chat_messages
+        except UnavailableException:
+            raise
+        except Exception as error:
+            self.log.exception(error)
+            raise UnavailableException(str(error))
+        finally:
+            #Forwarded long polls must not outlive this request,
+            #since they hold pooled forwarding connections.
+            gevent.killall(workers)
+
+    def _local_chat(self, chat_token):
+        """Get a valid local chat.
+
+        Args:
+            chat_token: chat token
+        Returns:
+            Chat object
+        Raises:
+            InvalidChatException if the chat is invalid or expired.
+        """
+        try:
+            chat = self.chat_manager.get(chat_token)
+            if chat.expired:
+                raise InvalidChatException()
+            return chat
+        except (KeyError, InvalidChatException):
+            raise InvalidChatException("invalid chat token: %s" % chat_token)
+
+    def subscribe(self, requestContext, chatToken, asOf):
+        """Subscribe to new chat messages.
+
+        Args:
+            requestContext: RequestContext object.
+            chatToken: chat token
+            asOf: unix timestamp after which messages should
+                be delivered.
+        Returns:
+            subscription id
+        Raises:
+            UnavailableException if no nodes are available.
+        """
+        primary_node = self._primary_node(chatToken)
+        if primary_node is None:
+            raise UnavailableException("no nodes available")
+
+        if self._is_remote_node(primary_node):
+            with self._service_proxy(primary_node) as proxy:
+                return proxy.subscribe(requestContext, chatToken, asOf)
+
+        chat = self._local_chat(chatToken)
+        chat.expire_subscriptions(settings.CHAT_SUBSCRIPTION_TTL)
+        subscription = chat.subscribe(asOf, requestContext.userId,
+                settings.CHAT_SUBSCRIPTION_MAX_QUEUE_SIZE)
+        return subscription.id
+
+    def pollSubscription(self, requestContext, chatToken, subscriptionId, timeout):
+        """Poll subscription for new chat messages.
+
+        Unlike getMessages(), messages are pushed to the subscription
+        as they arrive, and the poll is only handled by message
+        handlers (user presence) every
+        CHAT_SUBSCRIPTION_HANDLE_POLL_INTERVAL seconds.
+
+        Args:
+            requestContext: RequestContext object.
+            chatToken: chat token
+            subscriptionId: subscription id
+            timeout: how long to wait for new messages
+                before timing out.
+        Returns:
+            list of Message objects.
+        Raises:
+            InvalidSubscriptionException if the subscription
+                has expired, overflowed or was lost.
+        """
+        primary_node = self._primary_node(chatToken)
+        if primary_node is None:
+            raise UnavailableException("no nodes available")
+
+        if self._is_remote_node(primary_node):
+            with self._service_proxy(primary_node, True) as proxy:
+                return proxy.pollSubscription(requestContext, chatToken, subscriptionId, timeout)
+
+        chat = self._local_chat(chatToken)
+        subscription = chat.subscriptions.get(subscriptionId)
+        if subscription is None or subscription.overflowed:
+            chat.unsubscribe(subscriptionId)
+            raise InvalidSubscriptionException("invalid subscription: %s" % subscriptionId)
+
+        try:
+            now = time.time()
+            if now - subscription.last_handle_poll > settings.CHAT_SUBSCRIPTION_HANDLE_POLL_INTERVAL:
+                subscription.last_handle_poll = now
+                additional_messages = self.message_handler_manager.handle_poll(
+                        requestContext, chat)
+                for message in additional_messages:
+                    self.sendMessage(requestContext, message,
+                            settings.REPLICATION_N, settings.REPLICATION_W)
+
+            return subscription.poll(timeout)
+        except Exception as error:
+            self.log.exception(error)
+            raise UnavailableException(str(error))
+
+    def unsubscribe(self, requestContext, chatToken, subscriptionId):
+        """Remove subscription.
+
+        Args:
+            requestContext: RequestContext object.
+            chatToken: chat token
+            subscriptionId: subscription id
+        """
+        primary_node = self._primary_node(chatToken)
+        if primary_node is None:
+            raise UnavailableException("no nodes available")
+
+        if self._is_remote_node(primary_node):
+            with self._service_proxy(primary_node) as proxy:
+                return proxy.unsubscribe(requestContext, chatToken, subscriptionId)
+
+        chat = self.chat_manager.all().get(chatToken)
+        if chat is not None:
+            chat.unsubscribe(subscriptionId)
+
     def sendMessage(self, requestContext, message, N, W):
         """Send message to a chat.
 
@@ -341,8 +839,8 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             raise UnavailableException("no nodes available")
 
         if self._is_remote_node(primary_node):
-            proxy = self._service_proxy(primary_node)
-            return proxy.sendMessage(requestContext, message, N, W)
+            with self._service_proxy(primary_node) as proxy:
+                return proxy.sendMessage(requestContext, message, N, W)
 
         try:
             chat = self.chat_manager.get(message.header.chatToken)
@@ -392,6 +890,166 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             self.log.exception(error)
             raise UnavailableException(str(error))
 
+    def _send_chat_messages(self, requestContext, chat_token, messages, N, W):
+        """Send a batch of messages to a local chat.
+
+        Each message is passed through the message handlers
+        in order. Valid messages, and the additional messages
+        returned by the handlers, are then stored in the chat
+        at once, with a single replication and persist.
+
+        Args:
+            requestContext: RequestContext object.
+            chat_token: chat token
+            messages: list of Message objects for the chat
+            N: number of nodes that messages should
+                be replicated to.
+            W: number of nodes that messages need to be
+                written to before the write can be considered
+                successful.
+        Returns:
+            list of SendMessageResult objects ordered as messages.
+        """
+        try:
+            chat = self.chat_manager.get(chat_token)
+            if chat.expired:
+                raise InvalidChatException()
+        except (KeyError, InvalidChatException):
+            error = "invalid chat token: %s" % chat_token
+            return [SendMessageResult(status=SendMessageStatus.INVALID_CHAT, error=error)
+                    for message in messages]
+
+        results = []
+        chat_messages = []
+        for message in messages:
+            try:
+                additional_messages = self.message_handler_manager.handle(
+                        requestContext,
+                        chat,
+                        message)
+                chat_messages.append(message)
+                chat_messages.extend(additional_messages)
+                results.append(SendMessageResult(
+                    status=SendMessageStatus.SENT,
+                    message=message))
+            except MessageHandlerException as error:
+                self.log.exception(error)
+                results.append(SendMessageResult(
+                    status=SendMessageStatus.INVALID_MESSAGE,
+                    error=str(error)))
+
+        if not chat_messages:
+            return results
+
+        try:
+            #send messages to waiting users.
+            chat.send_messages(chat_messages)
+
+            #replicate messages
+            async_result = self.replicator.replicate(chat, chat_messages, N, W)
+            async_result.get(block=True, timeout=settings.REPLICATION_TIMEOUT)
+
+            #persist messages
+            self.persister.persist(chat, chat_messages)
+        except Exception as error:
+            if isinstance(error, gevent.Timeout):
+                error = "timeout: (%ss)" % settings.REPLICATION_TIMEOUT
+            self.log.error("sendMessages failed for %s: %s" % (chat_token, error))
+            for result in results:
+                if result.status == SendMessageStatus.SENT:
+                    result.status = SendMessageStatus.UNAVAILABLE
+                    result.message = None
+                    result.error = str(error)
+
+        return results
+
+    def _send_messages_group(self, requestContext, node, indexed_messages, N, W, results):
+        """Send the messages of a sendMessages request for a single primary.
+
+        Args:
+            requestContext: RequestContext object.
+            node: ServiceHashringNode of the messages' primary
+            indexed_messages: list of (index, Message) tuples
+            N: number of nodes that messages should
+                be replicated to.
+            W: number of nodes that messages need to be
+                written to before the write can be considered
+                successful.
+            results: list of SendMessageResult objects to
+                update at the messages' indexes.
+        """
+        indexes = [index for index, message in indexed_messages]
+        messages = [message for index, message in indexed_messages]
+
+        if self._is_remote_node(node):
+            try:
+                with self._service_proxy(node) as proxy:
+                    group_results = proxy.sendMessages(requestContext, messages, N, W)
+            except Exception as error:
+                self.log.warning("sendMessages forwarding to %s failed: %s" % (node, error))
+                group_results = [SendMessageResult(
+                    status=SendMessageStatus.UNAVAILABLE,
+                    error=str(error)) for message in messages]
+            for index, result in zip(indexes, group_results):
+                results[index] = result
+            return
+
+        #dict of {chat_token: list of (index, Message)}
+        chats = {}
+        for index, message in indexed_messages:
+            chats.setdefault(message.header.chatToken, []).append((index, message))
+
+        workers = []
+        for chat_token, chat_messages in chats.iteritems():
+            workers.append(gevent.spawn(self._send_chat_messages, requestContext,
+                chat_token, [m for i, m in chat_messages], N, W))
+        gevent.joinall(workers)
+
+        for worker, chat_messages in zip(workers, chats.values()):
+            chat_results = worker.value
+            if chat_results is None:
+                chat_results = [SendMessageResult(
+                    status=SendMessageStatus.UNAVAILABLE,
+                    error=str(worker.exception)) for m in chat_messages]
+            for (index, message), result in zip(chat_messages, chat_results):
+                results[index] = result
+
+    def sendMessages(self, requestContext, messages, N, W):
+        """Send a batch of messages.
+
+        Messages are grouped by the primary node of their chat,
+        and each remote group is forwarded as a single request.
+        The messages of each local chat are handled in order,
+        stored together, and replicated and persisted once.
+
+        Args:
+            requestContext: RequestContext object.
+            messages: list of Message objects.
+            N: number of nodes that messages should
+                be replicated to.
+            W: number of nodes that messages need to be
+                written to before the write can be considered
+                successful.
+        Returns:
+            list of SendMessageResult objects ordered as messages.
+        Raises:
+            UnavailableException if no nodes are available.
+        """
+        #dict of {service_key: (node, list of (index, Message))}
+        groups = {}
+        for index, message in enumerate(messages):
+            node = self._primary_node(message.header.chatToken)
+            if node is None:
+                raise UnavailableException("no nodes available")
+            groups.setdefault(node.service_info.key, (node, []))[1].append((index, message))
+
+        results = [None] * len(messages)
+        workers = [gevent.spawn(self._send_messages_group,
+                requestContext, node, indexed_messages, N, W, results)
+                for node, indexed_messages in groups.values()]
+        gevent.joinall(workers)
+        return results
+
     def twilioRequest(self, requestContext, path, params):
         """Twilio callback request
 
@@ -410,8 +1068,8 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
             raise UnavailableException("no nodes available")
 
         if self._is_remote_node(primary_node):
-            proxy = self._service_proxy(primary_node)
-            return proxy.twilioRequest(requestContext, path, params)
+            with self._service_proxy(primary_node) as proxy:
+                return proxy.twilioRequest(requestContext, path, params)
         
         try:
             chat = self.chat_manager.get(chat_token)
@@ -430,17 +1088,50 @@ class ChatServiceHandler(TChatService.Iface, GServiceHandler):
         Args:
             requestContext: RequestContext object
             replicationSnapshot: ReplicationSnapshot object
+        Raises:
+            ReplicationGapException if the snapshot is a delta
+            which does not follow from the last snapshot
+            stored. In this case a full snapshot is required.
         """
         chat = self.chat_manager.get(chatSnapshot.state.token)
-        chat.state.status = chatSnapshot.state.status
-        chat.state.maxDuration = chatSnapshot.state.maxDuration
-        chat.state.maxParticipants = chatSnapshot.state.maxParticipants
-        chat.state.startTimestamp = chatSnapshot.state.startTimestamp
-        chat.state.endTimestamp = chatSnapshot.state.endTimestamp
-        chat.state.users = chatSnapshot.state.users
-        chat.state.persisted = chatSnapshot.state.persisted
-        chat.state.session = chatSnapshot.state.session
-        chat.store_replicated_messages(chatSnapshot.state.messages)
+        if not chat.store_snapshot(chatSnapshot):
+            raise ReplicationGapException("replication gap: %s (epoch=%s, base=%s)" % (
+                chatSnapshot.state.token,
+                chatSnapshot.epoch,
+                chatSnapshot.baseSequence))
+        self.garbage_collector.schedule(chat)
+
+    def getChatDigest(self, requestContext, chatToken, bucketDuration):
+        """Get a digest of the messages in the local copy of a chat.
+
+        Args:
+            requestContext: RequestContext object
+            chatToken: chat token
+            bucketDuration: digest bucket duration in seconds
+        Returns:
+            ChatDigest object
+        """
+        chat = self.chat_manager.get(chatToken)
+        buckets = [ChatDigestBucket(start=start, count=count, digest=digest)
+                for start, count, digest in chat.digest(bucketDuration)]
+        return ChatDigest(
+                token=chatToken,
+                bucketDuration=bucketDuration,
+                buckets=buckets)
+
+    def getChatBucketMessages(self, requestContext, chatToken, bucketDuration, bucketStarts):
+        """Get the messages in digest buckets of the local copy of a chat.
+
+        Args:
+            requestContext: RequestContext object
+            chatToken: chat token
+            bucketDuration: digest bucket duration in seconds
+            bucketStarts: list of digest bucket start timestamps
+        Returns:
+            list of Message objects
+        """
+        chat = self.chat_manager.get(chatToken)
+        return materialize(chat.bucket_messages(bucketDuration, bucketStarts))
 
     def expireZookeeperSession(self, requestContext, timeout):
         result = False
@@ -0,0 +1,349 @@
+import logging
+import os
+import struct
+
+import gevent
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from trsvcscore.hashring.base import ServiceHashringEvent
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+from chat import Chat
+from snapshot import SerializedChatSnapshot
+
+class HintedHandoff(object):
+    """Hinted handoff store.
+
+    Holds the messages of replications which failed, keyed
+    by destination service, so they can be replayed once the
+    service is reachable again, restoring N copies of the
+    messages without replaying whole chats.
+
+    Hints for the same chat and service are merged. Hints
+    are held in memory up to max_hints messages, beyond which
+    they are spilled to a file per service in spill_path, or
+    dropped if no spill_path was provided.
+
+    Hints are replayed, batch_size chats at a time, when the
+    service reappears in the hashring, and every probe_interval
+    seconds, where a failure to replay the first chat acts as
+    a failed health probe.
+
+    If the chat is still present locally, hints are replayed
+    as a sequenced full snapshot of its current state, like the
+    rebalancer's final chunk, so a replica which has since
+    stored newer snapshots keeps its state. Otherwise only
+    the hinted messages are replayed.
+    """
+
+    def __init__(
+            self,
+            replicator,
+            max_hints=100000,
+            spill_path=None,
+            probe_interval=30,
+            batch_size=50):
+        """HintedHandoff constructor.
+
+        Args:
+            replicator: Replicator object whose replication
+                connections will be used to replay hints.
+            max_hints: maximum number of hinted messages
+                to hold in memory.
+            spill_path: optional directory in which to store
+                hints exceeding max_hints.
+            probe_interval: number of seconds between
+                replay attempts for unreachable services.
+            batch_size: number of chats to replay
+                before yielding.
+        """
+        self.replicator = replicator
+        self.max_hints = max_hints
+        self.spill_path = spill_path
+        self.probe_interval = probe_interval
+        self.batch_size = batch_size
+
+        #dict of {service_key: {chat_token: {message_id: Message}}}
+        self.hints = {}
+
+        #dict of {service_key: ServiceHashringNode} of the last
+        #known node for each service with hints.
+        self.nodes = {}
+
+        #number of hinted messages held in memory
+        self.size = 0
+
+        #set of service keys currently being replayed
+        self.replaying = set()
+
+        self.running = False
+        self.greenlet = None
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        #add hashring observer
+        self.replicator.hashring.add_observer(self._hashring_observer)
+
+    def _hashring_observer(self, hashring, event):
+        """Observer method which will be invoked upon hashring changes.
+
+        Replays hints for services which are in the hashring.
+
+        Args:
+            hashring: ServiceHashring object
+            event: ServiceHashringEvent object
+        """
+        if event.event_type == ServiceHashringEvent.CHANGED_EVENT:
+            for node in event.current_hashring:
+                service_key = node.service_info.key
+                if self.has_hints(service_key) and service_key not in self.replaying:
+                    self.nodes[service_key] = node
+                    gevent.spawn(self.replay, service_key)
+
+    def _spill_file(self, service_key):
+        """Get the spill file path for the given service.
+
+        Args:
+            service_key: service key
+        Returns:
+            spill file path
+        """
+        filename = "".join([c if c.isalnum() else "_" for c in service_key])
+        return os.path.join(self.spill_path, "%s.hints" % filename)
+
+    def _spill(self, service_key, chat_token, messages):
+        """Append hint to the service's spill file.
+
+        Args:
+            service_key: service key
+            chat_token: chat token
+            messages: list of Message objects
+        """
+        snapshot = SerializedChatSnapshot(ChatSnapshot(
+                fullSnapshot=False,
+                state=ChatState(token=chat_token, messages=messages)))
+        with open(self._spill_file(service_key), "ab") as spill_file:
+            spill_file.write(struct.pack(">I", len(snapshot.data)))
+            spill_file.write(snapshot.data)
+
+    def _read_spill(self, service_key):
+        """Read and remove the service's spill file.
+
+        Args:
+            service_key: service key
+        Returns:
+            list of ChatSnapshot objects.
+        """
+        result = []
+        path = self._spill_file(service_key)
+        if not os.path.exists(path):
+            return result
+
+        with open(path, "rb") as spill_file:
+            data = spill_file.read()
+        os.remove(path)
+
+        offset = 0
+        while offset + 4 <= len(data):
+            length = struct.unpack(">I", data[offset:offset+4])[0]
+            offset += 4
+            transport = TTransport.TMemoryBuffer(data[offset:offset+length])
+            snapshot = ChatSnapshot()
+            snapshot.read(TBinaryProtocol.TBinaryProtocol(transport))
+            result.append(snapshot)
+            offset += length
+        return result
+
+    def has_hints(self, service_key):
+        """Check if there are hints for the given service.
+
+        Args:
+            service_key: service key
+        Returns:
+            True if hints exist in memory or in a spill file.
+        """
+        if self.hints.get(service_key):
+            return True
+        return self.spill_path is not None and \
+                os.path.exists(self._spill_file(service_key))
+
+    def add(self, node, chat, messages):
+        """Add hint for a failed replication.
+
+        Args:
+            node: ServiceHashringNode the replication failed for.
+            chat: Chat object
+            messages: list of Message objects which
+                were not replicated.
+        """
+        if not messages:
+            return
+
+        service_key = node.service_info.key
+        self.nodes[service_key] = node
+
+        if self.size + len(messages) > self.max_hints:
+            if self.spill_path is not None:
+                self._spill(service_key, chat.token, messages)
+            else:
+                self.log.warning("dropping %s hinted message(s) for %s (max_hints=%s)" % (
+                    len(messages), service_key, self.max_hints))
+            return
+
+        chat_hints = self.hints.setdefault(service_key, {}).setdefault(chat.token, {})
+        for message in messages:
+            if message.header.id not in chat_hints:
+                chat_hints[message.header.id] = message
+                self.size += 1
+
+    def discard(self, service_key, chat_token):
+        """Discard in memory hints for a chat.
+
+        This should be invoked following a successful
+        replication of the chat to the service, since
+        the replication will have included the hinted
+        messages.
+
+        Args:
+            service_key: service key
+            chat_token: chat token
+        """
+        service_hints = self.hints.get(service_key)
+        if service_hints:
+            chat_hints = service_hints.pop(chat_token, None)
+            if chat_hints:
+                self.size -= len(chat_hints)
+            if not service_hints:
+                del self.hints[service_key]
+
+    def _build_snapshot(self, chat_token, messages):
+        """Build replay snapshot.
+
+        Snapshots of chats which are present locally contain
+        the chat state and are sequenced, so that the replica
+        does not store state older than its own. Snapshots of
+        chats which are no longer present contain messages only.
+
+        Args:
+            chat_token: chat token
+            messages: list of hinted Message objects
+        Returns:
+            ChatSnapshot object
+        """
+        state = ChatState(token=chat_token, messages=messages)
+        chat = self.replicator.chat_manager.all().get(chat_token)
+        if chat is None:
+            return ChatSnapshot(fullSnapshot=False, state=state)
+
+        for field in Chat.STATE_FIELDS:
+            setattr(state, field, getattr(chat.state, field))
+        return ChatSnapshot(
+                fullSnapshot=True,
+                state=state,
+                epoch=chat.epoch,
+                sequence=chat.sequence)
+
+    def _acknowledge(self, service_key, snapshot):
+        """Record the replay of a sequenced snapshot.
+
+        Args:
+            service_key: service key
+            snapshot: replayed ChatSnapshot object
+        """
+        if snapshot.sequence is None:
+            return
+        chat = self.replicator.chat_manager.all().get(snapshot.state.token)
+        if chat is not None and chat.epoch == snapshot.epoch:
+            chat.acknowledge(service_key, snapshot.sequence)
+
+    def replay(self, service_key):
+        """Replay hints for the given service.
+
+        Args:
+            service_key: service key
+        Returns:
+            True if all hints were replayed, False otherwise.
+        """
+        node = self.nodes.get(service_key)
+        if node is None or service_key in self.replaying:
+            return False
+
+        snapshots = []
+        replayed = 0
+        self.replaying.add(service_key)
+        try:
+            for chat_token in list(self.hints.get(service_key, {}).keys()):
+                messages = self.hints[service_key][chat_token].values()
+                snapshots.append((chat_token, self._build_snapshot(chat_token, messages)))
+            if self.spill_path is not None:
+                for snapshot in self._read_spill(service_key):
+                    snapshots.append((None, self._build_snapshot(
+                        snapshot.state.token, snapshot.state.messages)))
+
+            for index in range(0, len(snapshots), self.batch_size):
+                batch = snapshots[index:index+self.batch_size]
+                service_proxy_pool = self.replicator.service_proxy_pool(node)
+                with service_proxy_pool.get() as proxy:
+                    context = self.replicator.build_request_context()
+                    for chat_token, snapshot in batch:
+                        proxy.replicate(context, snapshot)
+                        self._acknowledge(service_key, snapshot)
+                        if chat_token is not None:
+                            self.discard(service_key, chat_token)
+                        replayed += 1
+                gevent.sleep(0)
+
+            if replayed:
+                self.log.info("replayed %s hinted chat(s) to %s" % (replayed, service_key))
+            return True
+        except Exception as error:
+            self.log.warning("hint replay to %s failed: %s" % (service_key, error))
+
+            #Return spilled hints which were not replayed
+            #to the spill file.
+            if self.spill_path is not None:
+                for chat_token, snapshot in snapshots[replayed:]:
+                    if chat_token is None:
+                        self._spill(service_key, snapshot.state.token, snapshot.state.messages)
+            return False
+        finally:
+            self.replaying.discard(service_key)
+
+    def start(self):
+        """Start hint replay prober."""
+        if not self.running:
+            self.running = True
+            self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        """Run hint replay prober."""
+        while self.running:
+            try:
+                gevent.sleep(self.probe_interval)
+                for service_key in self.nodes.keys():
+                    if self.has_hints(service_key):
+                        self.replay(service_key)
+                    else:
+                        del self.nodes[service_key]
+            except gevent.GreenletExit:
+                break
+            except Exception as error:
+                self.log.exception(error)
+
+        self.running = False
+
+    def stop(self):
+        """Stop hint replay prober."""
+        if self.running:
+            self.running = False
+            self.greenlet.kill()
+
+    def join(self, timeout=None):
+        """Join hint replay prober.
+
+        Args:
+            timeout: optional maximum number of seconds to wait
+                for the prober to complete.
+        """
+        if self.greenlet:
+            self.greenlet.join(timeout)
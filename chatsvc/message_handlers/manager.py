@@ -161,6 +161,7 @@ class MessageHandlerManager(object):
         user_state = chat.state.users.get(request_context.userId)
         if user_state:
             user_state.updateTimestamp = now
+            chat.state_changed("users")
 
         #find idle users and update status
         for user_state in chat.state.users.values():
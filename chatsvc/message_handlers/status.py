@@ -33,18 +33,27 @@ class StatusMessageHandler(MessageHandler):
         return StatusMessageHandler(service_handler)
 
     def _handle_chat_status(self, request_context, chat, message):
-        """CHAT_STATUS handler method."""
+        """CHAT_STATUS handler method.
+
+        Chat start / end times are saved to the database
+        behind the request, through the persister, rather
+        than blocking the request on the database write.
+        """
         msg = message.chatStatusMessage
         if chat.state.status == ChatStatus.PENDING:
             if msg.status == ChatStatus.STARTED:
                 chat.state.status = msg.status
                 chat.state.startTimestamp = message.header.timestamp
-                chat.save() 
+                chat.state_changed("status", "startTimestamp")
+                self.service_handler.persister.save(chat)
+                self.service_handler.garbage_collector.schedule(chat)
         if chat.state.status == ChatStatus.STARTED:
             if msg.status == ChatStatus.ENDED:
                 chat.state.status = msg.status
                 chat.state.endTimestamp = message.header.timestamp
-                chat.save() 
+                chat.state_changed("status", "endTimestamp")
+                self.service_handler.persister.save(chat)
+                self.service_handler.garbage_collector.schedule(chat)
 
     def _handle_user_status(self, request_context, chat, message):
         """USER_STATUS handler method."""
@@ -60,6 +69,7 @@ class StatusMessageHandler(MessageHandler):
 
         user_state.status = msg.status
         user_state.updateTimestamp = message.header.timestamp
+        chat.state_changed("users")
 
     def handled_message_types(self):
         """Return a list of handled message types.
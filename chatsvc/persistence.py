@@ -2,13 +2,16 @@ import abc
 import json
 import logging
 
+import gevent
 import gevent.event
 import gevent.queue
 from sqlalchemy.sql import func
 
 from trchatsvc.gen.ttypes import MessageType, ChatStatus
 from trsvcscore.hashring.base import ServiceHashringEvent
-from trsvcscore.db.models import ChatArchiveJob
+from trsvcscore.db.models import Chat as ChatModel, ChatArchiveJob
+
+from preference import PreferenceListCache
 
 class PersistException(Exception):
     """Persist exception class."""
@@ -42,7 +45,8 @@ class Persister(object):
             service,
             hashring,
             chat_manager,
-            database_session_factory):
+            database_session_factory,
+            preference_lists=None):
         """Persister constructor.
 
         Args:
@@ -51,11 +55,15 @@ class Persister(object):
             chat_manager: ChatManager object
             database_session_factory: sqlalchemy database session
             factory method.
+            preference_lists: optional PreferenceListCache object
+                to use for preference list lookups. If not provided,
+                a new cache will be created for the hashring.
         """
         self.service = service
         self.hashring = hashring
         self.chat_manager = chat_manager
         self.database_session_factory = database_session_factory
+        self.preference_lists = preference_lists or PreferenceListCache(hashring)
 
         #add hashring observer
         self.hashring.add_observer(self._hashring_observer)
@@ -103,6 +111,22 @@ class Persister(object):
         """
         return
 
+    @abc.abstractmethod
+    def save(self, chat):
+        """Save chat start / end times to the database.
+
+        Saves are written behind the caller, and may be
+        coalesced with other saves of the same chat.
+
+        Args:
+            chat: Chat object
+        
+        Returns:
+            PersistAsyncResult object which will be set
+            once the chat has been written.
+        """
+        return
+
     @abc.abstractmethod
     def add_observer(self, observer):
         """Add persister observer.
@@ -153,10 +177,10 @@ class Persister(object):
             #taking over, since they may have add messages
             #in memory which were not permitted.
             for chat_token, chat in self.chat_manager.all().items():
-                previous_preference_list = self.hashring.preference_list(
+                previous_preference_list = self.preference_lists.preference_list(
                         chat_token,
                         event.previous_hashring)
-                current_preference_list = self.hashring.preference_list(
+                current_preference_list = self.preference_lists.preference_list(
                         chat_token,
                         event.current_hashring)
 
@@ -198,6 +222,23 @@ class GreenletPoolPersister(Persister):
             self.zombie = zombie
             self.result = result
 
+    class SaveItem(object):
+        """Save item class.
+
+        Represents a batch of chats whose start / end
+        times need to be written.
+        """
+        def __init__(self, chats, results):
+            """SaveItem constructor.
+
+            Args:
+                chats: list of Chat objects
+                results: list of PersistAsyncResult objects
+                    to set once the chats have been written.
+            """
+            self.chats = chats
+            self.results = results
+
     def __init__(
         self,
         service,
@@ -205,7 +246,12 @@ class GreenletPoolPersister(Persister):
         chat_manager,
         database_session_factory,
         size,
-        max_queue_size=100):
+        max_queue_size=100,
+        preference_lists=None,
+        save_delay=0.05,
+        save_batch_size=50,
+        save_retries=3,
+        save_retry_delay=0.5):
         """GreenletPoolPersister constructor.
 
         Args:
@@ -218,16 +264,37 @@ class GreenletPoolPersister(Persister):
             max_queue_size: maximum number of persist work items
                 to allow in the queue before additional attempts
                 will block.
+            preference_lists: optional PreferenceListCache object
+                to use for preference list lookups.
+            save_delay: number of seconds to wait for additional
+                saves to coalesce before writing them.
+            save_batch_size: maximum number of chats to write
+                in a single database transaction.
+            save_retries: number of times to retry a failed
+                save before failing its results.
+            save_retry_delay: number of seconds to wait before
+                the first retry, doubled for each retry.
         """
         super(GreenletPoolPersister, self).__init__(
             service,
             hashring,
             chat_manager,
-            database_session_factory)
+            database_session_factory,
+            preference_lists)
         self.size = size
         self.queue = gevent.queue.Queue(max_queue_size)
         self.observers = []
         self.workers = []
+        self.save_delay = save_delay
+        self.save_batch_size = save_batch_size
+        self.save_retries = save_retries
+        self.save_retry_delay = save_retry_delay
+
+        #dict of {chat_token: (Chat, [PersistAsyncResult])} of
+        #chats waiting to be written.
+        self.pending_saves = {}
+        self.save_event = gevent.event.Event()
+        self.saver = None
         self.running = False
         self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
 
@@ -316,11 +383,23 @@ class GreenletPoolPersister(Persister):
     def _persist_ended_chat(self, chat, session):
         """Finish peristing ended chat.
 
+        Chat start / end times are written along with the
+        archive job, so that the times of zombie chats, whose
+        end was never saved, are written.
+
         Args:
             chat: Chat object
             session: SQLAlchemy Sesison object
         """
         chat.state.persisted = True
+        chat.state_changed("persisted")
+
+        session.query(ChatModel) \
+                .filter(ChatModel.id == chat.id) \
+                .update({
+                    "start": chat.start,
+                    "end": chat.end
+                })
         
         #convert chat session to pure json
         data = dict(chat.state.session);
@@ -338,6 +417,102 @@ class GreenletPoolPersister(Persister):
 
         session.add(job)
 
+    def _save_item(self, item):
+        """Write chat start / end times to the database.
+
+        All chats in the item are written in a single transaction,
+        which is retried with exponential backoff on failure.
+
+        Args:
+            item: SaveItem object
+        """
+        delay = self.save_retry_delay
+        last_error = None
+        for attempt in range(0, self.save_retries + 1):
+            session = self._get_database_session()
+            try:
+                for chat in item.chats:
+                    session.query(ChatModel) \
+                            .filter(ChatModel.id == chat.id) \
+                            .update({
+                                "start": chat.start,
+                                "end": chat.end
+                            })
+                session.commit()
+
+                for result in item.results:
+                    result.set(None)
+
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug("Done saving %s chat(s)" % len(item.chats))
+                return
+
+            except Exception as error:
+                last_error = error
+                session.rollback()
+                self.log.warning("save of %s chat(s) failed (attempt=%s): %s" % (
+                    len(item.chats), attempt + 1, error))
+            finally:
+                session.close()
+
+            if attempt < self.save_retries:
+                gevent.sleep(delay)
+                delay *= 2
+
+        self.log.error("save of %s chat(s) failed after %s attempt(s), requeueing in %ss" % (
+            len(item.chats), self.save_retries + 1, delay))
+        for result in item.results:
+            result.set_exception(PersistException(str(last_error)))
+
+        #Requeue the save, rather than dropping it, since the
+        #chats may already be persisted and garbage collected.
+        gevent.spawn_later(delay, self._requeue_saves, item.chats)
+
+    def _requeue_saves(self, chats):
+        """Requeue failed saves.
+
+        Args:
+            chats: list of Chat objects whose save failed.
+        """
+        if not self.running:
+            self.log.error("dropping save of %s chat(s) following stop" % len(chats))
+            return
+
+        for chat in chats:
+            if chat.token not in self.pending_saves:
+                self.pending_saves[chat.token] = (chat, [])
+        self.save_event.set()
+
+    def _flush_saves(self):
+        """Queue pending saves to the pool in batches."""
+        pending = self.pending_saves.values()
+        self.pending_saves = {}
+        for index in range(0, len(pending), self.save_batch_size):
+            batch = pending[index:index+self.save_batch_size]
+            chats = [chat for chat, results in batch]
+            results = [result for chat, results in batch for result in results]
+            self.queue.put(self.SaveItem(chats, results))
+
+    def _run_saver(self):
+        """Run write-behind saver."""
+        while self.running:
+            try:
+                self.save_event.wait()
+                if not self.running:
+                    break
+
+                #Wait for additional saves, i.e. the end
+                #of a chat following its start, to coalesce.
+                if self.save_delay:
+                    gevent.sleep(self.save_delay)
+                self.save_event.clear()
+                self._flush_saves()
+
+            except gevent.GreenletExit:
+                break
+            except Exception as error:
+                self.log.exception(error)
+
     def add_observer(self, observer):
         """Add persister observer.
 
@@ -364,6 +539,7 @@ class GreenletPoolPersister(Persister):
             for i in range(0, self.size):
                 worker = gevent.spawn(self.run)
                 self.workers.append(worker)
+            self.saver = gevent.spawn(self._run_saver)
 
     def run(self):
         """Run persister."""
@@ -373,11 +549,18 @@ class GreenletPoolPersister(Persister):
                 if item is self.STOP_ITEM:
                     break
                 
-                self._persist_item(item)
+                if isinstance(item, self.SaveItem):
+                    self._save_item(item)
+                else:
+                    self._persist_item(item)
                 
             except Exception as error:
                 self.log.exception(error)
-                item.result.set_exception(PersistException(str(error)))
+                if isinstance(item, self.SaveItem):
+                    for result in item.results:
+                        result.set_exception(PersistException(str(error)))
+                else:
+                    item.result.set_exception(PersistException(str(error)))
 
 
     def stop(self):
@@ -385,6 +568,11 @@ class GreenletPoolPersister(Persister):
         if self.running:
             self.log.info("Stopping %s ..." % self.__class__.__name__)
             self.running = False
+
+            #Wake the saver so that it exits, and queue
+            #pending saves ahead of the stop items.
+            self.save_event.set()
+            self._flush_saves()
             for i in range(0, self.size):
                 self.queue.put(self.STOP_ITEM)
 
@@ -398,7 +586,10 @@ class GreenletPoolPersister(Persister):
             timeout: optional maximum number of seconds to wait for the completion
                 of all threads or greenlets.
         """
-        gevent.joinall(self.workers, timeout)
+        greenlets = list(self.workers)
+        if self.saver:
+            greenlets.append(self.saver)
+        gevent.joinall(greenlets, timeout)
 
     def persist(self, chat, messages, all=False, zombie=False):
         """Persist messages for the given chat.
@@ -425,3 +616,30 @@ class GreenletPoolPersister(Persister):
                 result=PersistAsyncResult())
         self.queue.put(item)
         return item.result
+
+    def save(self, chat):
+        """Save chat start / end times to the database.
+
+        Saves are written behind the caller. Saves of the same
+        chat which are pending are coalesced into a single write
+        of the chat's current start / end times, and pending
+        saves are written in batches by the persister pool.
+
+        Args:
+            chat: Chat object
+        
+        Returns:
+            PersistAsyncResult object which will be set
+            once the chat has been written. Callers which
+            require durability may wait on the result.
+            If the write fails after save_retries retries,
+            the result is failed and the save is requeued.
+        """
+        result = PersistAsyncResult()
+        pending = self.pending_saves.get(chat.token)
+        if pending is not None:
+            pending[1].append(result)
+        else:
+            self.pending_saves[chat.token] = (chat, [result])
+            self.save_event.set()
+        return result
@@ -0,0 +1,129 @@
+import logging
+
+from trsvcscore.hashring.base import ServiceHashringEvent
+
+class PreferenceListCache(object):
+    """Hashring preference list cache.
+
+    Caches hashring preference lists by ring version, chat token
+    and merge_nodes, so that routing and replication do not need
+    to walk the hashring for every request.
+
+    Preference lists for the current hashring are cached until the
+    hashring changes, at which point the ring version is incremented
+    and the cache is dropped. Preference lists for explicitly provided
+    hashrings, i.e. the previous and current hashrings of a
+    ServiceHashringEvent, are cached by hashring identity for the
+    most recently used hashrings. This allows the observers of a
+    single hashring change to share the same preference lists.
+    """
+
+    def __init__(self, hashring, max_size=100000, max_hashrings=4):
+        """PreferenceListCache constructor.
+
+        Args:
+            hashring: ServiceHashring object
+            max_size: maximum number of preference lists to cache
+                per hashring before the cache is cleared.
+            max_hashrings: maximum number of explicitly provided
+                hashrings to cache preference lists for.
+        """
+        self.hashring = hashring
+        self.max_size = max_size
+        self.max_hashrings = max_hashrings
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+        #dict of {(chat_token, merge_nodes): preference list}
+        #for the current hashring.
+        self.cache = {}
+
+        #list of (hashring, cache) tuples for explicitly provided
+        #hashrings, ordered from most to least recently used.
+        self.hashring_caches = []
+
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        #add hashring observer
+        self.hashring.add_observer(self._hashring_observer)
+
+    def _hashring_observer(self, hashring, event):
+        """Observer method which will be invoked upon hashring changes.
+
+        Args:
+            hashring: ServiceHashring object
+            event: ServiceHashringEvent object
+        """
+        if event.event_type == ServiceHashringEvent.CHANGED_EVENT:
+            self.log.info("Dropping preference list cache (version=%s, hits=%s, misses=%s)" % (
+                self.version, self.hits, self.misses))
+            self.version += 1
+            self.cache = {}
+
+    def _hashring_cache(self, hashring):
+        """Get the cache for an explicitly provided hashring.
+
+        Args:
+            hashring: list of ServiceHashringNode objects
+        Returns:
+            dict of {(chat_token, merge_nodes): preference list}
+        """
+        for index, (cached_hashring, cache) in enumerate(self.hashring_caches):
+            if cached_hashring is hashring:
+                if index:
+                    del self.hashring_caches[index]
+                    self.hashring_caches.insert(0, (cached_hashring, cache))
+                return cache
+
+        cache = {}
+        self.hashring_caches.insert(0, (hashring, cache))
+        del self.hashring_caches[self.max_hashrings:]
+        return cache
+
+    def preference_list(self, chat_token, hashring=None, merge_nodes=False):
+        """Get the preference list for the given chat token.
+
+        Args:
+            chat_token: chat token
+            hashring: optional list of ServiceHashringNode's to
+                use to determine the preference list. If not
+                provided, the current hashring will be used.
+            merge_nodes: optional flag indicating that nodes on
+                the same host should be merged.
+        Returns:
+            list of ServiceHashringNode's. Note that the returned
+            list is shared and should not be modified.
+        """
+        if hashring is None:
+            cache = self.cache
+        else:
+            cache = self._hashring_cache(hashring)
+
+        key = (chat_token, merge_nodes)
+        result = cache.get(key)
+        if result is None:
+            self.misses += 1
+            result = self.hashring.preference_list(
+                    chat_token,
+                    hashring,
+                    merge_nodes=merge_nodes)
+            if len(cache) >= self.max_size:
+                cache.clear()
+            cache[key] = result
+        else:
+            self.hits += 1
+        return result
+
+    def stats(self):
+        """Get cache statistics.
+
+        Returns:
+            dict of cache statistics.
+        """
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.cache)
+        }
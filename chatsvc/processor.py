@@ -0,0 +1,206 @@
+import struct
+
+from thrift.Thrift import TApplicationException, TMessageType, TType
+from thrift.protocol import TBinaryProtocol, TCompactProtocol
+from thrift.transport import TTransport
+
+from trchatsvc.gen import TChatService
+from trchatsvc.gen.ttypes import UnavailableException, InvalidChatException
+
+from protocol import PrefixTransport, protocol_factory
+
+#first byte of strict binary and compact protocol messages
+BINARY_VERSION_BYTE = chr(0x80)
+COMPACT_PROTOCOL_ID = chr(TCompactProtocol.TCompactProtocol.PROTOCOL_ID)
+
+#first byte of framed messages. Frames contain strict binary,
+#compact, or non-strict binary messages, whose first byte is
+#the high byte of the method name length.
+FRAMED_MESSAGE_BYTES = (BINARY_VERSION_BYTE, COMPACT_PROTOCOL_ID, chr(0))
+
+class GetMessagesResult(TChatService.getMessages_result):
+    """getMessages result.
+
+    The result's messages may be MessageRecord objects, whose
+    encoded messages are written directly into the list encoding
+    for binary protocols, including the accelerated protocol,
+    rather than encoding each message struct by struct. Message
+    objects, i.e. from forwarded requests, are encoded as usual.
+    """
+
+    def write(self, oprot):
+        """Write result to the given protocol.
+
+        Args:
+            oprot: Thrift protocol object
+        """
+        if self.success is None or \
+           not isinstance(oprot, TBinaryProtocol.TBinaryProtocol):
+            return super(GetMessagesResult, self).write(oprot)
+
+        oprot.writeStructBegin("getMessages_result")
+        oprot.writeFieldBegin("success", TType.LIST, 0)
+        oprot.writeListBegin(TType.STRUCT, len(self.success))
+        for message in self.success:
+            message.write(oprot)
+        oprot.writeListEnd()
+        oprot.writeFieldEnd()
+        oprot.writeFieldStop()
+        oprot.writeStructEnd()
+
+
+class ChatServiceProcessor(TChatService.Processor):
+    """Chat service processor.
+
+    Processor which writes getMessages responses with
+    GetMessagesResult, so that stored messages are not
+    re-encoded for each client polling the same chat.
+
+    The protocol and transport of each request are detected
+    from its first bytes, so that clients and peers may use
+    the binary or compact protocols, either buffered or
+    framed, with the same server. Non-strict binary requests,
+    which begin with the method name length rather than the
+    protocol version, are distinguished from framed requests
+    by the fifth byte, which is the first byte of the method
+    name rather than the first byte of the framed message. Responses are written
+    with the protocol and transport of the request.
+    Binary requests are processed with the given binary
+    protocol, which may be the accelerated protocol.
+    """
+
+    def __init__(
+            self,
+            handler,
+            protocol="binary",
+            allow_compact=True,
+            allow_framed=True,
+            max_frame_size=16777216):
+        """ChatServiceProcessor constructor.
+
+        Args:
+            handler: ChatServiceHandler object
+            protocol: protocol with which to process binary
+                requests, 'binary' or 'accelerated'.
+            allow_compact: flag indicating if compact
+                protocol requests are allowed.
+            allow_framed: flag indicating if framed
+                transport requests are allowed.
+            max_frame_size: maximum framed request size in bytes.
+        """
+        TChatService.Processor.__init__(self, handler)
+        self._processMap["getMessages"] = ChatServiceProcessor.process_getMessages
+        self.binary_protocol_factory = protocol_factory(protocol)
+        self.compact_protocol_factory = protocol_factory("compact")
+        self.allow_compact = allow_compact
+        self.allow_framed = allow_framed
+        self.max_frame_size = max_frame_size
+
+    def process(self, iprot, oprot):
+        """Process a single request.
+
+        Args:
+            iprot: server input protocol
+            oprot: server output protocol
+        """
+        first = iprot.trans.readAll(1)
+
+        if first == BINARY_VERSION_BYTE:
+            #Read the remainder of the message header directly,
+            #so that the server's transport, which may support
+            #accelerated decoding, is used as is.
+            iprot = self.binary_protocol_factory.getProtocol(iprot.trans)
+            oprot = self.binary_protocol_factory.getProtocol(oprot.trans)
+            header = struct.unpack("!i", first + iprot.trans.readAll(3))[0]
+            version = header & TBinaryProtocol.TBinaryProtocol.VERSION_MASK
+            if version != TBinaryProtocol.TBinaryProtocol.VERSION_1:
+                raise TTransport.TTransportException(
+                        message="invalid binary protocol version: %s" % version)
+            name = iprot.readString()
+            seqid = iprot.readI32()
+            return self._dispatch(name, seqid, iprot, oprot)
+
+        elif first == COMPACT_PROTOCOL_ID:
+            if not self.allow_compact:
+                raise TTransport.TTransportException(
+                        message="compact protocol not allowed")
+            iprot = self.compact_protocol_factory.getProtocol(
+                    PrefixTransport(first, iprot.trans))
+            oprot = self.compact_protocol_factory.getProtocol(oprot.trans)
+
+        else:
+            size = struct.unpack("!i", first + iprot.trans.readAll(3))[0]
+            if size <= 0 or size > self.max_frame_size:
+                raise TTransport.TTransportException(
+                        message="invalid message size: %s" % size)
+            fifth = iprot.trans.readAll(1)
+
+            if fifth not in FRAMED_MESSAGE_BYTES:
+                #Non-strict binary message, whose size
+                #is the length of the method name.
+                iprot = self.binary_protocol_factory.getProtocol(iprot.trans)
+                oprot = self.binary_protocol_factory.getProtocol(oprot.trans)
+                name = fifth + iprot.trans.readAll(size - 1)
+                iprot.readByte()
+                seqid = iprot.readI32()
+                return self._dispatch(name, seqid, iprot, oprot)
+
+            if not self.allow_framed:
+                raise TTransport.TTransportException(
+                        message="framed transport not allowed")
+            frame = fifth + iprot.trans.readAll(size - 1)
+
+            factory = self.binary_protocol_factory
+            if frame[:1] == COMPACT_PROTOCOL_ID:
+                if not self.allow_compact:
+                    raise TTransport.TTransportException(
+                            message="compact protocol not allowed")
+                factory = self.compact_protocol_factory
+            iprot = factory.getProtocol(TTransport.TMemoryBuffer(frame))
+            oprot = factory.getProtocol(TTransport.TFramedTransport(oprot.trans))
+
+        return TChatService.Processor.process(self, iprot, oprot)
+
+    def _dispatch(self, name, seqid, iprot, oprot):
+        """Dispatch request whose message header has been read.
+
+        Args:
+            name: method name
+            seqid: message sequence id
+            iprot: input protocol
+            oprot: output protocol
+        """
+        if name not in self._processMap:
+            iprot.skip(TType.STRUCT)
+            iprot.readMessageEnd()
+            x = TApplicationException(TApplicationException.UNKNOWN_METHOD,
+                    "Unknown function %s" % name)
+            oprot.writeMessageBegin(name, TMessageType.EXCEPTION, seqid)
+            x.write(oprot)
+            oprot.writeMessageEnd()
+            oprot.trans.flush()
+            return
+        else:
+            self._processMap[name](self, seqid, iprot, oprot)
+        return True
+
+    def process_getMessages(self, seqid, iprot, oprot):
+        args = TChatService.getMessages_args()
+        args.read(iprot)
+        iprot.readMessageEnd()
+        result = GetMessagesResult()
+        try:
+            result.success = self._handler.getMessages(
+                    args.requestContext,
+                    args.chatToken,
+                    args.asOf,
+                    args.block,
+                    args.timeout)
+        except UnavailableException as unavailableException:
+            result.unavailableException = unavailableException
+        except InvalidChatException as invalidChatException:
+            result.invalidChatException = invalidChatException
+        oprot.writeMessageBegin("getMessages", TMessageType.REPLY, seqid)
+        result.write(oprot)
+        oprot.writeMessageEnd()
+        oprot.trans.flush()
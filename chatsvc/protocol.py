@@ -0,0 +1,240 @@
+import socket
+from contextlib import contextmanager
+
+import gevent.coros
+import gevent.queue
+import gevent.socket
+from thrift.Thrift import TException
+from thrift.protocol import TBinaryProtocol, TCompactProtocol
+from thrift.protocol.TProtocol import TProtocolException
+from thrift.transport import TSocket, TTransport
+
+#dict of {name: protocol factory} of supported protocols
+PROTOCOL_FACTORIES = {
+    "binary": TBinaryProtocol.TBinaryProtocolFactory(),
+    "accelerated": TBinaryProtocol.TBinaryProtocolAcceleratedFactory(),
+    "compact": TCompactProtocol.TCompactProtocolFactory()
+}
+
+#dict of {name: transport factory} of supported transports
+TRANSPORT_FACTORIES = {
+    "buffered": TTransport.TBufferedTransportFactory(),
+    "framed": TTransport.TFramedTransportFactory()
+}
+
+def protocol_factory(name):
+    """Get protocol factory by name.
+
+    Args:
+        name: protocol name, 'binary', 'accelerated', or 'compact'.
+    Returns:
+        Thrift protocol factory object.
+    Raises:
+        ValueError if the protocol is not supported.
+    """
+    if name not in PROTOCOL_FACTORIES:
+        raise ValueError("unsupported thrift protocol: %s" % name)
+    return PROTOCOL_FACTORIES[name]
+
+def transport_factory(name):
+    """Get transport factory by name.
+
+    Args:
+        name: transport name, 'buffered' or 'framed'.
+    Returns:
+        Thrift transport factory object.
+    Raises:
+        ValueError if the transport is not supported.
+    """
+    if name not in TRANSPORT_FACTORIES:
+        raise ValueError("unsupported thrift transport: %s" % name)
+    return TRANSPORT_FACTORIES[name]
+
+
+class PoolExhaustedException(Exception):
+    """Raised when no pooled connection becomes available
+    within the requested timeout."""
+    pass
+
+
+class PrefixTransport(TTransport.TTransportBase):
+    """Read only transport which returns the given prefix
+    before reading from the underlying transport.
+
+    This allows bytes read to detect the protocol of a
+    request to be read again by the detected protocol.
+    """
+
+    def __init__(self, prefix, trans):
+        """PrefixTransport constructor.
+
+        Args:
+            prefix: string of bytes to read first
+            trans: underlying Thrift transport
+        """
+        self.prefix = prefix
+        self.trans = trans
+
+    def isOpen(self):
+        return self.trans.isOpen()
+
+    def read(self, sz):
+        if self.prefix:
+            result = self.prefix[:sz]
+            self.prefix = self.prefix[sz:]
+            return result
+        return self.trans.read(sz)
+
+
+class GSocket(TSocket.TSocket):
+    """Thrift socket which connects with gevent sockets."""
+
+    def open(self):
+        try:
+            self.handle = gevent.socket.create_connection(
+                    (self.host, self.port), self._timeout)
+        except socket.error as error:
+            raise TTransport.TTransportException(
+                    TTransport.TTransportException.NOT_OPEN,
+                    "Could not connect to %s:%d (%s)" % (self.host, self.port, error))
+
+
+class ServiceProxyPool(object):
+    """Service proxy pool with configurable transport and protocol.
+
+    Pool of Thrift clients, connected with gevent sockets, which
+    are created on demand up to max_connections. Clients whose
+    request raises a declared service exception, or a
+    TApplicationException, are returned to the pool, since the
+    response was read in full. Clients whose request fails
+    otherwise, i.e. with a transport or protocol error, or
+    which are interrupted mid request, are closed.
+    """
+
+    def __init__(
+            self,
+            address,
+            port,
+            max_connections,
+            service_class,
+            transport="buffered",
+            protocol="binary",
+            timeout=None,
+            client_class=None):
+        """ServiceProxyPool constructor.
+
+        Args:
+            address: service address
+            port: service port
+            max_connections: maximum number of connections
+            service_class: generated Thrift service module
+            transport: transport name, 'buffered' or 'framed'.
+            protocol: protocol name, 'binary', 'accelerated',
+                or 'compact'.
+            timeout: optional socket timeout in seconds
+            client_class: optional Thrift client class to use
+                in place of service_class.Client.
+        """
+        self.address = address
+        self.port = port
+        self.service_class = service_class
+        self.client_class = client_class or service_class.Client
+        self.transport_factory = transport_factory(transport)
+        self.protocol_factory = protocol_factory(protocol)
+        self.timeout = timeout
+        self.clients = gevent.queue.Queue()
+        self.semaphore = gevent.coros.Semaphore(max_connections)
+        self.closed = False
+
+    def _connect(self):
+        """Create a new connected client.
+
+        Returns:
+            Thrift service Client object.
+        """
+        gsocket = GSocket(self.address, self.port)
+        if self.timeout is not None:
+            gsocket.setTimeout(self.timeout * 1000)
+        transport = self.transport_factory.getTransport(gsocket)
+        protocol = self.protocol_factory.getProtocol(transport)
+        transport.open()
+        return self.client_class(protocol)
+
+    def _close_client(self, client):
+        """Close client's transport.
+
+        Args:
+            client: Thrift service Client object
+        """
+        try:
+            client._iprot.trans.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def get(self, timeout=None):
+        """Get a client from the pool.
+
+        This method should be used as a context manager, which
+        will return the client to the pool upon exit.
+
+        Args:
+            timeout: optional number of seconds to wait for a
+                connection if max_connections are in use. If 0,
+                fail immediately. If None, wait indefinitely.
+        Returns:
+            Thrift service Client object context manager.
+        Raises:
+            PoolExhaustedException if no connection became
+            available within timeout.
+        """
+        if not self.semaphore.acquire(blocking=timeout != 0, timeout=timeout):
+            raise PoolExhaustedException("no connections available to %s:%s" % (
+                self.address, self.port))
+
+        client = None
+        try:
+            try:
+                client = self.clients.get_nowait()
+            except gevent.queue.Empty:
+                client = self._connect()
+
+            try:
+                yield client
+            except TException as error:
+                if not isinstance(error, (TTransport.TTransportException, TProtocolException)):
+                    self._put_client(client)
+                    client = None
+                raise
+            self._put_client(client)
+            client = None
+        finally:
+            if client is not None:
+                self._close_client(client)
+            self.semaphore.release()
+
+    def _put_client(self, client):
+        """Return client to the pool.
+
+        Clients returned after the pool is closed are closed.
+
+        Args:
+            client: Thrift service Client object
+        """
+        if self.closed:
+            self._close_client(client)
+        else:
+            self.clients.put(client)
+
+    def close(self):
+        """Close the pool's idle clients.
+
+        Clients currently in use are closed when
+        they are returned to the pool.
+        """
+        self.closed = True
+        while True:
+            try:
+                self._close_client(self.clients.get_nowait())
+            except gevent.queue.Empty:
+                break
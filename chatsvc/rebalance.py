@@ -0,0 +1,390 @@
+import logging
+import time
+
+import gevent
+import gevent.queue
+
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+from chat import Chat, materialize
+from scheduler import ReplicationPriority
+from snapshot import SerializedChatSnapshot
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Tokens are added to the bucket at the given rate, up to the
+    bucket's capacity. Consuming more tokens than are available
+    blocks the caller until the tokens would have been added.
+    Requests larger than the capacity are allowed, and leave the
+    bucket in debt, so that subsequent requests are delayed.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """TokenBucket constructor.
+
+        Args:
+            rate: number of tokens added per second. If None,
+                consuming tokens will never block.
+            capacity: optional maximum number of tokens in the
+                bucket. Defaults to rate (1 second burst).
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+
+    def consume(self, amount=1):
+        """Consume tokens, blocking until they are available.
+
+        Args:
+            amount: number of tokens to consume.
+        Returns:
+            number of seconds the caller was delayed.
+        """
+        if not self.rate:
+            return 0
+
+        now = time.time()
+        self.tokens = min(self.capacity,
+                self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        self.tokens -= amount
+
+        delay = 0
+        if self.tokens < 0:
+            delay = -self.tokens / float(self.rate)
+            gevent.sleep(delay)
+        return delay
+
+
+class RebalanceProgress(object):
+    """Rebalance progress for a single hashring change."""
+
+    def __init__(self, generation):
+        """RebalanceProgress constructor.
+
+        Args:
+            generation: hashring change number
+        """
+        self.generation = generation
+        self.started = time.time()
+        self.finished = None
+        self.chats_queued = 0
+        self.chats_completed = 0
+        self.chats_failed = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        """Convert progress to dict.
+
+        Returns:
+            dict of progress counters.
+        """
+        end = self.finished or time.time()
+        return {
+            "generation": self.generation,
+            "converged": self.finished is not None,
+            "duration": end - self.started,
+            "chats_queued": self.chats_queued,
+            "chats_completed": self.chats_completed,
+            "chats_failed": self.chats_failed,
+            "messages": self.messages,
+            "bytes": self.bytes
+        }
+
+    def __str__(self):
+        return "generation=%s, chats=%s/%s, failed=%s, messages=%s, bytes=%s" % (
+                self.generation,
+                self.chats_completed,
+                self.chats_queued,
+                self.chats_failed,
+                self.messages,
+                self.bytes)
+
+
+class Rebalancer(object):
+    """Background rebalancer.
+
+    Replicates chats to the nodes which need a copy of them
+    following a hashring change. Rebalancing uses its own
+    unbounded queue, so that hashring observers never block.
+    Each chunk is sent through the replicator's REBALANCE
+    priority class, so that rebalance traffic shares the
+    replication connections with live replications according
+    to the priority weights, rather than competing with them.
+
+    Rebalances are limited to chats_per_second and
+    bytes_per_second, and large chats are transferred in
+    chunks of chunk_size messages. Since the replication
+    connection to a node is released between chunks,
+    live replications to the node can proceed while a
+    large chat is being transferred.
+    """
+
+    STOP_ITEM = object()
+
+    class RebalanceItem(object):
+        """Chat needing to be rebalanced to the given nodes."""
+
+        def __init__(self, chat, nodes):
+            """RebalanceItem constructor.
+
+            Args:
+                chat: Chat object
+                nodes: list of ServiceHashringNode objects
+                    needing a copy of the chat.
+            """
+            self.chat = chat
+            self.nodes = list(nodes)
+
+        def merge(self, nodes):
+            """Merge additional nodes into this item.
+
+            Args:
+                nodes: list of ServiceHashringNode objects
+            """
+            service_keys = set(n.service_info.key for n in self.nodes)
+            for node in nodes:
+                if node.service_info.key not in service_keys:
+                    service_keys.add(node.service_info.key)
+                    self.nodes.append(node)
+
+    def __init__(
+            self,
+            replicator,
+            size=1,
+            chats_per_second=None,
+            bytes_per_second=None,
+            chunk_size=500):
+        """Rebalancer constructor.
+
+        Args:
+            replicator: Replicator object whose replication
+                connections will be used to transfer chats.
+            size: number of greenlets to use for rebalancing
+            chats_per_second: optional maximum number of chats
+                to rebalance per second.
+            bytes_per_second: optional maximum number of
+                serialized snapshot bytes to send per second.
+            chunk_size: maximum number of messages to
+                transfer in a single replication.
+        """
+        self.replicator = replicator
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chats_bucket = TokenBucket(chats_per_second)
+        self.bytes_bucket = TokenBucket(bytes_per_second)
+        self.queue = gevent.queue.Queue()
+
+        #dict of {chat_token: RebalanceItem} for queued items
+        self.pending = {}
+
+        #number of items currently being rebalanced
+        self.active = 0
+
+        self.progress = RebalanceProgress(0)
+        self.workers = []
+        self.running = False
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+    def start(self):
+        """Start rebalancer."""
+        if not self.running:
+            self.running = True
+            for i in range(0, self.size):
+                worker = gevent.spawn(self.run)
+                self.workers.append(worker)
+
+    def run(self):
+        """Run rebalancer.
+
+        Workers run until they dequeue a stop item, so that
+        rebalances queued before stop() are completed.
+        """
+        while True:
+            try:
+                item = self.queue.get()
+
+                if item is self.STOP_ITEM:
+                    break
+
+                self.pending.pop(item.chat.token, None)
+                self.active += 1
+                try:
+                    self._rebalance_item(item)
+                finally:
+                    self.active -= 1
+                    self._check_converged()
+
+            except gevent.GreenletExit:
+                break
+            except Exception as error:
+                self.log.exception(error)
+
+    def stop(self):
+        """Stop rebalancer.
+
+        Stop items are queued behind the queued rebalances,
+        i.e. the handoff of our chats following the removal
+        of our hashring positions, so that the workers exit
+        once the queued rebalances have completed.
+        """
+        if self.running:
+            self.running = False
+            for i in range(0, self.size):
+                self.queue.put(self.STOP_ITEM)
+
+    def kill(self):
+        """Stop rebalancer without completing queued rebalances."""
+        self.stop()
+        gevent.killall(self.workers)
+
+    def join(self, timeout=None):
+        """Join rebalancer.
+
+        Args:
+            timeout: optional maximum number of seconds to wait
+                for the completion of all greenlets.
+        """
+        gevent.joinall(self.workers, timeout)
+
+    def begin(self):
+        """Begin rebalancing for a new hashring change.
+
+        Progress counters are reset, and chats still queued
+        from a previous hashring change are carried over.
+        """
+        previous = self.progress
+        self.progress = RebalanceProgress(previous.generation + 1)
+        self.progress.chats_queued = len(self.pending)
+        if previous.finished is None and previous.chats_queued:
+            self.log.info("Rebalance superseded: %s" % previous)
+
+    def rebalance(self, chat, nodes):
+        """Queue the chat to be rebalanced to the given nodes.
+
+        If the chat is already queued, the nodes will be
+        merged into the queued item.
+
+        Args:
+            chat: Chat object
+            nodes: list of ServiceHashringNode objects
+                needing a copy of the chat.
+        """
+        item = self.pending.get(chat.token)
+        if item is not None:
+            item.merge(nodes)
+        else:
+            item = self.RebalanceItem(chat, nodes)
+            self.pending[chat.token] = item
+            self.progress.chats_queued += 1
+            self.queue.put(item)
+
+    def end(self):
+        """End queueing for the current hashring change."""
+        self.log.info("Rebalancing %s chat(s) (generation=%s)" % (
+            self.progress.chats_queued, self.progress.generation))
+        self._check_converged()
+
+    def is_converged(self):
+        """Check if all queued rebalances have completed.
+
+        Returns:
+            True if there is no rebalancing work remaining.
+        """
+        return not self.pending and not self.active
+
+    def _check_converged(self):
+        """Mark progress finished once rebalancing has converged."""
+        if self.progress.finished is None and self.is_converged():
+            self.progress.finished = time.time()
+            self.log.info("Rebalance converged in %.2fs: %s" % (
+                self.progress.finished - self.progress.started, self.progress))
+
+    def _build_chunk_snapshot(self, chat, messages, sequence=None):
+        """Build chunk snapshot.
+
+        Chunks preceding the final chunk contain messages only
+        and are not sequenced, so they are merged into the replica
+        without affecting its state. The final chunk contains
+        the chat state and the sequence of the transfer.
+
+        Args:
+            chat: Chat object
+            messages: list of Message objects in the chunk
+            sequence: chat sequence for the final chunk,
+                None otherwise.
+        Returns:
+            ChatSnapshot object
+        """
+        state = ChatState(token=chat.state.token, messages=messages)
+        if sequence is None:
+            return ChatSnapshot(fullSnapshot=False, state=state)
+
+        for field in Chat.STATE_FIELDS:
+            setattr(state, field, getattr(chat.state, field))
+        return ChatSnapshot(
+                fullSnapshot=True,
+                state=state,
+                epoch=chat.epoch,
+                sequence=sequence)
+
+    def _rebalance_item(self, item):
+        """Transfer chat to the item's nodes.
+
+        Args:
+            item: RebalanceItem object
+        """
+        chat = item.chat
+        self.chats_bucket.consume(1)
+
+        #Capture the sequence along with the messages, so that
+        #changes made during the transfer are sent by the next
+        #delta replication to the node.
+        sequence = chat.sequence
+        messages = list(chat.state.messages)
+
+        #Chunks of MessageRecord objects, which
+        #are materialized as each chunk is sent.
+        chunks = [messages[i:i+self.chunk_size]
+                for i in range(0, len(messages), self.chunk_size)] or [[]]
+
+        nodes = list(item.nodes)
+        for index, chunk in enumerate(chunks):
+            last = index == len(chunks) - 1
+            snapshot = SerializedChatSnapshot(self._build_chunk_snapshot(
+                chat, materialize(chunk), sequence if last else None))
+
+            for node in list(nodes):
+                self.bytes_bucket.consume(len(snapshot.data))
+                try:
+                    self._send(node, snapshot)
+                    self.progress.messages += len(chunk)
+                    self.progress.bytes += len(snapshot.data)
+                except Exception as error:
+                    self.log.error("Rebalance of %s to %s failed: %s" % (
+                        chat.token, node, error))
+                    nodes.remove(node)
+
+        for node in nodes:
+            chat.acknowledge(node.service_info.key, sequence)
+
+        if len(nodes) == len(item.nodes):
+            self.progress.chats_completed += 1
+        else:
+            self.progress.chats_failed += 1
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Rebalanced %s (messages=%s, chunks=%s): %s" % (
+                chat.token, len(messages), len(chunks), self.progress))
+
+    def _send(self, node, snapshot):
+        """Send snapshot to node.
+
+        Args:
+            node: ServiceHashringNode object
+            snapshot: SerializedChatSnapshot object
+        """
+        self.replicator.send(node, snapshot, ReplicationPriority.REBALANCE)
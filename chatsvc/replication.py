@@ -1,5 +1,6 @@
 import abc
 import logging
+import time
 from collections import deque
 
 import gevent
@@ -7,11 +8,18 @@ import gevent.coros
 import gevent.event
 import gevent.queue
 
-from trsvcscore.proxy.basic import BasicServiceProxyPool
 from trsvcscore.hashring.base import ServiceHashringEvent
 from tridlcore.gen.ttypes import RequestContext
 from trchatsvc.gen import TChatService
-from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot, ReplicationGapException
+
+from chat import Chat
+from handoff import HintedHandoff
+from preference import PreferenceListCache
+from protocol import ServiceProxyPool
+from rebalance import Rebalancer
+from scheduler import PriorityScheduler, ReplicationPriority
+from snapshot import ChatServiceClient, SerializedChatSnapshot
 
 def node_to_string(node):
     """Helper method to convert hashring node to string.
@@ -139,6 +147,56 @@ class ReplicationAsyncResult(gevent.event.AsyncResult):
         return len(self.exceptions)
 
 
+class ReplicationAsyncResultGroup(object):
+    """Group of async replication results.
+
+    This class allows a single replication to update multiple
+    ReplicationAsyncResult objects, which is useful when several
+    replications of the same chat are coalesced. Each result
+    will continue to be governed by its own W and max_errors.
+    """
+    def __init__(self, results):
+        """ReplicationAsyncResultGroup constructor.
+
+        Args:
+            results: list of ReplicationAsyncResult objects
+                with the same N.
+        """
+        self.results = results
+
+    def set(self, value=None):
+        """Add a replication result to all results."""
+        for result in self.results:
+            result.set(value)
+
+    def set_exception(self, exception):
+        """Add an exceptional replication result to all results."""
+        for result in self.results:
+            result.set_exception(exception)
+
+    def fail(self, exception):
+        """Fail all results whose W is not yet satisfied."""
+        for result in self.results:
+            if not result.w_satisfied():
+                result.fail(exception)
+
+    def w_satisfied(self):
+        """Check if W writes have been completed for all results."""
+        return all(result.w_satisfied() for result in self.results)
+
+    def n_satisfied(self):
+        """Check if N writes have been completed for all results."""
+        return all(result.n_satisfied() for result in self.results)
+
+    def num_completed(self):
+        """Get the number of completed replications."""
+        return min(result.num_completed() for result in self.results)
+
+    def num_errors(self):
+        """Get the number of failed replications."""
+        return max(result.num_errors() for result in self.results)
+
+
 class Replicator(object):
     """Abstract base Replicator class.
 
@@ -154,7 +212,10 @@ class Replicator(object):
             N,
             W,
             max_connections_per_service=1,
-            allow_same_host_replications=False):
+            allow_same_host_replications=False,
+            preference_lists=None,
+            transport=None,
+            protocol=None):
         """Replicator constructor.
 
         Args:
@@ -176,6 +237,15 @@ class Replicator(object):
             allow_same_host_replications: boolean indicating if replications
                 are allowed to reside in a different process on the
                 same host.
+            preference_lists: optional PreferenceListCache object
+                to use for preference list lookups. If not provided,
+                a new cache will be created for the hashring.
+            transport: optional transport name, 'buffered' or
+                'framed', to use for replication connections.
+                Defaults to 'buffered'.
+            protocol: optional protocol name, 'binary',
+                'accelerated', or 'compact', to use for
+                replication connections. Defaults to 'accelerated'.
         """
         self.service = service
         self.hashring = hashring
@@ -184,9 +254,16 @@ class Replicator(object):
         self.W = W
         self.max_connections_per_service = max_connections_per_service
         self.allow_same_host_replications = allow_same_host_replications
+        self.preference_lists = preference_lists or PreferenceListCache(hashring)
+        self.transport = transport
+        self.protocol = protocol
 
         self.service_proxy_pools = {}
         self.service_info = service.info()
+
+        #optional HintedHandoff object to store the
+        #messages of failed replications.
+        self.handoff = None
         self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
 
         #add hashring observer
@@ -199,7 +276,7 @@ class Replicator(object):
         return
     
     @abc.abstractmethod
-    def replicate(self, chat, messages, N=None, W=None, nodes=None):
+    def replicate(self, chat, messages, N=None, W=None, nodes=None, priority=None):
         """Replicate messages for the specified chat.
         
         Replicates messages for the specified chat. Upon success,
@@ -220,6 +297,10 @@ class Replicator(object):
                 as the replication preference list. If not
                 provided, the hashring will be used to
                 determine the preference list.
+            priority: optional ReplicationPriority class. If not
+                provided, replications to the hashring preference
+                list will be INTERACTIVE, and replications to
+                explicit nodes will be REBALANCE.
 
         Returns:
             ReplicationAsyncResult object
@@ -265,7 +346,7 @@ class Replicator(object):
         """
         return
 
-    def _build_request_context(self):
+    def build_request_context(self):
         """Build RequestContext object for use with service calls.
 
         Returns:
@@ -277,40 +358,86 @@ class Replicator(object):
                 sessionId="sessionid",
                 context="")
 
-    def _build_chat_snapshot(self, chat, messages=None):
+    def _build_chat_snapshot(self, chat, node=None, full_snapshot=False):
         """Build ChatSnapshot object for replication.
 
+        If the node has acknowledged a previous replication
+        of the chat, a delta snapshot containing only the state
+        fields and messages changed since the acknowledged
+        sequence will be built. Otherwise, a full snapshot
+        will be built.
+
         Args:
             chat: Chat object
-            messages: list of Message objects
-            full_snapshot: Option flag indicating if this is a full or
-                partial snapshot.
+            node: optional ServiceHashringNode the snapshot
+                will be replicated to.
+            full_snapshot: optional flag indicating that a full
+                snapshot should be built regardless of the
+                node's acknowledged sequence.
 
         Returns:
-            ReplicationSnapshot object
+            ChatSnapshot object
         """
-        messages = messages or []
-        full_snapshot = len(chat.state.messages) == len(messages)
+        base_sequence = None
+        if node is not None and not full_snapshot:
+            base_sequence = chat.replica_sequences.get(node.service_info.key)
+
+        if base_sequence is None:
+            fields = Chat.STATE_FIELDS
+            messages = chat.get_messages()
+        else:
+            fields, messages = chat.changes_since(base_sequence)
 
         state = ChatState(
                 token=chat.state.token,
-                status=chat.state.status,
-                maxDuration=chat.state.maxDuration,
-                maxParticipants=chat.state.maxParticipants,
-                startTimestamp=chat.state.startTimestamp,
-                endTimestamp=chat.state.endTimestamp,
-                users=chat.state.users,
-                persisted=chat.state.persisted,
-                session=chat.state.session,
-                messages=messages)
+                messages=list(messages))
+        for field in fields:
+            setattr(state, field, getattr(chat.state, field))
 
         snapshot = ChatSnapshot(
-                fullSnapshot=full_snapshot,
-                state=state)
+                fullSnapshot=base_sequence is None,
+                state=state,
+                epoch=chat.epoch,
+                sequence=chat.sequence,
+                baseSequence=base_sequence)
 
         return snapshot
 
-    def _service_proxy_pool(self, node):
+    def _serialized_chat_snapshot(self, chat, node, snapshots, full_snapshot=False):
+        """Get SerializedChatSnapshot object for replication.
+
+        Snapshots are shared between the nodes of a single
+        replication which need identical snapshots, i.e. nodes
+        which have acknowledged the same chat sequence, so
+        that the snapshot is only built and serialized once.
+
+        Args:
+            chat: Chat object
+            node: ServiceHashringNode the snapshot will be
+                replicated to.
+            snapshots: dict of {(base_sequence, sequence):
+                SerializedChatSnapshot} to share snapshots
+                between nodes.
+            full_snapshot: optional flag indicating that a full
+                snapshot should be built regardless of the
+                node's acknowledged sequence.
+
+        Returns:
+            SerializedChatSnapshot object
+        """
+        base_sequence = None
+        if not full_snapshot:
+            base_sequence = chat.replica_sequences.get(node.service_info.key)
+
+        key = (base_sequence, chat.sequence)
+        snapshot = snapshots.get(key)
+        if snapshot is None:
+            snapshot = SerializedChatSnapshot(
+                    self._build_chat_snapshot(chat, node, full_snapshot))
+            snapshots[key] = snapshot
+        return snapshot
+
+    def service_proxy_pool(self, node):
         """Get service proxy pool for the given hashring node.
 
         Args:
@@ -322,17 +449,18 @@ class Replicator(object):
         """
         if node.service_info.key not in self.service_proxy_pools:
             server_endpoint = node.service_info.default_endpoint()
-            proxy_pool = BasicServiceProxyPool(
-                    node.service_info.name,
+            proxy_pool = ServiceProxyPool(
                     server_endpoint.address,
                     server_endpoint.port,
                     self.max_connections_per_service,
                     TChatService,
-                    is_gevent=True)
+                    transport=self.transport or "buffered",
+                    protocol=self.protocol or "accelerated",
+                    client_class=ChatServiceClient)
             self.service_proxy_pools[node.service_info.key] = proxy_pool
         return self.service_proxy_pools[node.service_info.key]
 
-    def _is_remote_node(self, node):
+    def is_remote_node(self, node):
         """Check if node is remotely located.
 
         Note that a remote node may be a  different service
@@ -346,7 +474,7 @@ class Replicator(object):
         """
         return node.service_info.key != self.service_info.key
 
-    def _preference_list(self, chat_token, hashring=None):
+    def preference_list(self, chat_token, hashring=None):
         """Get the replication preference list for the given chat.
         
         Note that if self.allow_same_host_replications is True,
@@ -368,7 +496,7 @@ class Replicator(object):
         #If self.allow_same_host_replications is set to True,
         #we should not merge nodes.
         merge_nodes = not self.allow_same_host_replications
-        return self.hashring.preference_list(chat_token, hashring, merge_nodes=merge_nodes)
+        return self.preference_lists.preference_list(chat_token, hashring, merge_nodes=merge_nodes)
 
     def _replication_nodes(self, previous_hashring, current_hashring, chat_token):
         """Determine nodes needing a replication based on a hashring change.
@@ -398,13 +526,13 @@ class Replicator(object):
         #was previously in the preference list, is occupying a new
         #position on the hashring (closer to chat) which
         #has replaced its old position.
-        current_preference_list = self._preference_list(chat_token, current_hashring)[:self.N]
-        previous_preference_list = self._preference_list(chat_token, previous_hashring)[:self.N]
+        current_preference_list = self.preference_list(chat_token, current_hashring)[:self.N]
+        previous_preference_list = self.preference_list(chat_token, previous_hashring)[:self.N]
         previous_service_keys = {n.service_info.key: True for n in previous_preference_list}
         
         #Check if we are currently or were previously responsible for this chat
-        if (previous_preference_list and not self._is_remote_node(previous_preference_list[0])) or \
-           (current_preference_list and not self._is_remote_node(current_preference_list[0])):
+        if (previous_preference_list and not self.is_remote_node(previous_preference_list[0])) or \
+           (current_preference_list and not self.is_remote_node(current_preference_list[0])):
             
             # Check if any nodes needs replication
             if previous_preference_list != current_preference_list:
@@ -481,7 +609,8 @@ class Replicator(object):
                 with replication results.
         """
         workers = []
-        preference_list = nodes or self._preference_list(chat.token)
+        snapshots = {}
+        preference_list = nodes or self.preference_list(chat.token)
         preference_queue = deque(preference_list)
         
         #Use a semaphore to limit the number of concurrent replications.
@@ -505,8 +634,9 @@ class Replicator(object):
 
                 #Spawn a greenlet to perform the replication
                 #if this is not us (remote node)
-                if self._is_remote_node(node):
-                    worker = gevent.spawn(self._replicate_to_node, chat, messages, node, result)
+                if self.is_remote_node(node):
+                    worker = gevent.spawn(self._replicate_to_node,
+                            chat, messages, node, result, snapshots)
                     worker.link(lambda greenlet: semaphore.release())
                     workers.append(worker)
                 else:
@@ -534,11 +664,13 @@ class Replicator(object):
                     error_message = "uncompleted %s" % message
                     self.log.warn(error_message)
 
-    def _replicate_to_node(self, chat, messages, node, result):
+    def _replicate_to_node(self, chat, messages, node, result, snapshots=None):
         """Replicate chat messages to a single node.
 
         This method will peform a single replication to exactly one node, 
-        using the service_proxy_pool for the connection.
+        using the service_proxy_pool for the connection. The replicated
+        snapshot will contain all changes to the chat which the node
+        has not yet acknowledged, which always includes messages.
 
         Args:
             chat: Chat object
@@ -546,27 +678,56 @@ class Replicator(object):
             node: ServiceHashringNode to replicate messages to.
             result: ReplicationAsyncResult object to update 
                 with the replication result.
+            snapshots: optional dict of serialized snapshots
+                shared between the nodes of a replication.
         """
+        if snapshots is None:
+            snapshots = {}
+
+        snapshot = None
         try:
-            service_proxy_pool = self._service_proxy_pool(node)
+            service_proxy_pool = self.service_proxy_pool(node)
 
             #Wait for a service proxy to the node to be available.
             #This may be block and is limited by max_service_connections.
             with service_proxy_pool.get() as proxy:
+                context = self.build_request_context()
+                snapshot = self._serialized_chat_snapshot(chat, node, snapshots)
+
                 if self.log.isEnabledFor(logging.DEBUG):
-                    self.log.debug("Replicating %s message(s) to [\n%s\n]" % (len(messages), node_to_string(node)))
+                    self.log.debug("Replicating %s message(s) (full=%s) to [\n%s\n]" % (
+                        len(snapshot.state.messages), snapshot.fullSnapshot, node_to_string(node)))
+
+                try:
+                    proxy.replicate(context, snapshot)
+                except ReplicationGapException:
+                    #Replica is missing changes preceding the
+                    #delta snapshot, so a full snapshot is required.
+                    self.log.warning("Replication gap for %s at %s, sending full snapshot" % (
+                        chat.token, node_to_string(node)))
+                    snapshot = self._serialized_chat_snapshot(
+                            chat, node, snapshots, full_snapshot=True)
+                    proxy.replicate(context, snapshot)
+                
+                chat.acknowledge(node.service_info.key, snapshot.sequence)
 
-                context = self._build_request_context()
-                snapshot = self._build_chat_snapshot(chat, messages)
-                proxy.replicate(context, snapshot)
+                #The snapshot includes all changes since the last
+                #acknowledged replication, and therefore any hinted
+                #messages for the chat.
+                if self.handoff is not None:
+                    self.handoff.discard(node.service_info.key, chat.token)
 
                 #Signal to the result that our replication is completed.
                 result.set(None)
 
                 if self.log.isEnabledFor(logging.DEBUG):
-                    self.log.debug("Done replicating %s message(s) to %s" % (len(messages), node_to_string(node)))
+                    self.log.debug("Done replicating %s message(s) to %s" % (
+                        len(snapshot.state.messages), node_to_string(node)))
         except Exception as error:
             self.log.exception(error)
+            if self.handoff is not None:
+                hinted_messages = snapshot.state.messages if snapshot is not None else messages
+                self.handoff.add(node, chat, hinted_messages)
             result.set_exception(ReplicationException(str(error)))
 
 
@@ -590,8 +751,12 @@ class GreenletPoolReplicator(Replicator):
     STOP_ITEM = object()
 
     class ReplicationItem:
-        """Item representing a replication which needs to be performed."""
-        def __init__(self, chat, messages, N, W, nodes, result):
+        """Item representing a replication which needs to be performed.
+        
+        Replications of the same chat may be coalesced into a single
+        item, in which case the item will have multiple results.
+        """
+        def __init__(self, chat, messages, N, W, nodes, result, priority):
             """ReplicationItem constructor.
                 chat: Chat object
                 messages: list of Message objects needing replication
@@ -608,13 +773,67 @@ class GreenletPoolReplicator(Replicator):
                     used as the replication preference list.
                 result: ReplicationAsyncResult object to be
                     updated with replication results.
+                priority: ReplicationPriority class
             """
             self.chat = chat
-            self.messages = messages
+            self.messages = list(messages or [])
             self.N = N
             self.W = W
             self.nodes = nodes
-            self.result = result
+            self.results = [result]
+            self.priority = priority
+            self.created = time.time()
+            self.started = False
+
+        @property
+        def key(self):
+            """Coalescing key, or None if item cannot be coalesced.
+
+            Only replications using the hashring preference list
+            are coalesced, since replications to explicit nodes
+            are part of a hashring change.
+            """
+            if self.nodes is None:
+                return (self.chat.token, self.N)
+            return None
+
+        def merge(self, messages, W, result, priority):
+            """Merge a replication of the same chat into this item.
+
+            Args:
+                messages: list of Message objects needing replication
+                W: The total number of nodes needing the data
+                    written before the write is considered successful.
+                result: ReplicationAsyncResult object to be
+                    updated with replication results.
+                priority: ReplicationPriority class
+            Returns:
+                True if the item's priority was raised.
+            """
+            self.messages.extend(messages or [])
+            self.W = max(self.W, W)
+            self.results.append(result)
+
+            order = ReplicationPriority.ALL
+            if order.index(priority) < order.index(self.priority):
+                self.priority = priority
+                return True
+            return False
+
+    class SendItem:
+        """Item representing a serialized snapshot which needs
+        to be sent to a single node, i.e. a rebalance chunk.
+        """
+        def __init__(self, node, snapshot):
+            """SendItem constructor.
+
+            Args:
+                node: ServiceHashringNode object
+                snapshot: SerializedChatSnapshot object
+            """
+            self.node = node
+            self.snapshot = snapshot
+            self.result = gevent.event.AsyncResult()
 
     def __init__(
             self,
@@ -626,7 +845,23 @@ class GreenletPoolReplicator(Replicator):
             size,
             max_connections_per_service=1,
             allow_same_host_replications=False,
-            max_queue_size=100):
+            max_queue_size=100,
+            priority_weights=None,
+            preference_lists=None,
+            coalesce=False,
+            coalesce_window=0,
+            rebalance_size=1,
+            rebalance_chats_per_second=None,
+            rebalance_bytes_per_second=None,
+            rebalance_chunk_size=500,
+            handoff_max_hints=100000,
+            handoff_spill_path=None,
+            handoff_probe_interval=30,
+            handoff_batch_size=50,
+            transport=None,
+            protocol=None,
+            send_timeout=30,
+            drain_timeout=30):
         """Replicator constructor.
         Args:
             service: Service object
@@ -649,8 +884,48 @@ class GreenletPoolReplicator(Replicator):
                 are allowed to reside in a different process on the
                 same host.
             max_queue_size: maximum number of ReplicationItem's which
-                can be added to the replication queue before
-                blocking.
+                can be added to the replication queue, per
+                priority class, before blocking.
+            priority_weights: optional dict of {ReplicationPriority:
+                weight} used to share the replication greenlets
+                between priority classes.
+            preference_lists: optional PreferenceListCache object
+                to use for preference list lookups.
+            coalesce: optional flag indicating that replications of
+                the same chat should be coalesced into a single
+                replication while waiting in the queue, or while a
+                prior replication of the chat is in progress.
+            coalesce_window: optional number of seconds to delay
+                coalesced replications in order to allow additional
+                replications of the same chat to be coalesced.
+            rebalance_size: number of greenlets to use for
+                rebalancing chats following hashring changes.
+            rebalance_chats_per_second: optional maximum number
+                of chats to rebalance per second.
+            rebalance_bytes_per_second: optional maximum number
+                of bytes to send per second while rebalancing.
+            rebalance_chunk_size: maximum number of messages to
+                transfer in a single rebalance replication.
+            handoff_max_hints: maximum number of messages from
+                failed replications to hold in memory for replay.
+            handoff_spill_path: optional directory in which to
+                store hints exceeding handoff_max_hints.
+            handoff_probe_interval: number of seconds between
+                hint replay attempts for unreachable services.
+            handoff_batch_size: number of chats to replay
+                before yielding.
+            transport: optional transport name, 'buffered' or
+                'framed', to use for replication connections.
+                Defaults to 'buffered'.
+            protocol: optional protocol name, 'binary',
+                'accelerated', or 'compact', to use for
+                replication connections. Defaults to 'accelerated'.
+            send_timeout: maximum number of seconds to wait
+                for a queued snapshot send to complete.
+            drain_timeout: maximum number of seconds to wait,
+                upon stop(), for queued rebalances and
+                replications to complete before the
+                replication greenlets are stopped.
         """
         super(GreenletPoolReplicator, self).__init__(
                 service,
@@ -659,10 +934,49 @@ class GreenletPoolReplicator(Replicator):
                 N,
                 W,
                 max_connections_per_service,
-                allow_same_host_replications)
+                allow_same_host_replications,
+                preference_lists,
+                transport,
+                protocol)
         self.size = size
-        self.queue = gevent.queue.Queue(max_queue_size)
+        self.send_timeout = send_timeout
+        self.drain_timeout = drain_timeout
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self.priority_weights = priority_weights or {
+            ReplicationPriority.INTERACTIVE: 8,
+            ReplicationPriority.REBALANCE: 2,
+            ReplicationPriority.BACKGROUND: 1
+        }
+        self.queue = PriorityScheduler(self.priority_weights, max_queue_size)
+
+        #dict of {item key: ReplicationItem} for coalescable
+        #items which have not yet started replicating.
+        self.pending = {}
+
+        #set of item keys currently being replicated
+        self.in_flight = set()
+
+        #dict of {item key: Greenlet} of timers holding pending
+        #items for their coalesce_window before they are queued.
+        self.delayed = {}
+
+        self.rebalancer = Rebalancer(
+                self,
+                size=rebalance_size,
+                chats_per_second=rebalance_chats_per_second,
+                bytes_per_second=rebalance_bytes_per_second,
+                chunk_size=rebalance_chunk_size)
+
+        self.handoff = HintedHandoff(
+                self,
+                max_hints=handoff_max_hints,
+                spill_path=handoff_spill_path,
+                probe_interval=handoff_probe_interval,
+                batch_size=handoff_batch_size)
+
         self.workers = []
+        self.stopper = None
         self.running = False
         self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
     
@@ -676,36 +990,210 @@ class GreenletPoolReplicator(Replicator):
             for i in range(0, self.size):
                 worker = gevent.spawn(self.run)
                 self.workers.append(worker)
+            self.rebalancer.start()
+            self.handoff.start()
 
     def run(self):
-        """Run replicator."""
-        while self.running:
+        """Run replicator.
+
+        Workers run until they dequeue a stop item, which
+        stop() queues once queued work has drained.
+        """
+        while True:
             try:
                 item = self.queue.get()
 
                 if item is self.STOP_ITEM:
                     break
                 
+                if isinstance(item, self.SendItem):
+                    self._send_item(item)
+                else:
+                    self._replicate_item(item)
+
+            except Exception as error:
+                self.log.exception(error)
+
+    def _send_item(self, item):
+        """Send item's snapshot to its node.
+
+        Args:
+            item: SendItem object
+        """
+        #The sender has given up waiting on the item.
+        if item.result.ready():
+            return
+
+        try:
+            service_proxy_pool = self.service_proxy_pool(item.node)
+            with service_proxy_pool.get() as proxy:
+                context = self.build_request_context()
+                proxy.replicate(context, item.snapshot)
+            item.result.set(None)
+        except Exception as error:
+            item.result.set_exception(error)
+
+    def send(self, node, snapshot, priority=ReplicationPriority.REBALANCE, timeout=None):
+        """Send a serialized snapshot to a single node.
+
+        The send is queued with the given priority, so that it
+        shares the replication greenlets and connections with
+        other replications according to the priority weights.
+        Blocks until the snapshot has been sent.
+
+        Args:
+            node: ServiceHashringNode object
+            snapshot: SerializedChatSnapshot object
+            priority: ReplicationPriority class
+            timeout: optional maximum number of seconds to wait
+                for the send. If not provided, self.send_timeout
+                will be used.
+        Raises:
+            ReplicationException if the send timed out or the
+            replicator was stopped before the send, or
+            Exception if the snapshot could not be sent.
+        """
+        if timeout is None:
+            timeout = self.send_timeout
+
+        item = self.SendItem(node, snapshot)
+        self.queue.put(item, priority)
+        item.result.wait(timeout)
+        if not item.result.ready():
+            item.result.set_exception(ReplicationException(
+                "send to %s timed out" % node_to_string(node)))
+        item.result.get()
+
+    def _replicate_item(self, item):
+        """Replicate item.
+
+        If coalescing is enabled, replications of the item's
+        chat which are requested while the item is being
+        replicated will be coalesced into a single item,
+        and replicated following the completion of this item,
+        once its coalesce_window has elapsed.
+
+        Args:
+            item: ReplicationItem object
+        """
+        while item is not None:
+            #Items whose priority was raised may be queued twice.
+            if item.started:
+                break
+            item.started = True
+            key = item.key if self.coalesce else None
+
+            if key is not None:
+                if self.pending.get(key) is item:
+                    del self.pending[key]
+                self.in_flight.add(key)
+
+            try:
                 self._coordinate_replication(
                         chat=item.chat,
                         messages=item.messages,
                         N=item.N,
                         W=item.W,
                         nodes=item.nodes,
-                        result=item.result)
+                        result=ReplicationAsyncResultGroup(item.results))
+            finally:
+                item = None
+                if key is not None:
+                    self.in_flight.discard(key)
+                    item = self.pending.get(key)
+                    if item is not None and self._delay_item(item):
+                        item = None
+
+    def _delay_item(self, item):
+        """Delay coalescable item for the remainder of its coalesce_window.
+
+        The window is held by a timer, rather than a replication
+        greenlet, so that delayed items do not occupy workers
+        needed by other priority classes.
 
-            except Exception as error:
-                self.log.exception(error)
+        Args:
+            item: ReplicationItem object
+        Returns:
+            True if the item was delayed, False if its
+            window has elapsed, or the replicator is stopping,
+            and it should be replicated.
+        """
+        delay = item.created + self.coalesce_window - time.time()
+        if delay <= 0 or not self.running:
+            return False
+        self.delayed[item.key] = gevent.spawn_later(delay, self._queue_delayed_item, item)
+        return True
+
+    def _queue_delayed_item(self, item):
+        """Queue item whose coalesce_window has elapsed.
+
+        Args:
+            item: ReplicationItem object
+        """
+        self.delayed.pop(item.key, None)
+        self.queue.put(item, item.priority)
 
     def stop(self):
-        """Stop replicator."""
+        """Stop replicator.
+
+        The replication greenlets are stopped once the rebalancer,
+        i.e. the handoff of our chats following the removal of
+        our hashring positions, and the replication queue have
+        drained, or drain_timeout seconds have elapsed.
+        """
         if self.running:
             self.log.info("Stopping %s(N=%s, W=%s, size=%s) ..." % (
                 self.__class__.__name__, self.N, self.W, self.size))
 
             self.running = False
-            for i in range(0, self.size):
-                self.queue.put(self.STOP_ITEM)
+            self.rebalancer.stop()
+            self.handoff.stop()
+            self.stopper = gevent.spawn(self._drain)
+
+    def _drain(self):
+        """Stop replication greenlets once queued work has drained.
+
+        Queued items which were not replicated before the
+        drain_timeout are failed.
+        """
+        deadline = time.time() + self.drain_timeout
+
+        #Queue items held for their coalesce_window immediately.
+        for key, timer in self.delayed.items():
+            timer.kill()
+            item = self.pending[key]
+            self.queue.put(item, item.priority)
+        self.delayed = {}
+
+        self.rebalancer.join(self.drain_timeout)
+        if not self.rebalancer.is_converged():
+            self.log.warning("rebalance incomplete at shutdown: %s" % \
+                    self.rebalancer.progress)
+            self.rebalancer.kill()
+
+        while self.queue.qsize() and time.time() < deadline:
+            gevent.sleep(0.1)
+
+        #Stop items are queued to the lowest priority class,
+        #following the queued work.
+        for i in range(0, self.size):
+            self.queue.put(self.STOP_ITEM, ReplicationPriority.BACKGROUND)
+        gevent.joinall(self.workers, max(0, deadline - time.time()))
+        gevent.killall(self.workers)
+
+        #Coalesced items waiting on an in flight replication
+        #of their chat are not queued.
+        items = self.queue.clear() + self.pending.values()
+        self.pending = {}
+
+        exception = ReplicationException("replicator stopped")
+        for item in items:
+            if isinstance(item, self.SendItem):
+                if not item.result.ready():
+                    item.result.set_exception(exception)
+            elif item is not self.STOP_ITEM and not item.started:
+                item.started = True
+                ReplicationAsyncResultGroup(item.results).fail(exception)
 
     def join(self, timeout=None):
         """Join replicator.
@@ -717,9 +1205,26 @@ class GreenletPoolReplicator(Replicator):
             timeout: optional maximum number of seconds to wait for the completion
                 of all threads or greenlets.
         """
-        gevent.joinall(self.workers, timeout)
+        greenlets = list(self.workers)
+        if self.stopper:
+            greenlets.append(self.stopper)
+        gevent.joinall(greenlets, timeout)
+        self.rebalancer.join(timeout)
+        self.handoff.join(timeout)
+
+    def stats(self):
+        """Get replication queue statistics.
 
-    def replicate(self, chat, messages, N=None, W=None, nodes=None):
+        Returns:
+            dict containing the queue depth and wait time of
+            each priority class, and the rebalance progress.
+        """
+        return {
+            "queue": self.queue.to_dict(),
+            "rebalance": self.rebalancer.progress.to_dict()
+        }
+
+    def replicate(self, chat, messages, N=None, W=None, nodes=None, priority=None):
         """Replicate messages for the specified chat.
         
         Replicates messages for the specified chat. Upon success,
@@ -740,6 +1245,10 @@ class GreenletPoolReplicator(Replicator):
                 as the replication preference list. If not
                 provided, the hashring will be used to
                 determine the preference list.
+            priority: optional ReplicationPriority class. If not
+                provided, replications to the hashring preference
+                list will be INTERACTIVE, and replications to
+                explicit nodes will be REBALANCE.
 
         Returns:
             ReplicationAsyncResult object
@@ -748,6 +1257,11 @@ class GreenletPoolReplicator(Replicator):
             N = self.N
         if W is None or W == -1:
             W = self.W
+        if priority is None:
+            if nodes is None:
+                priority = ReplicationPriority.INTERACTIVE
+            else:
+                priority = ReplicationPriority.REBALANCE
         
         #Create the async replication result to track replication
         result = ReplicationAsyncResult(N, W)
@@ -761,9 +1275,30 @@ class GreenletPoolReplicator(Replicator):
                     N=N,
                     W=W,
                     nodes=nodes,
-                    result=result)
+                    result=result,
+                    priority=priority)
             
-            self.queue.put(item)
+            key = item.key if self.coalesce else None
+            if key is None:
+                self.queue.put(item, priority)
+            elif key in self.pending:
+                pending_item = self.pending[key]
+                if pending_item.merge(messages, W, result, priority) and \
+                   key not in self.in_flight and key not in self.delayed:
+                    #Requeue the item with its raised priority.
+                    #The stale queue entry will be skipped
+                    #since the item will have been started.
+                    #Delayed items are queued with their raised
+                    #priority once their window elapses.
+                    self.queue.put(pending_item, priority)
+            else:
+                self.pending[key] = item
+                
+                #If the chat is currently being replicated
+                #the item will be replicated upon completion
+                #by the same worker.
+                if key not in self.in_flight and not self._delay_item(item):
+                    self.queue.put(item, priority)
 
         return result
 
@@ -779,6 +1314,10 @@ class GreenletPoolReplicator(Replicator):
         for chat for which it is currently responsible, and,
         also chat for which it was is previously responsible.
 
+        Replications are queued to the rebalancer, which will
+        transfer the chats in the background, so this method
+        does not block on the replication queue.
+
         Args:
             previous_hashring: List of ServiceHashringNode's representing
                 the hashring prior to the node change.
@@ -786,6 +1325,8 @@ class GreenletPoolReplicator(Replicator):
                 the hashring following the node change.
         """
 
+        self.rebalancer.begin()
+
         #Loop through all of the chat to see if we need to
         #replicate any of them to new nodes.
         for chat_token, chat in self.chat_manager.all().items():
@@ -795,12 +1336,6 @@ class GreenletPoolReplicator(Replicator):
             #which we are currently or were previously responsible for.
             replication_nodes = self._replication_nodes(previous_hashring, current_hashring, chat_token)
             if replication_nodes:
-                #Note that we add 1 to N/W, to adjust for our copy of the data.
-                #Adding one to N/W will force the data to be replicated
-                #to all nodes in replication_nodes.
-                self.replicate(
-                        chat=chat,
-                        messages=chat.state.messages,
-                        N=len(replication_nodes)+1,
-                        W=len(replication_nodes)+1,
-                        nodes=replication_nodes)
+                self.rebalancer.rebalance(chat, replication_nodes)
+
+        self.rebalancer.end()
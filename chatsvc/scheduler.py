@@ -0,0 +1,166 @@
+import logging
+import time
+
+import gevent.coros
+import gevent.queue
+
+class ReplicationPriority(object):
+    """Replication priority classes."""
+
+    #Replications which a client is waiting on, i.e. sendMessage.
+    INTERACTIVE = "interactive"
+
+    #Replications resulting from hashring changes.
+    REBALANCE = "rebalance"
+
+    #Replications which no client is waiting on, i.e. following
+    #the persistence of a chat.
+    BACKGROUND = "background"
+
+    #Priority classes ordered from highest to lowest priority.
+    ALL = [INTERACTIVE, REBALANCE, BACKGROUND]
+
+
+class PriorityClassStats(object):
+    """Queue statistics for a single priority class."""
+
+    def __init__(self):
+        self.enqueued = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def to_dict(self, depth):
+        """Convert statistics to dict.
+
+        Args:
+            depth: current queue depth of the priority class.
+        Returns:
+            dict of statistics.
+        """
+        return {
+            "depth": depth,
+            "enqueued": self.enqueued,
+            "dequeued": self.dequeued,
+            "average_wait": self.total_wait / self.dequeued if self.dequeued else 0.0,
+            "max_wait": self.max_wait
+        }
+
+
+class PriorityScheduler(object):
+    """Weighted fair priority queue.
+
+    Items are queued to a bounded queue for their priority class.
+    get() dequeues from the non-empty classes in proportion to their
+    weights, using smooth weighted round robin, so that lower priority
+    classes are never starved while higher priority classes receive
+    most of the dequeues while they have items waiting.
+
+    Queue depth and wait time are tracked for each class.
+    """
+
+    def __init__(self, weights, max_queue_size=None):
+        """PriorityScheduler constructor.
+
+        Args:
+            weights: dict of {priority: weight}. Each priority
+                class must have a positive weight.
+            max_queue_size: optional maximum number of items
+                which can be queued for each priority class
+                before put() blocks.
+        """
+        self.weights = dict(weights)
+        self.queues = {}
+        self.current = {}
+        self.stats = {}
+        for priority in self.weights:
+            self.queues[priority] = gevent.queue.Queue(max_queue_size)
+            self.current[priority] = 0
+            self.stats[priority] = PriorityClassStats()
+
+        #count of items in all queues
+        self.semaphore = gevent.coros.Semaphore(0)
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+    def qsize(self, priority=None):
+        """Get queue depth.
+
+        Args:
+            priority: optional priority class. If not
+                provided, the depth of all classes is returned.
+        Returns:
+            number of queued items.
+        """
+        if priority is not None:
+            return self.queues[priority].qsize()
+        return sum(q.qsize() for q in self.queues.itervalues())
+
+    def put(self, item, priority):
+        """Queue item.
+
+        Blocks if the queue for the priority class is full.
+
+        Args:
+            item: item to queue
+            priority: priority class of the item
+        """
+        self.queues[priority].put((time.time(), item))
+        self.stats[priority].enqueued += 1
+        self.semaphore.release()
+
+    def get(self):
+        """Dequeue the next item, blocking until one is available.
+
+        Returns:
+            queued item.
+        """
+        self.semaphore.acquire()
+        priority = self._next_priority()
+        timestamp, item = self.queues[priority].get_nowait()
+
+        wait = time.time() - timestamp
+        stats = self.stats[priority]
+        stats.dequeued += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        return item
+
+    def clear(self):
+        """Remove all queued items without blocking.
+
+        Returns:
+            list of removed items.
+        """
+        items = []
+        while self.semaphore.acquire(blocking=False):
+            priority = self._next_priority()
+            timestamp, item = self.queues[priority].get_nowait()
+            items.append(item)
+        return items
+
+    def _next_priority(self):
+        """Select the priority class to dequeue from.
+
+        Returns:
+            priority class with the largest current weight
+            among the classes with queued items.
+        """
+        selected = None
+        total = 0
+        for priority, weight in self.weights.iteritems():
+            if not self.queues[priority].empty():
+                self.current[priority] += weight
+                total += weight
+                if selected is None or self.current[priority] > self.current[selected]:
+                    selected = priority
+        self.current[selected] -= total
+        return selected
+
+    def to_dict(self):
+        """Get per class queue statistics.
+
+        Returns:
+            dict of {priority: dict of statistics}
+        """
+        return dict((priority, stats.to_dict(self.qsize(priority)))
+                for priority, stats in self.stats.iteritems())
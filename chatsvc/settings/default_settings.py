@@ -14,6 +14,9 @@ SERVICE_FQDN = socket.gethostname()
 THRIFT_SERVER_ADDRESS = socket.gethostbyname(socket.gethostname())
 THRIFT_SERVER_INTERFACE = "0.0.0.0"
 THRIFT_SERVER_PORT = 9090
+THRIFT_SERVER_PROTOCOL = "accelerated"
+THRIFT_SERVER_ALLOW_COMPACT = True
+THRIFT_SERVER_ALLOW_FRAMED = True
 
 #Database settings
 DATABASE_HOST = "localdev"
@@ -39,6 +42,19 @@ RIAK_SESSION_POOL_SIZE = 4
 #Chat settings
 CHAT_LONG_POLL_WAIT = 10    
 CHAT_ALLOW_REQUEST_FORWARDING = True
+CHAT_REPLICA_READS = False
+CHAT_REPLICA_READS_MAX_STALENESS = 15
+CHAT_SUBSCRIPTION_TTL = 60
+CHAT_SUBSCRIPTION_MAX_QUEUE_SIZE = 1000
+CHAT_SUBSCRIPTION_HANDLE_POLL_INTERVAL = 5
+CHAT_UNKNOWN_TTL = 30
+CHAT_LOAD_BATCH_SIZE = 100
+CHAT_WARMUP = True
+CHAT_WARMUP_MAX_AGE = 14400
+CHAT_WARMUP_DEBOUNCE = 5
+CHAT_MEMORY_BUDGET = 536870912
+CHAT_EVICTION_INTERVAL = 10
+CHAT_COMPLETED_GRACE_PERIOD = 60
 
 #Replication settings
 REPLICATION_N = 1
@@ -48,6 +64,48 @@ REPLICATION_TIMEOUT = 10
 REPLICATION_MAX_CONNECTIONS_PER_SERVICE = 1
 REPLICATION_ALLOW_SAME_HOST = True
 REPLICATION_TIMEOUT = 5
+REPLICATION_COALESCE = True
+REPLICATION_COALESCE_WINDOW = 0
+REPLICATION_INTERACTIVE_WEIGHT = 8
+REPLICATION_REBALANCE_WEIGHT = 2
+REPLICATION_BACKGROUND_WEIGHT = 1
+REPLICATION_TRANSPORT = "buffered"
+REPLICATION_PROTOCOL = "accelerated"
+REPLICATION_SEND_TIMEOUT = 30
+REPLICATION_DRAIN_TIMEOUT = 30
+
+#Rebalance settings
+REBALANCE_POOL_SIZE = 1
+REBALANCE_CHATS_PER_SECOND = 50
+REBALANCE_BYTES_PER_SECOND = 1048576
+REBALANCE_CHUNK_SIZE = 500
+
+#Hinted handoff settings
+HANDOFF_MAX_HINTS = 100000
+HANDOFF_SPILL_PATH = None
+HANDOFF_PROBE_INTERVAL = 30
+HANDOFF_BATCH_SIZE = 50
+
+#Anti-entropy settings
+ANTI_ENTROPY_INTERVAL = 60
+ANTI_ENTROPY_BUCKET_DURATION = 60
+
+#Persistence settings
+PERSISTER_POOL_SIZE = 4
+PERSISTER_SAVE_DELAY = 0.05
+PERSISTER_SAVE_BATCH_SIZE = 50
+PERSISTER_SAVE_RETRIES = 3
+PERSISTER_SAVE_RETRY_DELAY = 0.5
+
+#Forwarding settings
+FORWARDING_MAX_CONNECTIONS_PER_SERVICE = 20
+FORWARDING_MAX_BLOCKING_CONNECTIONS_PER_SERVICE = 100
+#Wait up to half of the long poll wait for a forwarding connection
+#before failing the request with UnavailableException.
+FORWARDING_ACQUIRE_TIMEOUT = CHAT_LONG_POLL_WAIT / 2.0
+FORWARDING_IDLE_TIMEOUT = 300
+FORWARDING_TRANSPORT = None
+FORWARDING_PROTOCOL = None
 
 #Logging settings
 LOGGING = {
@@ -0,0 +1,78 @@
+from thrift.Thrift import TMessageType
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from trchatsvc.gen import TChatService
+
+class SerializedChatSnapshot(object):
+    """Serialized ChatSnapshot.
+
+    Wraps a ChatSnapshot which has been serialized once with the
+    binary protocol, so that the same bytes can be written to
+    the transport of every replica instead of re-encoding the
+    snapshot for each node.
+
+    The wrapper is passed to ChatServiceClient in place of the
+    ChatSnapshot, which writes the serialized bytes for both the
+    binary and accelerated protocols. Attribute access is delegated
+    to the wrapped snapshot, so other protocols, and the generated
+    client, whose accelerated encoder reads the snapshot's fields
+    directly, will continue to encode the snapshot as usual.
+    """
+
+    def __init__(self, snapshot):
+        """SerializedChatSnapshot constructor.
+
+        Args:
+            snapshot: ChatSnapshot object
+        """
+        transport = TTransport.TMemoryBuffer()
+        snapshot.write(TBinaryProtocol.TBinaryProtocolAccelerated(transport))
+        self.snapshot = snapshot
+        self.data = transport.getvalue()
+
+    def __getattr__(self, name):
+        return getattr(self.snapshot, name)
+
+    def write(self, oprot):
+        """Write snapshot to the given protocol.
+
+        Args:
+            oprot: Thrift protocol object
+        """
+        if isinstance(oprot, TBinaryProtocol.TBinaryProtocol):
+            #Binary encoded structs do not depend on the
+            #protocol's strict settings, so the serialized
+            #bytes can be written directly to the transport.
+            oprot.trans.write(self.data)
+        else:
+            self.snapshot.write(oprot)
+
+
+class ReplicateArgs(TChatService.replicate_args):
+    """replicate() arguments.
+
+    The generated arguments are encoded entirely by the accelerated
+    encoder when written to the accelerated protocol, which would
+    re-encode a SerializedChatSnapshot field by field. Without a
+    thrift_spec, the arguments are written field by field, so that
+    the snapshot's serialized bytes are written as is. The request
+    context is still written with the accelerated encoder.
+    """
+    thrift_spec = None
+
+
+class ChatServiceClient(TChatService.Client):
+    """Chat service client which writes the serialized bytes of
+    SerializedChatSnapshot objects for all binary protocols,
+    including the accelerated protocol.
+    """
+
+    def send_replicate(self, requestContext, chatSnapshot):
+        self._oprot.writeMessageBegin("replicate", TMessageType.CALL, self._seqid)
+        args = ReplicateArgs()
+        args.requestContext = requestContext
+        args.chatSnapshot = chatSnapshot
+        args.write(self._oprot)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
@@ -107,6 +107,7 @@ class VoiceHandler(TwilioHandler):
         }
 
         chat.state.session["twilio_data"] = json.dumps(twilio_data)
+        chat.state_changed("session")
         self.service_handler.replicator.replicate(chat, [])
         
         if chat.state.maxParticipants == 1:
@@ -0,0 +1,154 @@
+import logging
+
+import gevent
+
+from trpycore.timezone import tz
+from trsvcscore.db.models import Chat as ChatModel
+from trsvcscore.hashring.base import ServiceHashringEvent
+
+class ChatWarmer(object):
+    """Active chat warmer.
+
+    Preloads the active chats (started, but not ended or
+    beyond their max duration) for which this service is
+    the primary, using a single query, so that the first
+    request for each chat does not wait on a database load.
+
+    Chats are warmed when the handler starts and whenever
+    the hashring changes, since this service may have taken
+    over chats from another service. Warming following
+    hashring changes is debounced, so that a burst of
+    changes results in a single warm.
+
+    Only chats started within the last max_age seconds
+    are queried, so that abandoned chats, which were never
+    ended, do not make each warm a growing table scan.
+    """
+
+    def __init__(
+            self,
+            service,
+            hashring,
+            chat_manager,
+            database_session_factory,
+            preference_lists,
+            max_age=14400,
+            debounce=5):
+        """ChatWarmer constructor.
+
+        Args:
+            service: ChatService object
+            hashring: ServiceHashring object
+            chat_manager: ChatManager object
+            database_session_factory: sqlalchemy database session
+                factory method.
+            preference_lists: PreferenceListCache object
+            max_age: maximum number of seconds since a chat's
+                start for it to be warmed. This should exceed the
+                longest chat max duration plus the expiration
+                threshold.
+            debounce: number of seconds to wait for further
+                hashring changes before warming.
+        """
+        self.service = service
+        self.hashring = hashring
+        self.chat_manager = chat_manager
+        self.database_session_factory = database_session_factory
+        self.preference_lists = preference_lists
+        self.max_age = max_age
+        self.debounce = debounce
+
+        #greenlet of the pending warm following a hashring change
+        self.pending = None
+        self.stopped = False
+        self.log = logging.getLogger("%s.%s" % (__name__, self.__class__.__name__))
+
+        #add hashring observer
+        self.hashring.add_observer(self._hashring_observer)
+
+    def _hashring_observer(self, hashring, event):
+        """Observer method which will be invoked upon hashring changes.
+
+        Args:
+            hashring: ServiceHashring object
+            event: ServiceHashringEvent object
+        """
+        if event.event_type == ServiceHashringEvent.CHANGED_EVENT:
+            if self.stopped:
+                return
+            if self.pending is not None:
+                self.pending.kill(block=False)
+            self.pending = gevent.spawn_later(
+                    self.debounce, self.warm, event.current_hashring)
+
+    def stop(self):
+        """Stop warmer.
+
+        Cancels the pending warm, and ignores subsequent
+        hashring changes, i.e. the removal of our hashring
+        positions when the handler stops.
+        """
+        self.stopped = True
+        if self.pending is not None:
+            self.pending.kill(block=False)
+            self.pending = None
+
+    def _is_active(self, model, now):
+        """Check if chat model is active.
+
+        Args:
+            model: ChatModel object
+            now: current timestamp
+        Returns:
+            True if the chat has not exceeded its max duration.
+        """
+        if not model.max_duration:
+            return True
+        return now < tz.utc_to_timestamp(model.start) + model.max_duration
+
+    def _is_owned(self, chat_token, hashring=None):
+        """Check if this service is the chat's primary.
+
+        Args:
+            chat_token: chat token
+            hashring: optional hashring to check ownership
+                against. Defaults to the current hashring.
+        Returns:
+            True if this service is the chat's primary.
+        """
+        preference_list = self.preference_lists.preference_list(chat_token, hashring)
+        return bool(preference_list) and \
+                preference_list[0].service_info.key == self.service.info().key
+
+    def warm(self, hashring=None):
+        """Preload active chats owned by this service.
+
+        Args:
+            hashring: optional hashring to determine ownership
+                with. Defaults to the current hashring.
+        Returns:
+            number of chats preloaded.
+        """
+        cutoff = tz.timestamp_to_utc(tz.timestamp() - self.max_age)
+
+        session = self.database_session_factory()
+        try:
+            models = session.query(ChatModel)\
+                    .filter(ChatModel.start > cutoff)\
+                    .filter(ChatModel.end == None)\
+                    .all()
+            session.commit()
+        except Exception as error:
+            self.log.exception(error)
+            session.rollback()
+            return 0
+        finally:
+            session.close()
+
+        now = tz.timestamp()
+        models = [m for m in models
+                if self._is_active(m, now) and self._is_owned(m.token, hashring)]
+        added = self.chat_manager.preload(models)
+
+        self.log.info("Warmed %s of %s owned active chat(s)" % (added, len(models)))
+        return added
@@ -0,0 +1,86 @@
+import unittest
+
+import testbase
+from trchatsvc.gen.ttypes import ChatDigest, ChatDigestBucket
+
+from antientropy import AntiEntropy
+from chat import Chat, materialize
+from testbase import CHAT_TOKEN, build_message, FakeChatManager, FakeNode, \
+        FakeClient, FakeServiceProxyPool
+
+LOCAL_SERVICE_KEY = "UNITTEST_LOCAL_SERVICE_KEY"
+
+class ReplicaClient(FakeClient):
+    def __init__(self, replica):
+        super(ReplicaClient, self).__init__()
+        self.replica = replica
+
+    def getChatDigest(self, context, chat_token, bucket_duration):
+        buckets = [ChatDigestBucket(start=start, count=count, digest=digest)
+                for start, count, digest in self.replica.digest(bucket_duration)]
+        return ChatDigest(token=chat_token, bucketDuration=bucket_duration, buckets=buckets)
+
+    def getChatBucketMessages(self, context, chat_token, bucket_duration, bucket_starts):
+        return materialize(self.replica.bucket_messages(bucket_duration, bucket_starts))
+
+    def replicate(self, context, snapshot):
+        self.replica.store_snapshot(snapshot)
+
+class FakeReplicator(object):
+    N = 2
+
+    def __init__(self, replica):
+        self.nodes = [FakeNode(LOCAL_SERVICE_KEY), FakeNode()]
+        self.pool = FakeServiceProxyPool(
+                client_factory=lambda: ReplicaClient(replica))
+
+    def preference_list(self, chat_token, hashring=None):
+        return self.nodes
+
+    def is_remote_node(self, node):
+        return node.service_info.key != LOCAL_SERVICE_KEY
+
+    def service_proxy_pool(self, node):
+        return self.pool
+
+    def build_request_context(self):
+        return None
+
+
+class AntiEntropyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.replica = Chat(None, CHAT_TOKEN)
+        self.chat_manager = FakeChatManager()
+        self.chat_manager.chats[CHAT_TOKEN] = self.chat
+        self.anti_entropy = AntiEntropy(
+                FakeReplicator(self.replica),
+                self.chat_manager,
+                bucket_duration=60)
+
+    def _message_ids(self, chat):
+        return sorted(message.id for message in chat.state.messages)
+
+    def test_missing_messages_exchanged(self):
+        shared = build_message("shared", 10.0)
+        self.chat.store_replicated_messages([shared, build_message("primary", 20.0)])
+
+        #messages sent to a previous primary prior to failover,
+        #including a bucket which only the replica holds.
+        self.replica.store_replicated_messages([shared,
+            build_message("replica", 30.0), build_message("replica-only", 130.0)])
+
+        self.assertEqual(self.anti_entropy.synchronize(), 3)
+        self.assertEqual(self._message_ids(self.chat),
+                ["primary", "replica", "replica-only", "shared"])
+        self.assertEqual(self._message_ids(self.replica), self._message_ids(self.chat))
+        self.assertEqual(self.chat.digest(60), self.replica.digest(60))
+
+    def test_verified_replica_skipped(self):
+        self.chat.store_replicated_messages([build_message("message-0", 10.0)])
+        self.assertEqual(self.anti_entropy.synchronize(), 1)
+        self.assertEqual(self.anti_entropy.synchronize(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
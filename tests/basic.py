@@ -37,6 +37,8 @@ class BasicTest(IntegrationTestCase):
         result = self.service_proxy.getCounters(self.request_context)
         self.assertIsInstance(result, dict)
         self.assertEqual(result["open_requests"], 1)
+        self.assertIn("replication_interactive_depth", result)
+        self.assertIn("rebalance_chats_queued", result)
 
     def test_getOptions(self):
         result = self.service_proxy.getOptions(self.request_context)
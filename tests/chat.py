@@ -0,0 +1,405 @@
+import unittest
+
+import gevent
+
+import testbase
+from trchatsvc.gen.ttypes import MessageRouteType, ChatState, ChatSnapshot, ChatStatus
+
+from chat import Chat, ChatManager, ChatLoadException
+from testbase import CHAT_TOKEN, build_message
+
+
+class ChatWaiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+
+    def _spawn_waiter(self, user_id):
+        return gevent.spawn(self.chat.get_messages,
+                asOf=0, block=True, timeout=1, user_id=user_id)
+
+    def test_targeted_message_wakes_recipient_only(self):
+        waiter1 = self._spawn_waiter(1)
+        waiter2 = self._spawn_waiter(2)
+        gevent.sleep(0)
+
+        message = build_message(route_type=MessageRouteType.TARGETED_ROUTE, recipients=[1])
+        message.header.id = "targeted"
+        self.chat.send_messages([message])
+        gevent.sleep(0)
+
+        self.assertTrue(waiter1.ready())
+        self.assertEqual(len(waiter1.value), 1)
+        self.assertFalse(waiter2.ready())
+        waiter2.kill()
+
+    def test_broadcast_message_wakes_all(self):
+        waiters = [self._spawn_waiter(user_id) for user_id in [1, 2, None]]
+        gevent.sleep(0)
+
+        message = build_message()
+        message.header.id = "broadcast"
+        self.chat.send_messages([message])
+        gevent.joinall(waiters, timeout=0.5)
+
+        for waiter in waiters:
+            self.assertEqual(len(waiter.value), 1)
+        self.assertEqual(self.chat.message_waiters, {})
+
+    def test_trigger_messages_wakes_all(self):
+        waiters = [self._spawn_waiter(user_id) for user_id in [1, 2, None]]
+        gevent.sleep(0)
+
+        self.chat.trigger_messages()
+        gevent.joinall(waiters, timeout=0.5)
+
+        for waiter in waiters:
+            self.assertTrue(waiter.ready())
+            self.assertEqual(waiter.value, [])
+
+    def test_replicated_message_wakes_recipient(self):
+        waiter1 = self._spawn_waiter(1)
+        waiter2 = self._spawn_waiter(2)
+        gevent.sleep(0)
+
+        message = build_message(route_type=MessageRouteType.TARGETED_ROUTE, recipients=[2])
+        message.header.id = "replicated"
+        message.header.timestamp = 1.0
+        self.chat.store_replicated_messages([message])
+        gevent.sleep(0)
+
+        self.assertFalse(waiter1.ready())
+        self.assertTrue(waiter2.ready())
+        self.assertEqual(waiter2.value, [message])
+        waiter1.kill()
+
+    def test_replicated_message_before_cursor(self):
+        waiter = gevent.spawn(self.chat.get_messages,
+                asOf=5.0, block=True, timeout=1, user_id=1)
+        gevent.sleep(0)
+
+        message = build_message()
+        message.header.id = "old"
+        message.header.timestamp = 4.0
+        self.chat.store_replicated_messages([message])
+        gevent.sleep(0)
+        self.assertFalse(waiter.ready())
+
+        message = build_message()
+        message.header.id = "new"
+        message.header.timestamp = 6.0
+        self.chat.store_replicated_messages([message])
+        waiter.join(timeout=0.5)
+        self.assertEqual(waiter.value, [message])
+
+    def test_replica_staleness(self):
+        self.assertTrue(self.chat.is_stale(15))
+        self.chat.store_snapshot(ChatSnapshot(
+            fullSnapshot=False,
+            state=ChatState(token=CHAT_TOKEN, messages=[])))
+        self.assertFalse(self.chat.is_stale(15))
+        self.chat.replicated_timestamp -= 20
+        self.assertTrue(self.chat.is_stale(15))
+
+    def test_subscription(self):
+        first = build_message(route_type=MessageRouteType.TARGETED_ROUTE, recipients=[1])
+        first.header.id = "first"
+        self.chat.send_messages([first])
+
+        subscription = self.chat.subscribe(asOf=0, user_id=1)
+        self.assertEqual(subscription.poll(timeout=0), [first])
+
+        poll = gevent.spawn(subscription.poll, timeout=1)
+        gevent.sleep(0)
+        other = build_message(route_type=MessageRouteType.TARGETED_ROUTE, recipients=[2])
+        other.header.id = "other"
+        second = build_message()
+        second.header.id = "second"
+        self.chat.send_messages([other, second])
+        poll.join(timeout=0.5)
+
+        self.assertEqual(poll.value, [second])
+        self.assertEqual(subscription.cursor, second.header.timestamp)
+
+        self.chat.unsubscribe(subscription.id)
+        self.assertEqual(self.chat.subscriptions, {})
+
+    def test_unfiltered_subscription_matches_get_messages(self):
+        subscription = self.chat.subscribe(asOf=0)
+
+        message = build_message(route_type=MessageRouteType.NO_ROUTE)
+        message.header.id = "unrouted"
+        self.chat.send_messages([message])
+
+        self.assertEqual(subscription.poll(timeout=0), [message])
+        self.assertEqual(self.chat.get_messages(asOf=0), [message])
+
+    def test_subscription_overflow(self):
+        subscription = self.chat.subscribe(asOf=0, max_queue_size=1)
+        for i in range(3):
+            message = build_message()
+            message.header.id = "overflow-%s" % i
+            self.chat.send_messages([message])
+
+        self.assertTrue(subscription.overflowed)
+        self.assertEqual(subscription.messages, [])
+
+
+class ChatMessageIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+
+    def _store(self, message_id, timestamp, route_type=MessageRouteType.BROADCAST_ROUTE, recipients=None):
+        message = build_message(route_type=route_type, recipients=recipients)
+        message.header.id = message_id
+        message.header.timestamp = timestamp
+        self.chat.store_replicated_messages([message])
+        return message
+
+    def test_filtered_messages(self):
+        broadcast = self._store("broadcast", 1.0)
+        targeted = self._store("targeted", 2.0, MessageRouteType.TARGETED_ROUTE, [2])
+        self._store("no_route", 3.0, MessageRouteType.NO_ROUTE)
+
+        self.assertEqual(self.chat.get_messages(0, user_id=1), [broadcast])
+        self.assertEqual(self.chat.get_messages(0, user_id=2), [broadcast, targeted])
+        self.assertEqual(len(self.chat.get_messages(0)), 3)
+
+    def test_index_maintained(self):
+        self.assertEqual(self.chat.get_messages(0, user_id=1), [])
+
+        second = self._store("second", 2.0)
+        first = self._store("first", 1.0, MessageRouteType.TARGETED_ROUTE, [1])
+        self._store("other", 3.0, MessageRouteType.TARGETED_ROUTE, [2])
+
+        self.assertEqual(self.chat.get_messages(0, user_id=1), [first, second])
+        self.assertEqual(self.chat.get_messages(1.0, user_id=1), [second])
+
+    def test_replicated_messages_merged(self):
+        messages = []
+        for message_id, timestamp in [("a", 1.0), ("c", 3.0), ("e", 5.0)]:
+            messages.append(self._store(message_id, timestamp))
+
+        replicated = []
+        for message_id, timestamp in [("f", 6.0), ("b", 2.0), ("d", 4.0), ("a", 1.0)]:
+            message = build_message()
+            message.header.id = message_id
+            message.header.timestamp = timestamp
+            replicated.append(message)
+        self.chat.store_replicated_messages(replicated)
+
+        message_ids = [m.header.id for m in self.chat.get_messages()]
+        self.assertEqual(message_ids, ["a", "b", "c", "d", "e", "f"])
+        self.assertEqual(list(self.chat.message_log.timestamps),
+                [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+
+
+class ChatSequenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.replica = Chat(None, CHAT_TOKEN)
+
+    def _send(self, message_id):
+        message = build_message()
+        message.header.id = message_id
+        self.chat.send_messages([message])
+        return message
+
+    def _snapshot(self, base_sequence=None):
+        if base_sequence is None:
+            fields, messages = Chat.STATE_FIELDS, self.chat.get_messages()
+        else:
+            fields, messages = self.chat.changes_since(base_sequence)
+        state = ChatState(token=CHAT_TOKEN, messages=list(messages))
+        for field in fields:
+            setattr(state, field, getattr(self.chat.state, field))
+        return ChatSnapshot(
+                fullSnapshot=base_sequence is None,
+                state=state,
+                epoch=self.chat.epoch,
+                sequence=self.chat.sequence,
+                baseSequence=base_sequence)
+
+    def test_changes_since(self):
+        first = self._send("first")
+        sequence = self.chat.sequence
+        self.chat.state.status = ChatStatus.STARTED
+        self.chat.state_changed("status")
+        second = self._send("second")
+
+        fields, messages = self.chat.changes_since(sequence)
+        self.assertEqual(fields, ["status"])
+        self.assertEqual(messages, [second])
+
+        fields, messages = self.chat.changes_since(0)
+        self.assertEqual(messages, [first, second])
+
+    def test_store_snapshot(self):
+        self._send("first")
+        self.assertTrue(self.replica.store_snapshot(self._snapshot()))
+        sequence = self.chat.sequence
+
+        self.chat.state.status = ChatStatus.STARTED
+        self.chat.state_changed("status")
+        self._send("second")
+        delta = self._snapshot(sequence)
+        self.assertIsNone(delta.state.users)
+
+        self.assertTrue(self.replica.store_snapshot(delta))
+        self.assertEqual(self.replica.state.status, ChatStatus.STARTED)
+        self.assertEqual(len(self.replica.state.messages), 2)
+
+    def test_store_snapshot_gap(self):
+        self._send("first")
+        delta = self._snapshot(self.chat.sequence)
+        self.assertFalse(self.replica.store_snapshot(delta))
+
+
+class ChatDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.replica = Chat(None, CHAT_TOKEN)
+
+    def _messages(self, timestamps):
+        messages = []
+        for timestamp in timestamps:
+            message = build_message()
+            message.header.id = "message-%s" % timestamp
+            message.header.timestamp = timestamp
+            messages.append(message)
+        return messages
+
+    def test_digest_order_independent(self):
+        messages = self._messages([1.0, 2.0, 61.0, 125.0])
+        self.chat.store_replicated_messages(messages)
+        for message in reversed(messages):
+            self.replica.store_replicated_messages([message])
+
+        self.assertEqual(self.chat.digest(60), self.replica.digest(60))
+        self.assertEqual([b[0] for b in self.chat.digest(60)], [0, 60, 120])
+
+    def test_digest_mismatch(self):
+        messages = self._messages([1.0, 2.0, 61.0, 125.0])
+        self.chat.store_replicated_messages(messages)
+        self.replica.store_replicated_messages(messages[:2] + messages[3:])
+
+        digest = self.chat.digest(60)
+        replica_digest = self.replica.digest(60)
+        self.assertEqual(digest[0], replica_digest[0])
+        self.assertEqual(digest[2], replica_digest[1])
+        self.assertEqual(len(replica_digest), 2)
+
+
+class FakeChatModel(object):
+    def __init__(self, token):
+        self.id = 1
+        self.token = token
+        self.max_duration = 0
+        self.max_participants = 1
+        self.start = None
+        self.end = None
+
+class FakeServiceHandler(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.invalid_tokens = []
+        self.error = None
+        self.queries = 0
+
+    def get_database_session(self):
+        return self
+
+    def query(self, model):
+        self.queries += 1
+        return self
+
+    def filter(self, expression):
+        if self.error is not None:
+            raise self.error
+        models = [FakeChatModel(token) for token in self.tokens]
+        for model in models:
+            if model.token in self.invalid_tokens:
+                model.start = "invalid"
+        return models
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ChatManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service_handler = FakeServiceHandler(["chat1", "chat2"])
+        self.chat_manager = ChatManager(self.service_handler, unknown_ttl=30)
+
+    def test_load_batched(self):
+        greenlets = [gevent.spawn(self.chat_manager.get, token)
+                for token in ["chat1", "chat2", "chat1"]]
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertEqual(self.service_handler.queries, 1)
+        self.assertIs(greenlets[0].value, greenlets[2].value)
+        self.assertEqual(greenlets[1].value.token, "chat2")
+        self.assertTrue(greenlets[1].value.loaded)
+
+    def test_unknown_cached(self):
+        self.assertRaises(KeyError, self.chat_manager.get, "unknown")
+        self.assertRaises(KeyError, self.chat_manager.get, "unknown")
+        self.assertEqual(self.service_handler.queries, 1)
+
+    def test_load_model_failure(self):
+        self.service_handler.tokens.append("invalid")
+        self.service_handler.invalid_tokens.append("invalid")
+        greenlets = [gevent.spawn(self.chat_manager.get, token)
+                for token in ["chat1", "invalid", "chat2"]]
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertEqual(greenlets[0].value.token, "chat1")
+        self.assertIsInstance(greenlets[1].exception, ChatLoadException)
+        self.assertEqual(greenlets[2].value.token, "chat2")
+        self.assertEqual(self.chat_manager._loading, {})
+        self.assertNotIn("invalid", self.chat_manager.all())
+        self.assertNotIn("invalid", self.chat_manager._unknown)
+
+    def test_database_failure(self):
+        self.service_handler.error = Exception("database unavailable")
+        self.assertRaises(ChatLoadException, self.chat_manager.get, "chat1")
+        self.assertNotIn("chat1", self.chat_manager._unknown)
+
+        self.service_handler.error = None
+        self.assertEqual(self.chat_manager.get("chat1").token, "chat1")
+
+    def test_preload(self):
+        self.assertRaises(KeyError, self.chat_manager.get, "chat3")
+        added = self.chat_manager.preload([FakeChatModel("chat1"), FakeChatModel("chat3")])
+        self.assertEqual(added, 2)
+
+        self.assertEqual(self.chat_manager.get("chat3").token, "chat3")
+        self.assertEqual(self.service_handler.queries, 1)
+
+    def test_evict(self):
+        chats = self.chat_manager.all()
+        for token in ["persisted", "replica", "primary"]:
+            chats[token] = Chat(None, token)
+        chats["persisted"].state.persisted = True
+        self.chat_manager.is_primary = lambda token: token != "replica"
+
+        self.chat_manager.max_bytes = Chat.BASE_SIZE * 2
+        self.assertEqual(self.chat_manager.evict(), 1)
+        self.assertEqual(sorted(chats.keys()), ["primary", "replica"])
+
+        self.chat_manager.max_bytes = Chat.BASE_SIZE / 2
+        self.assertEqual(self.chat_manager.evict(), 1)
+        self.assertEqual(chats.keys(), ["primary"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import bisect
+import logging
+import random
+import time
+import unittest
+
+import testbase
+from trchatsvc.gen.ttypes import MessageRouteType
+
+from chat import Chat, materialize
+from testbase import CHAT_TOKEN, build_message
+
+def build_chat(num_messages, num_users, targeted_ratio=0.2):
+    """Build a chat containing a mix of broadcast and targeted messages."""
+    chat = Chat(None, CHAT_TOKEN)
+    for i in range(num_messages):
+        if random.random() < targeted_ratio:
+            message = build_message("message-%s" % i, float(i),
+                    route_type=MessageRouteType.TARGETED_ROUTE,
+                    recipients=[random.randint(1, num_users)])
+        else:
+            message = build_message("message-%s" % i, float(i))
+        chat.store_replicated_messages([message])
+    return chat
+
+def scan_messages(chat, asOf, user_id):
+    """Previous read path: bisect followed by a linear filter."""
+    index = bisect.bisect(chat.message_log.timestamps, asOf)
+    return materialize(chat._filter_messages(chat.state.messages[index:], user_id))
+
+def benchmark(method, chat, polls, num_users):
+    start = time.time()
+    for asOf in polls:
+        for user_id in range(1, num_users + 1):
+            method(chat, asOf, user_id)
+    return time.time() - start
+
+
+@testbase.benchmark
+class MessageIndexBenchmark(unittest.TestCase):
+
+    def _run(self, num_messages, num_users):
+        chat = build_chat(num_messages, num_users)
+
+        #long poll cursors are usually close to the end of the chat
+        polls = [num_messages - random.randint(1, 50) for i in range(100)]
+        polls.append(0)
+
+        for user_id in range(1, num_users + 1):
+            self.assertEqual(
+                    scan_messages(chat, polls[0], user_id),
+                    chat.get_messages(polls[0], user_id=user_id))
+
+        index_time = benchmark(
+                lambda c, a, u: c.get_messages(a, user_id=u),
+                chat, polls, num_users)
+        scan_time = benchmark(scan_messages, chat, polls, num_users)
+
+        logging.info("messages=%s, users=%s: scan=%.4fs, index=%.4fs (%.1fx)" % (
+            num_messages, num_users, scan_time, index_time,
+            scan_time / max(index_time, 1e-9)))
+
+    def test_message_index(self):
+        for num_messages in [1000, 5000, 10000]:
+            for num_users in [10, 50]:
+                self._run(num_messages, num_users)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
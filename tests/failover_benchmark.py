@@ -0,0 +1,63 @@
+import logging
+import time
+import unittest
+
+import gevent
+
+import testbase
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+from chat import Chat
+from testbase import CHAT_TOKEN, build_message
+
+def replicate(primary, replica, base_sequence):
+    """Replicate the primary's changes since base_sequence to the replica."""
+    fields, messages = primary.changes_since(base_sequence)
+    replica.store_snapshot(ChatSnapshot(
+        fullSnapshot=False,
+        state=ChatState(token=CHAT_TOKEN, messages=list(messages))))
+    return primary.sequence
+
+
+@testbase.benchmark
+class FailoverLatencyBenchmark(unittest.TestCase):
+    """Measures the time from sendMessage on the old primary
+    to delivery to a long poll on the new primary, which
+    holds a replica of the chat."""
+
+    def _run(self, num_waiters, iterations=100, timeout=10):
+        primary = Chat(None, CHAT_TOKEN)
+        replica = Chat(None, CHAT_TOKEN)
+        sequence = 0
+        latencies = []
+
+        for i in range(iterations):
+            asOf = replica.message_log.timestamps[-1] if len(replica.message_log) else 0
+            waiters = [gevent.spawn(replica.get_messages,
+                    asOf=asOf, block=True, timeout=timeout, user_id=user_id)
+                    for user_id in range(1, num_waiters + 1)]
+            gevent.sleep(0)
+
+            start = time.time()
+            primary.send_messages([build_message("message-%s" % i)])
+            sequence = replicate(primary, replica, sequence)
+            gevent.joinall(waiters, timeout=timeout)
+            latencies.append(time.time() - start)
+
+            for waiter in waiters:
+                self.assertEqual(len(waiter.value), 1)
+
+        latencies.sort()
+        logging.info("waiters=%s: p50=%.3fms, p99=%.3fms (poll timeout=%ss)" % (
+            num_waiters,
+            latencies[len(latencies) / 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            timeout))
+
+    def test_failover_latency(self):
+        for num_waiters in [1, 10, 100]:
+            self._run(num_waiters)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
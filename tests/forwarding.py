@@ -0,0 +1,61 @@
+import unittest
+
+import testbase
+from thrift.transport.TTransport import TTransportException
+from trchatsvc.gen.ttypes import UnavailableException
+
+from forwarding import ForwardingProxyPools
+from testbase import SERVICE_KEY, FakeHashring, FakeNode, FakeClient, \
+        FakeServiceProxyPool
+
+
+class ForwardingProxyPoolsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = FakeNode()
+        self.pools = ForwardingProxyPools(
+                hashring=FakeHashring(),
+                max_connections_per_service=1,
+                max_blocking_connections_per_service=1,
+                acquire_timeout=0.01)
+        self.pools.pools[SERVICE_KEY] = FakeServiceProxyPool()
+        self.pools.blocking_pools[SERVICE_KEY] = FakeServiceProxyPool()
+
+    def test_blocking_requests_isolated(self):
+        with self.pools.get(self.node, blocking=True):
+            with self.pools.get(self.node) as proxy:
+                self.assertIsInstance(proxy, FakeClient)
+
+            with self.assertRaises(UnavailableException):
+                with self.pools.get(self.node, blocking=True):
+                    pass
+
+    def test_evict_closes_connections(self):
+        with self.pools.get(self.node) as idle_proxy:
+            pass
+        with self.pools.get(self.node, blocking=True) as active_proxy:
+            self.pools.evict(SERVICE_KEY)
+            self.assertTrue(idle_proxy._iprot.trans.closed)
+            self.assertFalse(active_proxy._iprot.trans.closed)
+        self.assertTrue(active_proxy._iprot.trans.closed)
+        self.assertEqual(self.pools.pools, {})
+        self.assertEqual(self.pools.blocking_pools, {})
+
+    def test_service_exception_keeps_connection(self):
+        with self.assertRaises(UnavailableException):
+            with self.pools.get(self.node) as proxy:
+                raise UnavailableException("unavailable")
+        self.assertFalse(proxy._iprot.trans.closed)
+
+        with self.pools.get(self.node) as pooled_proxy:
+            self.assertIs(pooled_proxy, proxy)
+
+    def test_transport_exception_closes_connection(self):
+        with self.assertRaises(TTransportException):
+            with self.pools.get(self.node) as proxy:
+                raise TTransportException(TTransportException.END_OF_FILE, "closed")
+        self.assertTrue(proxy._iprot.trans.closed)
+        self.assertEqual(self.pools.pools, {})
+
+if __name__ == '__main__':
+    unittest.main()
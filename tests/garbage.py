@@ -0,0 +1,102 @@
+import unittest
+
+import gevent
+
+import testbase
+from trpycore.timezone import tz
+from trchatsvc.gen.ttypes import ChatStatus, ChatStatusMessage, Message, \
+        MessageHeader, MessageRoute, MessageRouteType, MessageType
+
+from chat import Chat, ChatManager
+from garbage import GarbageCollector, GarbageCollectionEvent
+
+class GarbageCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat_manager = ChatManager(None)
+        self.garbage_collector = GarbageCollector(
+                service=None,
+                hashring=None,
+                chat_manager=self.chat_manager,
+                interval=60,
+                throttle=0,
+                completed_grace_period=30)
+        self.events = []
+        self.garbage_collector.add_observer(self.events.append)
+
+    def _add_chat(self, token, start, end=0, max_duration=0):
+        chat = Chat(None, token)
+        chat.state.status = ChatStatus.STARTED
+        chat.state.startTimestamp = start
+        chat.state.endTimestamp = end
+        chat.state.maxDuration = max_duration
+        self.chat_manager.all()[token] = chat
+        self.garbage_collector.schedule(chat)
+        return chat
+
+    def test_completed_chat_collected(self):
+        now = tz.timestamp()
+        chat = self._add_chat("completed", now - 100, now - 31)
+        chat.state.persisted = True
+        self._add_chat("active", now - 10, max_duration=3600)
+
+        self.garbage_collector._collect_due()
+        self.assertEqual(self.chat_manager.all().keys(), ["active"])
+        self.assertEqual(self.garbage_collector.heap[0][1], "active")
+
+    def test_zombie_chat_rescheduled(self):
+        now = tz.timestamp()
+        chat = self._add_chat("zombie", now - 1000, max_duration=60)
+
+        self.garbage_collector._collect_due()
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0].event_type, GarbageCollectionEvent.ZOMBIE_CHAT_EVENT)
+        self.assertTrue(self.garbage_collector.scheduled["zombie"] >= now + 60)
+
+        chat.state.persisted = True
+        chat.state.endTimestamp = now - 31
+        self.garbage_collector.schedule(chat)
+        self.garbage_collector._collect_due()
+        self.assertEqual(self.chat_manager.all(), {})
+
+    def test_expire_subscriptions(self):
+        self.garbage_collector.subscription_ttl = 60
+        chat = self._add_chat("subscribed", tz.timestamp(), max_duration=3600)
+        active = chat.subscribe()
+        expired = chat.subscribe()
+        expired.last_poll -= 120
+
+        self.garbage_collector._expire_subscriptions()
+        self.assertEqual(chat.subscriptions.keys(), [active.id])
+
+    def test_completed_chat_grace_period(self):
+        now = tz.timestamp()
+        chat = self._add_chat("ended", now - 10, max_duration=3600)
+        waiter = gevent.spawn(chat.get_messages, now - 1, True, 5)
+        gevent.sleep(0)
+
+        header = MessageHeader(
+                id="ended",
+                type=MessageType.CHAT_STATUS,
+                chatToken="ended",
+                userId=1,
+                timestamp=now,
+                route=MessageRoute(MessageRouteType.BROADCAST_ROUTE))
+        ended = Message(
+                header=header,
+                chatStatusMessage=ChatStatusMessage(userId=1, status=ChatStatus.ENDED))
+
+        chat.state.status = ChatStatus.ENDED
+        chat.state.endTimestamp = now
+        chat.state.persisted = True
+        self.garbage_collector.schedule(chat)
+        chat.store_replicated_messages([ended])
+        self.garbage_collector._collect_due()
+
+        self.assertEqual(waiter.get(timeout=1), [ended])
+        self.assertEqual(self.chat_manager.all().keys(), ["ended"])
+        self.assertEqual(self.chat_manager.get("ended").get_messages(now - 1), [ended])
+        self.assertEqual(self.garbage_collector.scheduled["ended"], now + 30)
+
+if __name__ == '__main__':
+    unittest.main()
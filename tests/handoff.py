@@ -0,0 +1,81 @@
+import unittest
+
+import testbase
+from trchatsvc.gen.ttypes import ChatStatus
+
+from chat import Chat
+from handoff import HintedHandoff
+from testbase import CHAT_TOKEN, SERVICE_KEY, build_message, FakeHashring, \
+        FakeChatManager, FakeNode, FakeClient, FakeServiceProxyPool
+
+
+class ReplicaClient(FakeClient):
+    def __init__(self, replica):
+        super(ReplicaClient, self).__init__()
+        self.replica = replica
+
+    def replicate(self, context, snapshot):
+        self.replica.store_snapshot(snapshot)
+
+class FakeReplicator(object):
+    def __init__(self, replica):
+        self.hashring = FakeHashring()
+        self.chat_manager = FakeChatManager()
+        self.replica = replica
+
+    def service_proxy_pool(self, node):
+        return FakeServiceProxyPool(
+                client_factory=lambda: ReplicaClient(self.replica))
+
+    def build_request_context(self):
+        return None
+
+
+class HintedHandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.replica = Chat(None, CHAT_TOKEN)
+        self.replicator = FakeReplicator(self.replica)
+        self.replicator.chat_manager.chats[CHAT_TOKEN] = self.chat
+        self.handoff = HintedHandoff(self.replicator)
+
+    def test_replay_does_not_roll_back_replica(self):
+        self.chat.state.status = ChatStatus.STARTED
+        self.chat.state_changed("status")
+        stale = self.handoff._build_snapshot(CHAT_TOKEN, [build_message("message-0")])
+
+        self.chat.state.status = ChatStatus.ENDED
+        self.chat.state_changed("status")
+        current = self.handoff._build_snapshot(CHAT_TOKEN, [])
+
+        #The recovered replica has stored newer state before
+        #the stale replay arrives.
+        self.assertTrue(self.replica.store_snapshot(current))
+        self.assertTrue(self.replica.store_snapshot(stale))
+
+        self.assertEqual(self.replica.state.status, ChatStatus.ENDED)
+        self.assertEqual(self.replica.replicated_sequence, self.chat.sequence)
+        self.assertEqual(len(self.replica.state.messages), 1)
+
+    def test_replay(self):
+        self.chat.state.status = ChatStatus.STARTED
+        self.chat.state_changed("status")
+        self.handoff.add(FakeNode(), self.chat, [build_message("message-0")])
+
+        self.assertTrue(self.handoff.replay(SERVICE_KEY))
+        self.assertFalse(self.handoff.has_hints(SERVICE_KEY))
+        self.assertEqual(self.replica.state.status, ChatStatus.STARTED)
+        self.assertEqual(self.replica.replicated_sequence, self.chat.sequence)
+        self.assertEqual(self.chat.replica_sequences[SERVICE_KEY], self.chat.sequence)
+
+    def test_replay_unknown_chat(self):
+        self.handoff.add(FakeNode(), self.chat, [build_message("message-0")])
+        del self.replicator.chat_manager.chats[CHAT_TOKEN]
+
+        self.assertTrue(self.handoff.replay(SERVICE_KEY))
+        self.assertIsNone(self.replica.state.status)
+        self.assertEqual(len(self.replica.state.messages), 1)
+
+if __name__ == '__main__':
+    unittest.main()
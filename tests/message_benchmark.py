@@ -0,0 +1,65 @@
+import logging
+import sys
+import unittest
+
+import testbase
+from trchatsvc.gen.ttypes import MessageRouteType
+
+from chat import Chat, MessageRecord
+from testbase import CHAT_TOKEN, build_message
+
+def build_messages(num_messages):
+    messages = []
+    for i in range(num_messages):
+        if i % 5 == 0:
+            messages.append(build_message("message-%s" % i, float(i),
+                route_type=MessageRouteType.TARGETED_ROUTE, recipients=[i % 10]))
+        else:
+            messages.append(build_message("message-%s" % i, float(i)))
+    return messages
+
+def deep_size(obj, seen=None):
+    """Approximate the memory used by obj and the objects it references."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            size += deep_size(value, seen)
+    if hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    for slot in getattr(obj.__class__, "__slots__", []):
+        if hasattr(obj, slot):
+            size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+@testbase.benchmark
+class MessageMemoryBenchmark(unittest.TestCase):
+
+    def test_bytes_per_message(self):
+        num_messages = 1000
+        messages = build_messages(num_messages)
+
+        message_size = deep_size(messages) / float(num_messages)
+        records = [MessageRecord(m) for m in messages]
+        record_size = deep_size(records) / float(num_messages)
+
+        chat = Chat(None, CHAT_TOKEN)
+        chat.store_replicated_messages(messages)
+        self.assertEqual(chat.get_messages(), messages)
+
+        logging.info("bytes per message: message=%.0f, record=%.0f (%.1fx)" % (
+            message_size, record_size, message_size / record_size))
+        self.assertLess(record_size, message_size)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+import gevent
+
+import testbase
+from persistence import GreenletPoolPersister, PersistException
+from testbase import FakeHashring
+
+class FakeChatState(object):
+    def __init__(self):
+        self.persisted = False
+
+class FakeChat(object):
+    def __init__(self, token):
+        self.id = token
+        self.token = token
+        self.start = None
+        self.end = None
+        self.state = FakeChatState()
+        self.changed = []
+
+    def state_changed(self, *fields):
+        self.changed.extend(fields)
+
+class FakeSession(object):
+    def __init__(self, persister_test):
+        self.persister_test = persister_test
+        self.updates = []
+
+    def query(self, model):
+        return self
+
+    def filter(self, expression):
+        return self
+
+    def update(self, values):
+        self.updates.append(values)
+
+    def commit(self):
+        self.persister_test.failures -= 1
+        if self.persister_test.failures >= 0:
+            raise RuntimeError("commit failed")
+        self.persister_test.commits.append(self.updates)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PersisterSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.commits = []
+        self.failures = 0
+        self.persister = GreenletPoolPersister(
+                service=None,
+                hashring=FakeHashring(),
+                chat_manager=None,
+                database_session_factory=lambda: FakeSession(self),
+                size=1,
+                save_delay=0.01,
+                save_batch_size=2,
+                save_retries=1,
+                save_retry_delay=0.01)
+        self.persister.start()
+
+    def tearDown(self):
+        self.persister.stop()
+        self.persister.join(1)
+
+    def test_save_coalesced(self):
+        chat = FakeChat("chat1")
+        chat.start = 1
+        result1 = self.persister.save(chat)
+        chat.end = 2
+        result2 = self.persister.save(chat)
+
+        result1.get(timeout=1)
+        result2.get(timeout=1)
+        self.assertEqual(self.commits, [[{"start": 1, "end": 2}]])
+
+    def test_save_batched(self):
+        results = [self.persister.save(FakeChat("chat%s" % i)) for i in range(3)]
+        for result in results:
+            result.get(timeout=1)
+        self.assertEqual(sorted(len(c) for c in self.commits), [1, 2])
+
+    def test_save_retried(self):
+        self.failures = 1
+        self.persister.save(FakeChat("chat1")).get(timeout=1)
+        self.assertEqual(len(self.commits), 1)
+
+    def test_save_failed(self):
+        self.failures = 2
+        result = self.persister.save(FakeChat("chat1"))
+        self.assertRaises(PersistException, result.get, timeout=1)
+
+    def test_save_failed_requeued(self):
+        self.failures = 2
+        chat = FakeChat("chat1")
+        chat.state.persisted = True
+        result = self.persister.save(chat)
+        self.assertRaises(PersistException, result.get, timeout=1)
+
+        #persisted chats are not returned to zombies,
+        #and the failed save is written once requeued.
+        gevent.sleep(0.2)
+        self.assertTrue(chat.state.persisted)
+        self.assertEqual(chat.changed, [])
+        self.assertEqual(len(self.commits), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+import testbase
+from thrift.protocol import TBinaryProtocol, TCompactProtocol
+from thrift.transport import TTransport
+from tridlcore.gen.ttypes import RequestContext
+from trchatsvc.gen import TChatService
+
+from chat import Chat
+from processor import ChatServiceProcessor, GetMessagesResult
+from testbase import CHAT_TOKEN, build_message
+
+def encode(result, protocol_class):
+    transport = TTransport.TMemoryBuffer()
+    result.write(protocol_class(transport))
+    return transport.getvalue()
+
+
+class GetMessagesResultTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [build_message("message-%s" % i, float(i)) for i in range(5)]
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.chat.store_replicated_messages(self.messages)
+
+    def test_spliced_encoding(self):
+        expected = TChatService.getMessages_result(success=self.messages)
+        result = GetMessagesResult(success=self.chat.get_message_records())
+
+        for protocol_class in [TBinaryProtocol.TBinaryProtocol,
+                TBinaryProtocol.TBinaryProtocolAccelerated]:
+            self.assertEqual(
+                    encode(result, protocol_class),
+                    encode(expected, protocol_class))
+
+    def test_decoded(self):
+        result = GetMessagesResult(success=self.chat.get_message_records())
+        transport = TTransport.TMemoryBuffer(
+                encode(result, TBinaryProtocol.TBinaryProtocol))
+        decoded = TChatService.getMessages_result()
+        decoded.read(TBinaryProtocol.TBinaryProtocol(transport))
+        self.assertEqual(decoded.success, self.messages)
+
+
+class FakeHandler(object):
+    def __init__(self, chat):
+        self.chat = chat
+
+    def getMessages(self, requestContext, chatToken, asOf, block, timeout):
+        return self.chat.get_message_records(asOf)
+
+
+class ChatServiceProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = RequestContext(
+                userId=0,
+                impersonatingUserId=0,
+                sessionId="dummy_session_id",
+                context="")
+        self.messages = [build_message("message-%s" % i, float(i)) for i in range(5)]
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.chat.store_replicated_messages(self.messages)
+        self.processor = ChatServiceProcessor(FakeHandler(self.chat))
+
+    def _get_messages(self, protocol_class, framed=False, **kwargs):
+        buffer = TTransport.TMemoryBuffer()
+        trans = TTransport.TFramedTransport(buffer) if framed else buffer
+        client = TChatService.Client(protocol_class(trans, **kwargs))
+        client.send_getMessages(self.context, CHAT_TOKEN, -1, False, 0)
+
+        otrans = TTransport.TMemoryBuffer()
+        self.processor.process(
+                TBinaryProtocol.TBinaryProtocol(TTransport.TMemoryBuffer(buffer.getvalue())),
+                TBinaryProtocol.TBinaryProtocol(otrans))
+
+        buffer = TTransport.TMemoryBuffer(otrans.getvalue())
+        trans = TTransport.TFramedTransport(buffer) if framed else buffer
+        client = TChatService.Client(protocol_class(trans, **kwargs))
+        return client.recv_getMessages()
+
+    def test_strict_binary(self):
+        self.assertEqual(
+                self._get_messages(TBinaryProtocol.TBinaryProtocol),
+                self.messages)
+
+    def test_non_strict_binary(self):
+        for framed in [False, True]:
+            self.assertEqual(
+                    self._get_messages(TBinaryProtocol.TBinaryProtocol, framed,
+                        strictRead=False, strictWrite=False),
+                    self.messages)
+
+    def test_framed_compact(self):
+        self.assertEqual(
+                self._get_messages(TCompactProtocol.TCompactProtocol, True),
+                self.messages)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import logging
+import time
+import unittest
+
+import testbase
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+from tridlcore.gen.ttypes import RequestContext
+from trchatsvc.gen import TChatService
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+from chat import Chat
+from processor import ChatServiceProcessor
+from protocol import protocol_factory
+from testbase import CHAT_TOKEN, build_messages
+
+
+class FakeHandler(object):
+    def __init__(self, chat):
+        self.chat = chat
+
+    def getMessages(self, requestContext, chatToken, asOf, block, timeout):
+        return self.chat.get_message_records(asOf)
+
+    def sendMessage(self, requestContext, message, N, W):
+        return message
+
+    def replicate(self, requestContext, chatSnapshot):
+        pass
+
+
+@testbase.benchmark
+class ProtocolBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.context = RequestContext(
+                userId=0,
+                impersonatingUserId=0,
+                sessionId="dummy_session_id",
+                context="")
+        self.messages = build_messages(100)
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.chat.store_replicated_messages(self.messages)
+        self.snapshot = ChatSnapshot(
+                fullSnapshot=True,
+                state=ChatState(token=CHAT_TOKEN, messages=self.messages),
+                epoch=1,
+                sequence=1)
+        self.processor = ChatServiceProcessor(
+                FakeHandler(self.chat),
+                protocol="accelerated")
+
+    def _client(self, data, transport, protocol):
+        buffer = TTransport.TMemoryBuffer(data)
+        trans = buffer
+        if transport == "framed":
+            trans = TTransport.TFramedTransport(buffer)
+        return TChatService.Client(protocol_factory(protocol).getProtocol(trans)), buffer
+
+    def _call(self, transport, protocol, method, *args):
+        client, buffer = self._client(None, transport, protocol)
+        getattr(client, "send_%s" % method)(*args)
+        request = buffer.getvalue()
+
+        #server transport as created by GThriftServer
+        itrans = TTransport.TMemoryBuffer(request)
+        otrans = TTransport.TMemoryBuffer()
+        self.processor.process(
+                TBinaryProtocol.TBinaryProtocol(itrans),
+                TBinaryProtocol.TBinaryProtocol(otrans))
+        response = otrans.getvalue()
+
+        client, buffer = self._client(response, transport, protocol)
+        result = getattr(client, "recv_%s" % method)()
+        return result, len(request), len(response)
+
+    def _benchmark(self, method, args, expected, iterations=200):
+        for transport in ["buffered", "framed"]:
+            for protocol in ["binary", "accelerated", "compact"]:
+                start = time.time()
+                for i in range(iterations):
+                    result, request_bytes, response_bytes = \
+                            self._call(transport, protocol, method, *args)
+                elapsed = time.time() - start
+
+                self.assertEqual(result, expected)
+                logging.info("%s (%s/%s): %.0f requests/sec, request=%s bytes, response=%s bytes" % (
+                    method, transport, protocol, iterations / elapsed,
+                    request_bytes, response_bytes))
+
+    def test_get_messages(self):
+        self._benchmark(
+                "getMessages",
+                (self.context, CHAT_TOKEN, 0, False, 0),
+                self.messages)
+
+    def test_send_message(self):
+        self._benchmark(
+                "sendMessage",
+                (self.context, self.messages[0], 3, 2),
+                self.messages[0])
+
+    def test_replicate(self):
+        self._benchmark(
+                "replicate",
+                (self.context, self.snapshot),
+                None)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
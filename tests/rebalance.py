@@ -0,0 +1,155 @@
+import time
+import unittest
+
+import gevent
+
+import testbase
+from trchatsvc.gen.ttypes import ChatStatus
+
+from chat import Chat
+from rebalance import Rebalancer, TokenBucket
+from replication import GreenletPoolReplicator, ReplicationException
+from testbase import CHAT_TOKEN, build_message, FakeHashring, FakeChatManager, \
+        FakeServiceInfo, FakeNode, FakeClient, FakeServiceProxyPool, SERVICE_KEY
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        bucket = TokenBucket(None)
+        self.assertEqual(bucket.consume(1000000), 0)
+
+    def test_rate_limited(self):
+        bucket = TokenBucket(100)
+        self.assertEqual(bucket.consume(100), 0)
+
+        start = time.time()
+        bucket.consume(10)
+        self.assertTrue(time.time() - start >= 0.09)
+
+
+class RebalanceChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = Chat(None, CHAT_TOKEN)
+        self.replica = Chat(None, CHAT_TOKEN)
+        self.rebalancer = Rebalancer(None, chunk_size=2)
+
+    def test_chunked_transfer(self):
+        self.chat.send_messages([build_message("message-%s" % i) for i in range(5)])
+        self.chat.state.status = ChatStatus.STARTED
+        self.chat.state_changed("status")
+
+        messages = self.chat.get_messages()
+        sequence = self.chat.sequence
+        chunks = [messages[0:2], messages[2:4], messages[4:]]
+
+        for chunk in chunks[:-1]:
+            snapshot = self.rebalancer._build_chunk_snapshot(self.chat, chunk)
+            self.assertTrue(self.replica.store_snapshot(snapshot))
+            self.assertIsNone(self.replica.state.status)
+
+        snapshot = self.rebalancer._build_chunk_snapshot(self.chat, chunks[-1], sequence)
+        self.assertTrue(self.replica.store_snapshot(snapshot))
+
+        self.assertEqual(self.replica.state.status, ChatStatus.STARTED)
+        self.assertEqual(self.replica.replicated_sequence, sequence)
+        self.assertEqual(len(self.replica.state.messages), 5)
+
+
+class FakeService(object):
+    def info(self):
+        return FakeServiceInfo("UNITTEST_LOCAL_SERVICE_KEY")
+
+class RecordingClient(FakeClient):
+    def __init__(self, snapshots):
+        super(RecordingClient, self).__init__()
+        self.snapshots = snapshots
+
+    def replicate(self, context, snapshot):
+        gevent.sleep(0.01)
+        self.snapshots.append(snapshot)
+
+
+class RebalanceShutdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshots = []
+        self.node = FakeNode()
+        self.replicator = GreenletPoolReplicator(
+                service=FakeService(),
+                hashring=FakeHashring(),
+                chat_manager=FakeChatManager(),
+                N=2,
+                W=1,
+                size=2,
+                drain_timeout=5)
+        self.replicator.service_proxy_pools[SERVICE_KEY] = FakeServiceProxyPool(
+                client_factory=lambda: RecordingClient(self.snapshots))
+
+    def test_queued_rebalances_sent_on_stop(self):
+        self.replicator.start()
+        for i in range(5):
+            chat = Chat(None, "%s_%s" % (CHAT_TOKEN, i))
+            self.replicator.rebalancer.rebalance(chat, [self.node])
+
+        self.replicator.stop()
+        self.replicator.join(5)
+
+        self.assertEqual(len(self.snapshots), 5)
+        self.assertTrue(self.replicator.rebalancer.is_converged())
+        for greenlet in self.replicator.workers + self.replicator.rebalancer.workers:
+            self.assertTrue(greenlet.ready())
+
+    def test_send_timeout(self):
+        chat = Chat(None, CHAT_TOKEN)
+        snapshot = self.replicator.rebalancer._build_chunk_snapshot(chat, [])
+        self.assertRaises(ReplicationException,
+                self.replicator.send, self.node, snapshot, timeout=0.01)
+
+        #the timed out send is not sent once the workers start.
+        self.replicator.start()
+        self.replicator.stop()
+        self.replicator.join(5)
+        self.assertEqual(self.snapshots, [])
+
+
+class CoalesceWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshots = []
+        self.node = FakeNode()
+        self.replicator = GreenletPoolReplicator(
+                service=FakeService(),
+                hashring=FakeHashring(),
+                chat_manager=FakeChatManager(),
+                N=2,
+                W=1,
+                size=1,
+                coalesce=True,
+                coalesce_window=5,
+                drain_timeout=5)
+        self.replicator.service_proxy_pools[SERVICE_KEY] = FakeServiceProxyPool(
+                client_factory=lambda: RecordingClient(self.snapshots))
+
+    def test_window_does_not_hold_worker(self):
+        self.replicator.start()
+        chat = Chat(None, CHAT_TOKEN)
+        self.replicator.replicate(chat, [build_message("message-0")])
+        self.replicator.replicate(chat, [build_message("message-1")])
+        self.assertEqual(self.replicator.delayed.keys(), [(CHAT_TOKEN, 2)])
+        self.assertEqual(self.replicator.queue.qsize(), 0)
+
+        #the single worker is free to send while the chat is delayed.
+        snapshot = self.replicator.rebalancer._build_chunk_snapshot(chat, [])
+        self.replicator.send(self.node, snapshot, timeout=1)
+        self.assertEqual(len(self.snapshots), 1)
+
+        #delayed items are queued immediately on stop.
+        self.replicator.stop()
+        self.replicator.join(1)
+        self.assertEqual(self.replicator.delayed, {})
+        self.assertEqual(self.replicator.pending, {})
+
+if __name__ == '__main__':
+    unittest.main()
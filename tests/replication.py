@@ -3,6 +3,7 @@ import unittest
 
 import gevent
 
+from trchatsvc.gen.ttypes import ChatCursor, SendMessageStatus
 from testbase import DistributedTestCase, create_chat, delete_chat, build_user_status_message
 
 
@@ -85,5 +86,48 @@ class ReplicationTest(DistributedTestCase):
         chat = self.service.handler.chat_manager.get(self.chat_token)
         self.assertEqual(len(chat.state.messages), length+1)
 
+    def test_getMessagesMulti(self):
+        message = build_user_status_message(self.chat_token)
+        self.service_proxy.sendMessage(
+                requestContext=self.request_context,
+                message=message,
+                N=2,
+                W=1)
+
+        cursors = [
+            ChatCursor(chatToken=self.chat_token, asOf=0),
+            ChatCursor(chatToken="UNITTEST_INVALID_CHAT_TOKEN", asOf=0)
+        ]
+        result = self.service_proxy.getMessagesMulti(
+                self.request_context, cursors, True, 1)
+        result = dict((r.chatToken, r) for r in result)
+
+        self.assertTrue(len(result[self.chat_token].messages) >= 1)
+        self.assertTrue(result["UNITTEST_INVALID_CHAT_TOKEN"].invalidChat)
+
+    def test_sendMessages(self):
+        chat = self.service.handler.chat_manager.get(self.chat_token)
+        chat2 = self.service2.handler.chat_manager.get(self.chat_token)
+
+        length = len(chat.state.messages)
+        length2 = len(chat2.state.messages)
+
+        messages = [
+            build_user_status_message(self.chat_token),
+            build_user_status_message("UNITTEST_INVALID_CHAT_TOKEN"),
+            build_user_status_message(self.chat_token)
+        ]
+        results = self.service_proxy.sendMessages(
+                self.request_context, messages, 2, 2)
+
+        self.assertEqual([r.status for r in results], [
+            SendMessageStatus.SENT,
+            SendMessageStatus.INVALID_CHAT,
+            SendMessageStatus.SENT])
+        self.assertTrue(results[0].message.header.timestamp <= results[2].message.header.timestamp)
+
+        self.assertEqual(len(chat.state.messages), length+2)
+        self.assertEqual(len(chat2.state.messages), length2+2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+import logging
+import time
+import unittest
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+import testbase
+from tridlcore.gen.ttypes import RequestContext
+from trchatsvc.gen import TChatService
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+from chat import Chat
+from snapshot import ChatServiceClient, SerializedChatSnapshot
+from testbase import CHAT_TOKEN, build_messages
+
+def build_chat(num_messages):
+    chat = Chat(None, CHAT_TOKEN)
+    chat.store_replicated_messages(build_messages(num_messages))
+    return chat
+
+def build_snapshot(chat):
+    state = ChatState(token=CHAT_TOKEN, messages=chat.get_messages())
+    for field in Chat.STATE_FIELDS:
+        setattr(state, field, getattr(chat.state, field))
+    return ChatSnapshot(
+            fullSnapshot=True,
+            state=state,
+            epoch=chat.epoch,
+            sequence=chat.sequence)
+
+def write_replicate(client_class, protocol_class, context, snapshot):
+    """Encode a replicate() call with the given client and protocol."""
+    transport = TTransport.TMemoryBuffer()
+    client = client_class(protocol_class(transport))
+    client.send_replicate(context, snapshot)
+    return transport.getvalue()
+
+def per_node(protocol_class, chat, context, peers):
+    """Previous replication path: build and encode for every peer."""
+    return [write_replicate(TChatService.Client, protocol_class, context, build_snapshot(chat))
+            for i in range(peers)]
+
+def fan_out(protocol_class, chat, context, peers):
+    """Build and serialize once, then write the same bytes to every peer."""
+    snapshot = SerializedChatSnapshot(build_snapshot(chat))
+    return [write_replicate(ChatServiceClient, protocol_class, context, snapshot)
+            for i in range(peers)]
+
+def benchmark(method, protocol_class, chat, context, peers, iterations):
+    start = time.time()
+    for i in range(iterations):
+        method(protocol_class, chat, context, peers)
+    return time.time() - start
+
+
+@testbase.benchmark
+class SnapshotFanOutBenchmark(unittest.TestCase):
+
+    def _run(self, protocol_class, num_messages, N, iterations=200):
+        chat = build_chat(num_messages)
+        context = RequestContext(userId=0, impersonatingUserId=0, sessionId="dummy", context="")
+        peers = N - 1
+
+        self.assertEqual(
+                per_node(protocol_class, chat, context, peers),
+                fan_out(protocol_class, chat, context, peers))
+
+        per_node_time = benchmark(per_node, protocol_class, chat, context, peers, iterations)
+        fan_out_time = benchmark(fan_out, protocol_class, chat, context, peers, iterations)
+        replicated = float(iterations * num_messages)
+
+        logging.info("%s messages=%s, N=%s: per-node=%.2fus/msg, fan-out=%.2fus/msg (saved %.2fus/msg)" % (
+            protocol_class.__name__, num_messages, N,
+            per_node_time / replicated * 1e6,
+            fan_out_time / replicated * 1e6,
+            (per_node_time - fan_out_time) / replicated * 1e6))
+
+    def test_fan_out(self):
+        for protocol_class in [TBinaryProtocol.TBinaryProtocol,
+                TBinaryProtocol.TBinaryProtocolAccelerated]:
+            for num_messages in [10, 100, 1000]:
+                for N in [2, 3]:
+                    self._run(protocol_class, num_messages, N)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
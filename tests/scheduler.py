@@ -0,0 +1,54 @@
+import unittest
+
+import gevent
+
+import testbase
+from scheduler import PriorityScheduler, ReplicationPriority
+
+WEIGHTS = {
+    ReplicationPriority.INTERACTIVE: 4,
+    ReplicationPriority.REBALANCE: 2,
+    ReplicationPriority.BACKGROUND: 1
+}
+
+class PrioritySchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = PriorityScheduler(WEIGHTS)
+
+    def test_weighted_dequeue(self):
+        for priority in ReplicationPriority.ALL:
+            for i in range(70):
+                self.scheduler.put(priority, priority)
+
+        dequeued = [self.scheduler.get() for i in range(70)]
+        self.assertEqual(dequeued.count(ReplicationPriority.INTERACTIVE), 40)
+        self.assertEqual(dequeued.count(ReplicationPriority.REBALANCE), 20)
+        self.assertEqual(dequeued.count(ReplicationPriority.BACKGROUND), 10)
+
+    def test_single_class(self):
+        for i in range(3):
+            self.scheduler.put(i, ReplicationPriority.BACKGROUND)
+        self.assertEqual([self.scheduler.get() for i in range(3)], [0, 1, 2])
+
+    def test_blocking_get(self):
+        getter = gevent.spawn(self.scheduler.get)
+        gevent.sleep(0)
+        self.assertFalse(getter.ready())
+
+        self.scheduler.put("item", ReplicationPriority.REBALANCE)
+        getter.join(timeout=1)
+        self.assertEqual(getter.value, "item")
+
+    def test_stats(self):
+        self.scheduler.put("item", ReplicationPriority.INTERACTIVE)
+        self.scheduler.put("item", ReplicationPriority.INTERACTIVE)
+        self.scheduler.get()
+
+        stats = self.scheduler.to_dict()[ReplicationPriority.INTERACTIVE]
+        self.assertEqual(stats["depth"], 1)
+        self.assertEqual(stats["enqueued"], 2)
+        self.assertEqual(stats["dequeued"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import testbase
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+from tridlcore.gen.ttypes import RequestContext
+from trchatsvc.gen import TChatService
+from trchatsvc.gen.ttypes import ChatState, ChatSnapshot
+
+from snapshot import ChatServiceClient, SerializedChatSnapshot
+from testbase import CHAT_TOKEN
+
+def send_replicate(client_class, protocol_class, context, snapshot):
+    transport = TTransport.TMemoryBuffer()
+    client = client_class(protocol_class(transport))
+    client.send_replicate(context, snapshot)
+    return transport.getvalue()
+
+
+class ChatServiceClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = RequestContext(
+                userId=0,
+                impersonatingUserId=0,
+                sessionId="dummy_session_id",
+                context="")
+        self.snapshot = ChatSnapshot(
+                fullSnapshot=True,
+                state=ChatState(token=CHAT_TOKEN, messages=[]),
+                epoch=1,
+                sequence=1)
+
+    def test_serialized_bytes_written(self):
+        expected = send_replicate(TChatService.Client,
+                TBinaryProtocol.TBinaryProtocolAccelerated, self.context, self.snapshot)
+        serialized = SerializedChatSnapshot(self.snapshot)
+
+        #changes following serialization are not written,
+        #since the serialized bytes are written as is.
+        self.snapshot.sequence = 2
+
+        for protocol_class in [TBinaryProtocol.TBinaryProtocol,
+                TBinaryProtocol.TBinaryProtocolAccelerated]:
+            self.assertEqual(
+                    send_replicate(ChatServiceClient, protocol_class, self.context, serialized),
+                    expected)
+
+if __name__ == '__main__':
+    unittest.main()
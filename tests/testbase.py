@@ -10,6 +10,14 @@ os.environ["SERVICE_ENV"] = "test"
 
 SERVICE_NAME = "chatsvc"
 
+#Chat token and service key used by unit tests.
+CHAT_TOKEN = "UNITTEST_CHAT_TOKEN"
+SERVICE_KEY = "UNITTEST_SERVICE_KEY"
+
+#Benchmarks only log timings, and are skipped unless
+#CHATSVC_BENCHMARKS is set, i.e. CHATSVC_BENCHMARKS=1 python tests/chat_benchmark.py
+RUN_BENCHMARKS = bool(os.environ.get("CHATSVC_BENCHMARKS"))
+
 #Add PROJECT_ROOT to python path, for version import.
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
 sys.path.insert(0, PROJECT_ROOT)
@@ -29,7 +37,10 @@ from trchatsvc.gen import TChatService
 from trchatsvc.gen.ttypes import MessageHeader, MessageType, Message, \
         UserStatusMessage, UserStatus, MessageRoute, MessageRouteType
 
+import settings
 from handler import ChatServiceHandler
+from processor import ChatServiceProcessor
+from protocol import ServiceProxyPool
 
 class ChatService(GDefaultService):
     def __init__(self, hostname, port):
@@ -40,7 +51,11 @@ class ChatService(GDefaultService):
                 interface="0.0.0.0",
                 port=port,
                 handler=self.handler,
-                processor=TChatService.Processor(self.handler),
+                processor=ChatServiceProcessor(
+                    self.handler,
+                    protocol=settings.THRIFT_SERVER_PROTOCOL,
+                    allow_compact=settings.THRIFT_SERVER_ALLOW_COMPACT,
+                    allow_framed=settings.THRIFT_SERVER_ALLOW_FRAMED),
                 address=hostname)
 
         super(ChatService, self).__init__(
@@ -117,6 +132,11 @@ class DistributedTestCase(unittest.TestCase):
 
 
 #Helper methods
+def benchmark(test_case_class):
+    """Skip benchmark test case unless CHATSVC_BENCHMARKS is set."""
+    return unittest.skipUnless(RUN_BENCHMARKS,
+            "set CHATSVC_BENCHMARKS=1 to run benchmarks")(test_case_class)
+
 def delete_chat(session, chat):
     session.delete(chat)
     session.commit()
@@ -149,3 +169,77 @@ def build_user_status_message(token, status=UserStatus.AVAILABLE, userId=1):
             )
 
     return message
+
+def build_message(message_id=None, timestamp=None,
+        route_type=MessageRouteType.BROADCAST_ROUTE, recipients=None, token=CHAT_TOKEN):
+    header = MessageHeader(
+            id=message_id,
+            type=MessageType.USER_STATUS,
+            chatToken=token,
+            userId=1,
+            timestamp=timestamp,
+            route=MessageRoute(route_type, recipients))
+
+    message = Message(
+            header=header,
+            userStatusMessage=UserStatusMessage(userId=1, status=UserStatus.CONNECTED))
+
+    return message
+
+def build_messages(num_messages, token=CHAT_TOKEN):
+    return [build_message("message-%s" % i, float(i + 1), token=token)
+            for i in range(num_messages)]
+
+
+#Unit test fakes
+class FakeHashring(object):
+    def add_observer(self, observer):
+        pass
+
+class FakeEndpoint(object):
+    address = "localhost"
+    port = 9090
+
+class FakeServiceInfo(object):
+    name = SERVICE_NAME
+
+    def __init__(self, key=SERVICE_KEY):
+        self.key = key
+
+    def default_endpoint(self):
+        return FakeEndpoint()
+
+class FakeNode(object):
+    def __init__(self, key=SERVICE_KEY):
+        self.service_info = FakeServiceInfo(key)
+
+class FakeChatManager(object):
+    def __init__(self):
+        self.chats = {}
+
+    def all(self):
+        return self.chats
+
+class FakeTransport(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.trans = FakeTransport()
+
+class FakeClient(object):
+    def __init__(self):
+        self._iprot = FakeProtocol()
+
+class FakeServiceProxyPool(ServiceProxyPool):
+    def __init__(self, max_connections=1, client_factory=FakeClient):
+        super(FakeServiceProxyPool, self).__init__(
+                FakeEndpoint.address, FakeEndpoint.port, max_connections, TChatService)
+        self.client_factory = client_factory
+
+    def _connect(self):
+        return self.client_factory()
@@ -1,2 +1,2 @@
-VERSION = "0.30.0"
+VERSION = "0.31.0"
 BUILD = None